@@ -0,0 +1,317 @@
+"""
+lock_scenarios のシナリオを N 並列で流し続け、ロック競合のコストを測る
+
+    python bench_lock_contention.py --workers 8 --duration 10
+    python bench_lock_contention.py -e mysql -s gap --compare bench_results/previous.json
+
+シナリオごとに スループット / レイテンシ (p50, p99) / ロック待ち時間 / デッドロック・タイムアウト率
+を集計し、実行ごとに JSON ファイルへ保存する (--compare で前回の結果と比べられる)
+
+ロック待ち時間は
+- MySQL: SHOW GLOBAL STATUS の Innodb_row_lock_time / Innodb_row_lock_waits の増分
+- PostgreSQL: pg_stat_activity で wait_event_type = 'Lock' のセッション数をサンプリングした積算
+で、どちらもサーバー全体の値なので他の負荷がない状態で実行する
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from os import environ
+
+import psycopg
+from mysql import connector
+from tabulate import tabulate
+
+from lock_scenarios import SCENARIOS
+from util import (
+    classify_error,
+    connect_mysql,
+    connect_postgresql,
+    setup_mysql_fixture,
+    setup_postgresql_fixture,
+)
+
+ENGINES = ("mysql", "postgresql")
+RESULTS_DIR = "bench_results"
+
+# INSERT の主キーが既存の行やほかのワーカーと重ならないようにする
+KEY_BASE = 1_000_000
+KEY_STRIDE = 1_000_000
+
+
+def percentile(sorted_values, p):
+    # nearest-rank 法
+    if not sorted_values:
+        return None
+    rank = max(int(len(sorted_values) * p / 100 + 0.999999) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def connect(engine):
+    if engine == "mysql":
+        return connect_mysql()
+    conn = connect_postgresql()
+    # innodb_lock_wait_timeout と揃える
+    conn.execute("SET lock_timeout = '5s'")
+    conn.commit()
+    return conn
+
+
+def setup(engine, scenario):
+    conn = connect_mysql() if engine == "mysql" else connect_postgresql()
+    try:
+        if engine == "mysql":
+            setup_mysql_fixture(conn, scenario.setup[engine])
+        else:
+            setup_postgresql_fixture(conn, scenario.setup[engine])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class Worker(threading.Thread):
+    def __init__(self, engine, conn, statements, index, deadline):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.conn = conn
+        self.statements = statements
+        self.index = index
+        self.deadline = deadline
+        self.latencies = []
+        self.outcomes = Counter()
+        self.error = None
+
+    def run(self):
+        try:
+            self.loop()
+        except Exception as e:
+            self.error = e
+
+    def loop(self):
+        cur = (
+            self.conn.cursor(buffered=True)
+            if self.engine == "mysql"
+            else self.conn.cursor()
+        )
+        seq = 0
+        while time.monotonic() < self.deadline:
+            n = KEY_BASE + self.index * KEY_STRIDE + seq
+            seq += 1
+            started = time.perf_counter()
+            try:
+                for statement in self.statements:
+                    cur.execute(statement.format(n=n))
+                self.conn.commit()
+                outcome = "ok"
+            except (connector.Error, psycopg.Error) as e:
+                outcome = classify_error(e)
+                if outcome is None:
+                    raise
+                self.conn.rollback()
+            self.latencies.append(time.perf_counter() - started)
+            self.outcomes[outcome] += 1
+
+
+class LockWaitMeter:
+    """
+    ベンチマーク中のロック待ち時間を測る
+    """
+
+    def __init__(self, engine, interval=0.01):
+        self.engine = engine
+        self.interval = interval
+        self.conn = (
+            connect_mysql(root=True) if engine == "mysql" else connect_postgresql()
+        )
+        self.conn.autocommit = True
+        self._stop = threading.Event()
+        self._thread = None
+        self._before = None
+        self.waiting_seconds = 0.0
+
+    def mysql_counters(self):
+        with self.conn.cursor() as cur:
+            cur.execute(
+                "SHOW GLOBAL STATUS WHERE Variable_name IN "
+                "('Innodb_row_lock_time', 'Innodb_row_lock_waits')"
+            )
+            return {name: int(value) for name, value in cur.fetchall()}
+
+    def sample_postgresql(self):
+        previous = time.monotonic()
+        while not self._stop.wait(self.interval):
+            waiting = self.conn.execute(
+                "select count(*) from pg_stat_activity "
+                "where wait_event_type = 'Lock' and datname = current_database()"
+            ).fetchone()[0]
+            now = time.monotonic()
+            self.waiting_seconds += waiting * (now - previous)
+            previous = now
+
+    def start(self):
+        if self.engine == "mysql":
+            self._before = self.mysql_counters()
+        else:
+            self._thread = threading.Thread(target=self.sample_postgresql, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        try:
+            if self.engine == "mysql":
+                after = self.mysql_counters()
+                return {
+                    "seconds": (
+                        after["Innodb_row_lock_time"]
+                        - self._before["Innodb_row_lock_time"]
+                    )
+                    / 1000,
+                    "waits": after["Innodb_row_lock_waits"]
+                    - self._before["Innodb_row_lock_waits"],
+                }
+            self._stop.set()
+            self._thread.join()
+            return {"seconds": self.waiting_seconds, "waits": None}
+        finally:
+            self.conn.close()
+
+
+def run_scenario(engine, scenario, workers, duration, prepare=None):
+    """
+    scenario を workers 並列で duration 秒流して結果を dict で返す
+
+    prepare(conn) はワーカーのコネクションを作った直後に呼ぶ (分離レベルの設定など)
+    """
+    setup(engine, scenario)
+    connections = [connect(engine) for _ in range(workers)]
+    try:
+        if prepare is not None:
+            for conn in connections:
+                prepare(conn)
+
+        meter = LockWaitMeter(engine)
+        meter.start()
+        started = time.monotonic()
+        deadline = started + duration
+        threads = [
+            Worker(
+                engine,
+                conn,
+                scenario.transactions[index % len(scenario.transactions)],
+                index,
+                deadline,
+            )
+            for index, conn in enumerate(connections)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        lock_wait = meter.stop()
+    finally:
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+    latencies = sorted(latency for thread in threads for latency in thread.latencies)
+    outcomes = Counter()
+    for thread in threads:
+        outcomes.update(thread.outcomes)
+    total = len(latencies)
+    return {
+        "engine": engine,
+        "scenario": scenario.name,
+        "workers": workers,
+        "elapsed": elapsed,
+        "transactions": total,
+        "committed": outcomes["ok"],
+        "throughput": outcomes["ok"] / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000 if total else None,
+            "p99": percentile(latencies, 99) * 1000 if total else None,
+            "max": latencies[-1] * 1000 if total else None,
+        },
+        "outcomes": dict(outcomes),
+        "deadlock_rate": outcomes["deadlock"] / total if total else 0.0,
+        "timeout_rate": outcomes["timeout"] / total if total else 0.0,
+        "lock_wait": lock_wait,
+    }
+
+
+def summarize(results, previous=None):
+    baseline = {
+        (result["engine"], result["scenario"]): result for result in previous or []
+    }
+    rows = []
+    for result in results:
+        row = {
+            "engine": result["engine"],
+            "scenario": result["scenario"],
+            "tps": round(result["throughput"], 1),
+            "p50_ms": result["latency_ms"]["p50"],
+            "p99_ms": result["latency_ms"]["p99"],
+            "lock_wait_s": round(result["lock_wait"]["seconds"], 3),
+            "deadlock": f"{result['deadlock_rate']:.2%}",
+            "timeout": f"{result['timeout_rate']:.2%}",
+        }
+        before = baseline.get((result["engine"], result["scenario"]))
+        if before is not None and before["throughput"]:
+            row["tps_vs_prev"] = (
+                f"{result['throughput'] / before['throughput'] - 1:+.1%}"
+            )
+        rows.append(row)
+    return tabulate(rows, headers="keys", tablefmt="psql", floatfmt=".2f")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-e", "--engine", choices=ENGINES, action="append")
+    parser.add_argument("-s", "--scenario", choices=SCENARIOS, action="append")
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("-o", "--out")
+    parser.add_argument("--compare")
+    args = parser.parse_args(argv)
+
+    results = [
+        run_scenario(engine, SCENARIOS[name], args.workers, args.duration)
+        for engine in args.engine or ENGINES
+        for name in args.scenario or SCENARIOS
+    ]
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"lock_contention-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(
+            {
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "mysql_database": environ["MYSQL_DATABASE"],
+                "postgres_db": environ["POSTGRES_DB"],
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+    print(summarize(results, previous))
+    print(f"saved to {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
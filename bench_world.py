@@ -0,0 +1,390 @@
+"""
+world データセット (db/mysql/initdb.d/world.sql.gz) を使ったホットスポットのベンチマーク (MySQL のみ)
+
+    python bench_world.py --scale 1 --scale 100 --skew 0 --skew 1.2 --read-ratio 0.5
+
+world スキーマの city / country / countrylanguage を作業用のスキーマに world_* としてコピーし、
+city と countrylanguage を --scale 倍に複製してから以下のトランザクションを混ぜて流す
+(country は Code char(3) が主キーなので複製せず、元の 239 行のまま)
+- 読み込み: countrylanguage を CountryCode (セカンダリインデックス) の範囲で FOR SHARE
+  範囲は Zipf で選んだ国から Code の順に --range-width か国分
+- 書き込み: city.Population / country.Population の UPDATE、countrylanguage への INSERT
+更新対象の国・都市は Zipf 分布 (--skew、0 なら一様) で選ぶ
+
+スループット・レイテンシ・デッドロック / タイムアウト率に加えて、実行中に data_locks を
+サンプリングし、インデックスごとのネクストキー / ギャップ / レコード / 挿入意図ロックの数を集計する
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from mysql import connector
+from tabulate import tabulate
+
+from bench_lock_contention import RESULTS_DIR, LockWaitMeter, percentile
+from util import LockSnapshot, classify_error, connect_mysql, lock_kind
+
+TABLES = ("country", "city", "countrylanguage")
+# 複製した city の ID が元の行と重ならないようにする (world.city の ID は 4079 まで)
+CITY_ID_STRIDE = 10000
+
+
+class Zipf:
+    """
+    1..n の順位を確率 1 / rank^skew に比例して選ぶ (skew=0 なら一様)
+
+    累積分布は大きくなるので 1 度だけ作って全ワーカーで共有し、乱数はワーカーごとの rng を渡す
+    """
+
+    def __init__(self, n, skew):
+        self.cdf = list(
+            itertools.accumulate(1 / (rank**skew) for rank in range(1, n + 1))
+        )
+
+    def sample(self, rng):
+        return bisect.bisect_left(self.cdf, rng.random() * self.cdf[-1])
+
+
+def language_prefix(column_length, scale):
+    """
+    複製した countrylanguage の Language (元の名前の先頭 + '#' + 複製の番号) が
+    列の長さに収まるよう、元の名前を切り詰める長さ
+    """
+    return column_length - len(f"#{max(scale - 1, 0)}")
+
+
+def load(scale):
+    """
+    world_* テーブルを用意し、city と countrylanguage を scale 倍の行数にする
+    (同じ行数で作成済みなら作り直さない)
+    """
+    conn = connect_mysql(root=True)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM world.city")
+        (cities,) = cur.fetchone()
+        cur.execute(
+            "SELECT CHARACTER_MAXIMUM_LENGTH FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = 'world' AND TABLE_NAME = 'countrylanguage' "
+            "AND COLUMN_NAME = 'Language'"
+        )
+        (language_length,) = cur.fetchone()
+        prefix = language_prefix(language_length, scale)
+        cur.execute(
+            "SELECT COUNT(*) FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = database() AND TABLE_NAME = 'world_city'"
+        )
+        if cur.fetchone()[0]:
+            cur.execute("SELECT COUNT(*) FROM world_city")
+            if cur.fetchone()[0] == cities * scale:
+                return
+        conn.rollback()
+
+        for table in TABLES:
+            cur.execute(f"DROP TABLE IF EXISTS world_{table}")
+            cur.execute(f"CREATE TABLE world_{table} LIKE world.{table}")
+        cur.execute("INSERT INTO world_country SELECT * FROM world.country")
+        conn.commit()
+
+        # 1 つのトランザクションが大きくなりすぎないよう 10 倍ずつ複製する
+        for start in range(0, scale, 10):
+            copies = ", ".join(
+                f"ROW({k})" for k in range(start, min(start + 10, scale))
+            )
+            cur.execute(
+                f"""
+                INSERT INTO world_city
+                SELECT c.ID + k.n * {CITY_ID_STRIDE}, c.Name, c.CountryCode,
+                    c.District, c.Population
+                FROM world.city c CROSS JOIN (VALUES {copies}) k (n)
+                """
+            )
+            cur.execute(
+                f"""
+                INSERT INTO world_countrylanguage
+                SELECT l.CountryCode,
+                    IF(k.n = 0, l.Language, CONCAT(LEFT(l.Language, {prefix}), '#', k.n)),
+                    l.IsOfficial, l.Percentage
+                FROM world.countrylanguage l CROSS JOIN (VALUES {copies}) k (n)
+                """
+            )
+            conn.commit()
+    finally:
+        conn.close()
+
+
+class WorldData:
+    """
+    全ワーカーで共有する、人口の多い順の国 / 都市と Zipf の累積分布
+    """
+
+    def __init__(self, countries, cities, skew):
+        self.countries = countries
+        self.cities = cities
+        # 範囲の読み込みは Code の順に隣り合う国を対象にする
+        self.codes = sorted(countries)
+        self.code_index = {code: i for i, code in enumerate(self.codes)}
+        self.country_rank = Zipf(len(countries), skew)
+        self.city_rank = Zipf(len(cities), skew)
+
+
+class WorldWorker(threading.Thread):
+    def __init__(self, conn, index, deadline, world, args):
+        super().__init__(daemon=True)
+        self.conn = conn
+        self.index = index
+        self.deadline = deadline
+        self.world = world
+        self.args = args
+        self.rng = random.Random(args.seed + index)
+        self.latencies = []
+        self.outcomes = Counter()
+        self.error = None
+
+    def run(self):
+        try:
+            self.loop()
+        except Exception as e:
+            self.error = e
+
+    def country(self):
+        return self.world.countries[self.world.country_rank.sample(self.rng)]
+
+    def code_range(self, code):
+        """
+        code から Code の順に range_width か国分の (最初, 最後) の Code
+        """
+        codes = self.world.codes
+        first = self.world.code_index[code]
+        last = min(first + self.args.range_width, len(codes)) - 1
+        return codes[first], codes[last]
+
+    def transaction(self, cur, seq):
+        if self.rng.random() < self.args.read_ratio:
+            cur.execute(
+                "SELECT * FROM world_countrylanguage "
+                "WHERE CountryCode BETWEEN %s AND %s FOR SHARE",
+                self.code_range(self.country()),
+            )
+            return
+
+        operation = self.rng.randrange(3)
+        if operation == 0:
+            cur.execute(
+                "UPDATE world_city SET Population = Population + 1 WHERE ID = %s",
+                (self.world.cities[self.world.city_rank.sample(self.rng)],),
+            )
+        elif operation == 1:
+            cur.execute(
+                "UPDATE world_country SET Population = Population + 1 WHERE Code = %s",
+                (self.country(),),
+            )
+        else:
+            code = self.country()
+            language = f"bench-{self.index}-{seq}"
+            cur.execute(
+                "INSERT INTO world_countrylanguage VALUES (%s, %s, 'F', 0.0)",
+                (code, language),
+            )
+            cur.execute(
+                "DELETE FROM world_countrylanguage "
+                "WHERE CountryCode = %s AND Language = %s",
+                (code, language),
+            )
+
+    def loop(self):
+        cur = self.conn.cursor(buffered=True)
+        for seq in itertools.count():
+            if time.monotonic() >= self.deadline:
+                break
+            started = time.perf_counter()
+            try:
+                self.transaction(cur, seq)
+                self.conn.commit()
+                outcome = "ok"
+            except connector.Error as e:
+                outcome = classify_error(e)
+                if outcome is None:
+                    raise
+                self.conn.rollback()
+            self.latencies.append(time.perf_counter() - started)
+            self.outcomes[outcome] += 1
+
+
+class LockCounter:
+    """
+    data_locks を一定間隔でサンプリングし、(インデックス, 種類) ごとのレコードロックの数を数える
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.conn = connect_mysql(root=True)
+        self.conn.autocommit = True
+        self.samples = 0
+        self.total = Counter()
+        self.peak = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        schema = os.environ["MYSQL_DATABASE"]
+        while not self._stop.wait(self.interval):
+            snapshot = LockSnapshot.capture_mysql(self.conn, schema=schema)
+            counts = Counter(
+                (f"{row['table']}.{row['index']}", lock_kind(row["mode"]))
+                for row in snapshot.filter(lock_type="RECORD").rows()
+            )
+            self.samples += 1
+            self.total.update(counts)
+            for key, count in counts.items():
+                self.peak[key] = max(self.peak[key], count)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.conn.close()
+        return {
+            f"{index} {kind}": {
+                "mean": self.total[(index, kind)] / max(self.samples, 1),
+                "peak": self.peak[(index, kind)],
+            }
+            for index, kind in sorted(self.total)
+        }
+
+
+def run_world(args, scale, skew):
+    load(scale)
+
+    conn = connect_mysql()
+    cur = conn.cursor()
+    # 人口の多い順を Zipf の順位にする
+    cur.execute("SELECT Code FROM world_country ORDER BY Population DESC, Code")
+    countries = [code for (code,) in cur.fetchall()]
+    cur.execute("SELECT ID FROM world_city ORDER BY Population DESC, ID")
+    cities = [city_id for (city_id,) in cur.fetchall()]
+    cur.execute("SELECT COUNT(*) FROM world_countrylanguage")
+    (languages,) = cur.fetchone()
+    conn.close()
+
+    world = WorldData(countries, cities, skew)
+    connections = [connect_mysql() for _ in range(args.workers)]
+    meter = LockWaitMeter("mysql")
+    counter = LockCounter(interval=args.lock_interval)
+    try:
+        meter.start()
+        counter.start()
+        started = time.monotonic()
+        threads = [
+            WorldWorker(conn, index, started + args.duration, world, args)
+            for index, conn in enumerate(connections)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        locks = counter.stop()
+        lock_wait = meter.stop()
+    finally:
+        for conn in connections:
+            conn.close()
+
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+    latencies = sorted(latency for thread in threads for latency in thread.latencies)
+    outcomes = Counter()
+    for thread in threads:
+        outcomes.update(thread.outcomes)
+    total = len(latencies)
+    return {
+        "scale": scale,
+        "rows": {
+            "country": len(countries),
+            "city": len(cities),
+            "countrylanguage": languages,
+        },
+        "skew": skew,
+        "read_ratio": args.read_ratio,
+        "workers": args.workers,
+        "elapsed": elapsed,
+        "transactions": total,
+        "throughput": outcomes["ok"] / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000 if total else None,
+            "p99": percentile(latencies, 99) * 1000 if total else None,
+        },
+        "outcomes": dict(outcomes),
+        "deadlock_rate": outcomes["deadlock"] / total if total else 0.0,
+        "timeout_rate": outcomes["timeout"] / total if total else 0.0,
+        "lock_wait": lock_wait,
+        "locks": locks,
+    }
+
+
+def summarize(results):
+    rows = []
+    for result in results:
+        locks = result["locks"]
+        rows.append(
+            {
+                "scale": result["scale"],
+                "skew": result["skew"],
+                "tps": round(result["throughput"], 1),
+                "p99_ms": result["latency_ms"]["p99"],
+                "lock_wait_s": round(result["lock_wait"]["seconds"], 3),
+                "deadlock": f"{result['deadlock_rate']:.2%}",
+                "timeout": f"{result['timeout_rate']:.2%}",
+                "next-key": sum(
+                    v["mean"] for k, v in locks.items() if k.endswith(" next-key")
+                ),
+                "gap": sum(v["mean"] for k, v in locks.items() if k.endswith(" gap")),
+            }
+        )
+    return tabulate(rows, headers="keys", tablefmt="psql", floatfmt=".2f")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", type=int, action="append")
+    parser.add_argument("--skew", type=float, action="append")
+    parser.add_argument("--read-ratio", type=float, default=0.5)
+    parser.add_argument("--range-width", type=int, default=3)
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("--lock-interval", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--out")
+    args = parser.parse_args(argv)
+
+    results = [
+        run_world(args, scale, skew)
+        for scale in args.scale or [1]
+        for skew in args.skew or [0.0, 1.2]
+    ]
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"world-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({"results": results}, f, indent=2)
+
+    print(summarize(results))
+    print(f"saved to {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
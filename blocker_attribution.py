@@ -0,0 +1,304 @@
+"""
+ロックを待たせている側のどの文がそのロックを取ったのかを推定し、待たされた時間を文の形ごとに集計する (MySQL)
+
+    python blocker_attribution.py --duration 30 --interval 0.5
+
+InnoDB はロックを取った文を記録しないので、test_observe_lock と同じく
+sys.innodb_lock_waits (data_lock_waits) -> INNODB_TRX -> threads -> events_statements_history
+とたどり、待たせているスレッドの履歴のうち最後の BEGIN / COMMIT / ROLLBACK より後の文から
+次の条件に近い文を選ぶ
+- 待たせているトランザクションの中で実行された文 (events_transactions_current で確認できたもの)
+- ロックのテーブルを参照している
+- ロックのインデックスの列を参照している
+- ロックを取る文 (FOR UPDATE / FOR SHARE / UPDATE / DELETE / INSERT など)
+同点の場合は先に実行された文 (最初にロックを取った文) を選ぶ
+
+1 回のスナップショットは、待ちの関係・ロック・インデックスの列・履歴をまとめて取る 1 クエリで済ませる
+"""
+
+import argparse
+import re
+import time
+from dataclasses import dataclass, field
+
+from tabulate import tabulate
+
+from statement_stats import fingerprint
+from util import connect_mysql
+
+MYSQL_BLOCKER_QUERY = """
+select
+    tw.PROCESSLIST_ID,
+    tb.PROCESSLIST_ID,
+    l.OBJECT_SCHEMA,
+    l.OBJECT_NAME,
+    l.INDEX_NAME,
+    l.LOCK_MODE,
+    l.LOCK_DATA,
+    i.COLUMNS,
+    trx.trx_wait_started,
+    timestampdiff(microsecond, trx.trx_wait_started, now(6)) / 1000000,
+    cw.SQL_TEXT,
+    h.EVENT_ID,
+    h.SQL_TEXT,
+    case
+        when bt.EVENT_ID is null or h.EVENT_ID is null then null
+        else h.NESTING_EVENT_ID <=> bt.EVENT_ID
+    end
+from
+    performance_schema.data_lock_waits w
+    join performance_schema.data_locks l on (
+        l.ENGINE = w.ENGINE
+        and l.ENGINE_LOCK_ID = w.BLOCKING_ENGINE_LOCK_ID
+    )
+    join performance_schema.threads tw on (w.REQUESTING_THREAD_ID = tw.THREAD_ID)
+    join performance_schema.threads tb on (w.BLOCKING_THREAD_ID = tb.THREAD_ID)
+    left join information_schema.INNODB_TRX trx on (
+        trx.trx_id = w.REQUESTING_ENGINE_TRANSACTION_ID
+    )
+    left join performance_schema.events_statements_current cw on (
+        cw.THREAD_ID = w.REQUESTING_THREAD_ID
+        and cw.NESTING_EVENT_LEVEL = 0
+    )
+    left join performance_schema.events_transactions_current bt on (
+        bt.THREAD_ID = w.BLOCKING_THREAD_ID
+        and bt.STATE = 'ACTIVE'
+    )
+    left join performance_schema.events_statements_history h on (
+        h.THREAD_ID = w.BLOCKING_THREAD_ID
+    )
+    left join (
+        select
+            TABLE_SCHEMA,
+            TABLE_NAME,
+            INDEX_NAME,
+            group_concat(COLUMN_NAME order by SEQ_IN_INDEX) as COLUMNS
+        from
+            information_schema.STATISTICS
+        where
+            %(schema)s is null or TABLE_SCHEMA = %(schema)s
+        group by
+            TABLE_SCHEMA,
+            TABLE_NAME,
+            INDEX_NAME
+    ) i on (
+        i.TABLE_SCHEMA = l.OBJECT_SCHEMA
+        and i.TABLE_NAME = l.OBJECT_NAME
+        and i.INDEX_NAME = l.INDEX_NAME
+    )
+where
+    %(schema)s is null or l.OBJECT_SCHEMA = %(schema)s
+order by
+    tw.PROCESSLIST_ID,
+    tb.PROCESSLIST_ID,
+    l.ENGINE_LOCK_ID,
+    h.EVENT_ID
+"""
+
+LOCKING_STATEMENT = re.compile(
+    r"\bfor\s+(?:update|share)\b|\block\s+in\s+share\s+mode\b"
+    r"|^\s*(?:update|delete|insert|replace)\b",
+    re.IGNORECASE,
+)
+
+# これより前の文は今のトランザクションのロックを持っていない
+TRANSACTION_BOUNDARY = re.compile(
+    r"^\s*(?:begin|start\s+transaction|commit|rollback)\b", re.IGNORECASE
+)
+
+
+@dataclass
+class HistoryStatement:
+    event_id: int
+    sql: str
+    # events_transactions_current で待たせているトランザクションの中の文と確認できたか
+    in_transaction: bool = None
+
+
+@dataclass
+class LockWait:
+    waiting_session: int
+    blocking_session: int
+    schema: str
+    table: str
+    index: str
+    mode: str
+    lock_data: str
+    index_columns: list
+    wait_started: object
+    wait_seconds: float
+    waiting_sql: str
+    history: list = field(default_factory=list)
+
+    @property
+    def blocking_statement(self):
+        return attribute(self)
+
+
+def mentions(sql, name):
+    return re.search(rf"(?<![\w$]){re.escape(name)}(?![\w$])", sql, re.IGNORECASE)
+
+
+def score(statement, wait):
+    """
+    statement が wait で待たせているロックを取った文らしいほど大きい値を返す
+    """
+    points = 8 if statement.in_transaction else 0
+    if mentions(statement.sql, wait.table):
+        points += 4
+        if any(mentions(statement.sql, column) for column in wait.index_columns):
+            points += 2
+    if LOCKING_STATEMENT.search(statement.sql):
+        points += 2
+    return points
+
+
+def attribute(wait):
+    """
+    待たせている側の履歴から、ロックを取った文として最もらしいものを返す (候補がなければ None)
+    """
+    history = sorted(wait.history, key=lambda statement: statement.event_id)
+    start = 0
+    for i, statement in enumerate(history):
+        if TRANSACTION_BOUNDARY.match(statement.sql):
+            start = i + 1
+
+    best, best_score = None, 0
+    for statement in history[start:]:
+        points = score(statement, wait)
+        if points > best_score:
+            best, best_score = statement, points
+    return best
+
+
+def capture_lock_waits(conn, schema=None):
+    with conn.cursor() as cur:
+        cur.execute(MYSQL_BLOCKER_QUERY, {"schema": schema})
+        rows = cur.fetchall()
+
+    waits = {}
+    for (
+        waiting,
+        blocking,
+        lock_schema,
+        table,
+        index,
+        mode,
+        lock_data,
+        columns,
+        wait_started,
+        wait_seconds,
+        waiting_sql,
+        event_id,
+        sql,
+        in_transaction,
+    ) in rows:
+        key = (waiting, blocking, lock_schema, table, index, mode, lock_data)
+        if key not in waits:
+            waits[key] = LockWait(
+                waiting_session=waiting,
+                blocking_session=blocking,
+                schema=lock_schema,
+                table=table,
+                index=index,
+                mode=mode,
+                lock_data=lock_data,
+                index_columns=columns.split(",") if columns else [],
+                wait_started=wait_started,
+                wait_seconds=float(wait_seconds) if wait_seconds is not None else 0.0,
+                waiting_sql=waiting_sql,
+            )
+        if event_id is not None and sql is not None:
+            waits[key].history.append(
+                HistoryStatement(
+                    event_id,
+                    sql,
+                    bool(in_transaction) if in_transaction is not None else None,
+                )
+            )
+    return list(waits.values())
+
+
+class BlockerAttribution:
+    """
+    スナップショットを重ねて、待たせている文の形 (フィンガープリント) ごとに待たされた時間を集計する
+
+    同じ待ち (待っているセッションと待ち始めた時刻が同じもの) は最後に見た待ち時間だけを数える
+    """
+
+    def __init__(self):
+        self.waits = {}
+
+    def add(self, waits):
+        for wait in waits:
+            key = (wait.waiting_session, wait.wait_started, wait.blocking_session)
+            previous = self.waits.get(key)
+            if previous is None or wait.wait_seconds >= previous.wait_seconds:
+                self.waits[key] = wait
+
+    def capture(self, conn, schema=None):
+        waits = capture_lock_waits(conn, schema=schema)
+        self.add(waits)
+        return waits
+
+    def report(self):
+        """
+        待たされた時間の合計が大きい順に並べる
+        """
+        totals = {}
+        for wait in self.waits.values():
+            statement = wait.blocking_statement
+            key = fingerprint(statement.sql) if statement is not None else None
+            total = totals.setdefault(
+                key,
+                {
+                    "statement": key,
+                    "waits": 0,
+                    "blocked_seconds": 0.0,
+                    "max_wait_seconds": 0.0,
+                    "locks": set(),
+                },
+            )
+            total["waits"] += 1
+            total["blocked_seconds"] += wait.wait_seconds
+            total["max_wait_seconds"] = max(
+                total["max_wait_seconds"], wait.wait_seconds
+            )
+            total["locks"].add(f"{wait.table}.{wait.index} {wait.mode}")
+        return sorted(
+            ({**total, "locks": sorted(total["locks"])} for total in totals.values()),
+            key=lambda total: -total["blocked_seconds"],
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--schema")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--interval", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    conn = connect_mysql(root=True)
+    conn.autocommit = True
+    attribution = BlockerAttribution()
+    try:
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            attribution.capture(conn, schema=args.schema)
+            time.sleep(args.interval)
+    finally:
+        conn.close()
+
+    rows = [
+        {
+            **total,
+            "statement": total["statement"] or "(unknown)",
+            "locks": ", ".join(total["locks"]),
+        }
+        for total in attribution.report()
+    ]
+    print(tabulate(rows, headers="keys", tablefmt="psql", floatfmt=".3f"))
+
+
+if __name__ == "__main__":
+    main()
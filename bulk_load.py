@@ -0,0 +1,261 @@
+"""
+ロックの挙動を大きなテーブルで確かめるため、生成した行を一括でロードする
+
+    python bulk_load.py mysql t1 --rows 10000000
+    python bulk_load.py postgresql lock_sample --rows 100000000 --chunk-rows 5000000
+
+- 行は行番号から決まるジェネレーターで作り、Python のメモリにまとめて載せない
+- MySQL は名前付きパイプ経由で LOAD DATA LOCAL INFILE に流す (サーバーの local_infile が必要)
+- PostgreSQL は psycopg の copy() で COPY FROM STDIN に流す
+- 主キー以外のインデックス (PostgreSQL は主キーも) はロードが終わってから作る
+- chunk_rows 行ごとに commit し、1 つのトランザクションが大きくなりすぎないようにする
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+
+from mysql import connector
+
+from util import connect_postgresql, init_mysql_session, mysql_connect_params
+
+DEFAULT_CHUNK_ROWS = 1_000_000
+
+
+@dataclass
+class BulkTable:
+    name: str
+    # (列名, MySQL の型, PostgreSQL の型) のリスト。先頭の列を主キーにする
+    columns: list
+    # 行番号 (0 始まり) -> 行のタプル
+    row: object
+    # インデックス名 -> 列名のリスト (ロードが終わってから作る)
+    indexes: dict = field(default_factory=dict)
+
+    @property
+    def column_names(self):
+        return [name for name, _, _ in self.columns]
+
+    def create_sql(self, dialect):
+        if dialect == "mysql":
+            columns = [f"`{name}` {mysql_type}" for name, mysql_type, _ in self.columns]
+            columns.append(f"PRIMARY KEY (`{self.columns[0][0]}`)")
+            return (
+                f"CREATE TABLE `{self.name}` ({', '.join(columns)}) "
+                "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+            )
+        columns = [
+            f"{name} {postgresql_type}" for name, _, postgresql_type in self.columns
+        ]
+        return f"create table {self.name} ({', '.join(columns)})"
+
+    def index_sql(self, dialect):
+        if dialect == "mysql":
+            if not self.indexes:
+                return []
+            # まとめて 1 回の ALTER TABLE にし、テーブルの走査を 1 回で済ませる
+            return [
+                f"ALTER TABLE `{self.name}` "
+                + ", ".join(
+                    f"ADD INDEX `{index}` ({', '.join(f'`{c}`' for c in columns)})"
+                    for index, columns in self.indexes.items()
+                )
+            ]
+        return [f"alter table {self.name} add primary key ({self.columns[0][0]})"] + [
+            f"create index {index} on {self.name} ({', '.join(columns)})"
+            for index, columns in self.indexes.items()
+        ]
+
+
+def scatter(i, modulus):
+    # 行番号を散らして、インデックスの値が挿入順に並ばないようにする
+    return i * 2654435761 % 4294967296 % modulus
+
+
+def t1_row(i):
+    val = format(scatter(i, 4294967296), "x")
+    return (i + 1, val, len(val))
+
+
+def lock_sample_row(i):
+    return (i + 1, scatter(i, 1000))
+
+
+# lock_scenarios の T1_SETUP / LOCK_SAMPLE_SETUP と同じ定義のテーブル
+TABLES = {
+    table.name: table
+    for table in [
+        BulkTable(
+            name="t1",
+            columns=[
+                ("num", "int NOT NULL", "integer not null"),
+                ("val", "varchar(32) NOT NULL", "varchar(32) not null"),
+                ("val_length", "int unsigned NOT NULL", "integer not null"),
+            ],
+            row=t1_row,
+            indexes={"idx_vallength": ["val_length"]},
+        ),
+        BulkTable(
+            name="lock_sample",
+            columns=[
+                ("id", "bigint NOT NULL", "bigint not null"),
+                ("val1", "int NOT NULL", "integer not null"),
+            ],
+            row=lock_sample_row,
+        ),
+    ]
+}
+
+
+def generate_rows(table, count, start=0):
+    return (table.row(i) for i in range(start, start + count))
+
+
+def chunks(count, chunk_rows):
+    for start in range(0, count, chunk_rows):
+        yield start, min(chunk_rows, count - start)
+
+
+def mysql_escape(value):
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def mysql_lines(rows):
+    """
+    LOAD DATA の既定の形式 (タブ区切り、\\ でエスケープ、NULL は \\N) の行に変換する
+    """
+    for row in rows:
+        yield "\t".join(map(mysql_escape, row)) + "\n"
+
+
+def write_fifo(path, lines, errors):
+    try:
+        # 読み手 (LOAD DATA) が開くまでブロックする
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.writelines(lines)
+    except BrokenPipeError:
+        pass
+    except Exception as e:
+        errors.append(e)
+
+
+def load_mysql(table, count, chunk_rows=DEFAULT_CHUNK_ROWS):
+    directory = tempfile.mkdtemp(prefix="bulk_load_")
+    fifo = os.path.join(directory, f"{table.name}.tsv")
+    os.mkfifo(fifo)
+    conn = connector.connect(
+        **mysql_connect_params(), allow_local_infile_in_path=directory
+    )
+    init_mysql_session(conn)
+    timings = {}
+    try:
+        cur = conn.cursor()
+        cur.execute("SET unique_checks = 0")
+        cur.execute("SET foreign_key_checks = 0")
+        cur.execute(f"DROP TABLE IF EXISTS `{table.name}`")
+        cur.execute(table.create_sql("mysql"))
+
+        started = time.monotonic()
+        columns = ", ".join(f"`{name}`" for name in table.column_names)
+        for start, rows in chunks(count, chunk_rows):
+            errors = []
+            writer = threading.Thread(
+                target=write_fifo,
+                args=(fifo, mysql_lines(generate_rows(table, rows, start)), errors),
+                daemon=True,
+            )
+            writer.start()
+            try:
+                cur.execute(
+                    f"LOAD DATA LOCAL INFILE '{fifo}' INTO TABLE `{table.name}` "
+                    f"CHARACTER SET utf8mb4 ({columns})"
+                )
+                conn.commit()
+            except Exception:
+                # 書き手が open でブロックしたままにならないよう、読み手として開いて閉じる
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                raise
+            finally:
+                writer.join()
+            if errors:
+                raise errors[0]
+        timings["load"] = time.monotonic() - started
+
+        started = time.monotonic()
+        for sql in table.index_sql("mysql"):
+            cur.execute(sql)
+        timings["index"] = time.monotonic() - started
+        return timings
+    finally:
+        conn.close()
+        os.unlink(fifo)
+        os.rmdir(directory)
+
+
+def load_postgresql(table, count, chunk_rows=DEFAULT_CHUNK_ROWS):
+    conn = connect_postgresql()
+    timings = {}
+    try:
+        conn.execute(f"drop table if exists {table.name}")
+        conn.execute(table.create_sql("postgresql"))
+        conn.commit()
+
+        started = time.monotonic()
+        columns = ", ".join(table.column_names)
+        with conn.cursor() as cur:
+            for start, rows in chunks(count, chunk_rows):
+                with cur.copy(f"copy {table.name} ({columns}) from stdin") as copy:
+                    for row in generate_rows(table, rows, start):
+                        copy.write_row(row)
+                conn.commit()
+        timings["load"] = time.monotonic() - started
+
+        started = time.monotonic()
+        conn.execute("set maintenance_work_mem = '256MB'")
+        for sql in table.index_sql("postgresql"):
+            conn.execute(sql)
+        conn.execute(f"analyze {table.name}")
+        conn.commit()
+        timings["index"] = time.monotonic() - started
+        return timings
+    finally:
+        conn.close()
+
+
+def bulk_load(engine, table, count, chunk_rows=DEFAULT_CHUNK_ROWS):
+    if isinstance(table, str):
+        table = TABLES[table]
+    if engine == "mysql":
+        return load_mysql(table, count, chunk_rows)
+    return load_postgresql(table, count, chunk_rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", choices=("mysql", "postgresql"))
+    parser.add_argument("table", choices=TABLES)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    timings = bulk_load(args.engine, args.table, args.rows, args.chunk_rows)
+    print(
+        f"{args.engine} {args.table}: {args.rows} rows, "
+        f"load {timings['load']:.1f}s ({args.rows / max(timings['load'], 1e-9):.0f} rows/s), "
+        f"index {timings['index']:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+デッドロックが起きやすい文の並びを N 並列で流し、クライアントの再試行の方針ごとに有効なスループットを測る
+
+    python deadlock_harness.py -w 8 -d 10
+    python deadlock_harness.py -e mysql -p gap_insert -r immediate -r ordered
+
+パターン (どちらも lock_scenarios の T1_SETUP の t1 を使う)
+- cross_update: 2 行をランダムな順に UPDATE する (ロックを取る順序が逆になると ABBA のデッドロック)
+- gap_insert: 同じギャップを FOR UPDATE でロックしてから INSERT する (MySQL のみ)
+  ギャップロック同士は競合しないが、挿入意図ロックは相手のギャップロックを待つので、両方が INSERT すると
+  デッドロックになる (test_innodb_layer_lock のギャップロックと挿入意図ロックの組み合わせ)
+
+再試行の方針
+- immediate: デッドロック / ロック待ちタイムアウトになったらすぐにやり直す
+- backoff: 指数的に伸ばした上限までの一様乱数だけ待ってからやり直す (full jitter)
+- ordered: ロックを取る文をキーの順に並べ替えてから実行し (ロック順序の書き換え)、失敗したらすぐにやり直す
+  同じギャップに対する gap_insert は順序を揃えても防げない
+
+コミットできたトランザクションの数を有効なスループットとし、やり直しの回数、あきらめた数、
+やり直しを含めたレイテンシを集計する。実行後に MySQL は SHOW ENGINE INNODB STATUS の
+LATEST DETECTED DEADLOCK を、PostgreSQL はログの deadlock detected を構造化して結果に含める
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from os import environ
+
+import psycopg
+from mysql import connector
+from tabulate import tabulate
+
+from bench_lock_contention import RESULTS_DIR, connect, setup
+from innodb_status import parse_innodb_status
+from lock_scenarios import T1_SETUP
+from pg_log import POSTGRESQL_LOG_PATH, PostgresqlLogTailer
+from statement_stats import Histogram
+from util import classify_error, connect_mysql
+
+ENGINES = ("mysql", "postgresql")
+
+# cross_update で取り合う行 / gap_insert で取り合うギャップ (3 と 5 の間、5 より後ろ)
+HOT_KEYS = (1, 2, 3, 5)
+GAP_KEYS = (4, 6)
+
+
+@dataclass
+class LockStep:
+    # ロックを取る順序を揃えるときのキー
+    key: int
+    sql: str
+
+
+@dataclass
+class DeadlockPattern:
+    name: str
+    description: str
+    setup: dict
+    engines: tuple
+    # steps(rng, worker) は 1 トランザクション分の LockStep のリスト
+    steps: object
+
+
+def cross_update_steps(rng, worker):
+    return [
+        LockStep(key, f"UPDATE t1 SET val = 'w{worker}' WHERE num = {key}")
+        for key in rng.sample(HOT_KEYS, 2)
+    ]
+
+
+def gap_insert_steps(rng, worker):
+    key = rng.choice(GAP_KEYS)
+    return [
+        LockStep(key, f"SELECT * FROM t1 WHERE num = {key} FOR UPDATE"),
+        LockStep(
+            key,
+            f"INSERT INTO t1 (num, val, val_length) VALUES ({key}, 'w{worker}', 2)",
+        ),
+        LockStep(key, f"DELETE FROM t1 WHERE num = {key}"),
+    ]
+
+
+PATTERNS = {
+    pattern.name: pattern
+    for pattern in [
+        DeadlockPattern(
+            name="cross_update",
+            description="2 行をランダムな順に UPDATE する",
+            setup=T1_SETUP,
+            engines=ENGINES,
+            steps=cross_update_steps,
+        ),
+        DeadlockPattern(
+            name="gap_insert",
+            description="同じギャップの FOR UPDATE と INSERT",
+            setup=T1_SETUP,
+            engines=("mysql",),
+            steps=gap_insert_steps,
+        ),
+    ]
+}
+
+
+@dataclass
+class RetryPolicy:
+    name: str
+    reorder: bool = False
+    backoff: bool = False
+    base_delay: float = 0.001
+    max_delay: float = 0.1
+
+    def prepare(self, steps):
+        # sorted は安定なので、同じキーの文 (ロックしてから INSERT など) の順序は変わらない
+        return sorted(steps, key=lambda step: step.key) if self.reorder else steps
+
+    def delay(self, attempt, rng):
+        if not self.backoff:
+            return 0.0
+        return rng.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in [
+        RetryPolicy("immediate"),
+        RetryPolicy("backoff", backoff=True),
+        RetryPolicy("ordered", reorder=True),
+    ]
+}
+
+
+class Worker(threading.Thread):
+    def __init__(self, engine, conn, pattern, policy, index, deadline, max_attempts):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.conn = conn
+        self.pattern = pattern
+        self.policy = policy
+        self.index = index
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.rng = random.Random(index)
+        self.latency = Histogram()
+        self.outcomes = Counter()
+        self.error = None
+
+    def run(self):
+        try:
+            self.loop()
+        except Exception as e:
+            self.error = e
+
+    def attempt(self, cur, steps):
+        try:
+            for step in steps:
+                cur.execute(step.sql)
+            self.conn.commit()
+            return "committed"
+        except (connector.Error, psycopg.Error) as e:
+            outcome = classify_error(e)
+            if outcome is None:
+                raise
+            self.conn.rollback()
+            return outcome
+
+    def loop(self):
+        cur = (
+            self.conn.cursor(buffered=True)
+            if self.engine == "mysql"
+            else self.conn.cursor()
+        )
+        while time.monotonic() < self.deadline:
+            steps = self.policy.prepare(self.pattern.steps(self.rng, self.index))
+            started = time.perf_counter()
+            for attempt in range(self.max_attempts):
+                outcome = self.attempt(cur, steps)
+                self.outcomes[outcome] += 1
+                if outcome == "committed":
+                    self.latency.record(time.perf_counter() - started)
+                    break
+                if time.monotonic() >= self.deadline:
+                    self.outcomes["unfinished"] += 1
+                    break
+                time.sleep(self.policy.delay(attempt, self.rng))
+            else:
+                self.outcomes["gave_up"] += 1
+
+
+def describe_innodb_deadlock(deadlock):
+    def describe_lock(lock):
+        return f"{lock.table}.{lock.index} {lock.mode} {lock.lock_type}"
+
+    return {
+        "detected_at": deadlock.detected_at,
+        "rolled_back": deadlock.victim.trx_id if deadlock.victim else None,
+        "transactions": [
+            {
+                "trx_id": trx.trx_id,
+                "thread_id": trx.thread_id,
+                "query": trx.query,
+                "holds": [describe_lock(lock) for lock in trx.locks],
+                "waiting_for": (
+                    describe_lock(trx.waiting_for) if trx.waiting_for else None
+                ),
+            }
+            for trx in deadlock.transactions
+        ],
+    }
+
+
+def describe_pg_deadlock(event):
+    deadlock = event.deadlock
+    return {
+        "detected_at": event.logged_at,
+        "rolled_back": deadlock.victim,
+        "waits": [
+            f"{wait.pid} waits for {wait.mode} on {wait.target} "
+            f"(blocked by {wait.blocked_by})"
+            for wait in deadlock.waits
+        ],
+        "queries": deadlock.queries,
+    }
+
+
+class DeadlockRecorder:
+    """
+    実行中に起きたデッドロックをサーバー側の記録から読む
+
+    MySQL は最後に検出した 1 件だけが残るので、実行後の SHOW ENGINE INNODB STATUS を読む
+    (実行前から残っていたものと同じなら、実行中には起きていないので含めない)
+    PostgreSQL は実行中に書かれたログの deadlock detected をすべて読む (ログが読めない環境では空)
+    """
+
+    def __init__(self, engine, log_path=POSTGRESQL_LOG_PATH):
+        self.engine = engine
+        self.tailer = None
+        self.previous = None
+        if engine == "mysql":
+            self.previous = self.latest_innodb_deadlock()
+        elif os.path.exists(log_path):
+            self.tailer = PostgresqlLogTailer(log_path)
+
+    @staticmethod
+    def latest_innodb_deadlock():
+        conn = connect_mysql(root=True)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SHOW ENGINE INNODB STATUS")
+                _, _, text = cur.fetchall()[0]
+        finally:
+            conn.close()
+        return parse_innodb_status(text).deadlock
+
+    def collect(self, limit=5):
+        if self.engine == "mysql":
+            deadlock = self.latest_innodb_deadlock()
+            if deadlock is None or deadlock == self.previous:
+                return []
+            return [describe_innodb_deadlock(deadlock)]
+
+        if self.tailer is None:
+            return []
+        self.tailer.read()
+        events = self.tailer.find(kind="deadlock")
+        return [describe_pg_deadlock(event) for event in events[-limit:]]
+
+
+def prepare_connection(engine, conn, deadlock_timeout_ms):
+    if engine == "postgresql":
+        # 既定の 1s ではデッドロックの検出を待つ時間がスループットの大半を占めるので短くする
+        # (スーパーユーザーでのみ変更できる)
+        conn.execute(f"SET deadlock_timeout = '{int(deadlock_timeout_ms)}ms'")
+        conn.commit()
+
+
+def run_harness(
+    engine,
+    pattern,
+    policy,
+    workers,
+    duration,
+    max_attempts=20,
+    deadlock_timeout_ms=100,
+):
+    """
+    pattern を policy で workers 並列に duration 秒流して結果を dict で返す
+    """
+    setup(engine, pattern)
+    recorder = DeadlockRecorder(engine)
+    connections = [connect(engine) for _ in range(workers)]
+    try:
+        for conn in connections:
+            prepare_connection(engine, conn, deadlock_timeout_ms)
+
+        started = time.monotonic()
+        deadline = started + duration
+        threads = [
+            Worker(engine, conn, pattern, policy, index, deadline, max_attempts)
+            for index, conn in enumerate(connections)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+    finally:
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+    latency = Histogram()
+    outcomes = Counter()
+    for thread in threads:
+        latency.merge(thread.latency)
+        outcomes.update(thread.outcomes)
+    attempts = sum(outcomes[key] for key in ("committed", "deadlock", "timeout"))
+    return {
+        "engine": engine,
+        "pattern": pattern.name,
+        "policy": policy.name,
+        "workers": workers,
+        "elapsed": elapsed,
+        "committed": outcomes["committed"],
+        "throughput": outcomes["committed"] / elapsed,
+        "attempts": attempts,
+        "retries": attempts - outcomes["committed"],
+        "outcomes": dict(outcomes),
+        "deadlock_rate": outcomes["deadlock"] / attempts if attempts else 0.0,
+        "latency": latency.summary(),
+        "deadlocks": recorder.collect(),
+    }
+
+
+def summarize(results):
+    rows = [
+        {
+            "engine": result["engine"],
+            "pattern": result["pattern"],
+            "policy": result["policy"],
+            "tps": round(result["throughput"], 1),
+            "retries": result["retries"],
+            "deadlock": f"{result['deadlock_rate']:.2%}",
+            "gave_up": result["outcomes"].get("gave_up", 0),
+            "p50_ms": result["latency"].get("p50_ms"),
+            "p99_ms": result["latency"].get("p99_ms"),
+        }
+        for result in results
+    ]
+    return tabulate(rows, headers="keys", tablefmt="psql", floatfmt=".2f")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-e", "--engine", choices=ENGINES, action="append")
+    parser.add_argument("-p", "--pattern", choices=PATTERNS, action="append")
+    parser.add_argument("-r", "--policy", choices=POLICIES, action="append")
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("--max-attempts", type=int, default=20)
+    parser.add_argument("--deadlock-timeout-ms", type=int, default=100)
+    parser.add_argument("-o", "--out")
+    args = parser.parse_args(argv)
+
+    results = [
+        run_harness(
+            engine,
+            PATTERNS[name],
+            POLICIES[policy],
+            args.workers,
+            args.duration,
+            max_attempts=args.max_attempts,
+            deadlock_timeout_ms=args.deadlock_timeout_ms,
+        )
+        for engine in args.engine or ENGINES
+        for name in args.pattern or PATTERNS
+        if engine in PATTERNS[name].engines
+        for policy in args.policy or POLICIES
+    ]
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"deadlock-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(
+            {
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "mysql_database": environ["MYSQL_DATABASE"],
+                "postgres_db": environ["POSTGRES_DB"],
+                "results": results,
+            },
+            f,
+            indent=2,
+            default=str,
+        )
+    print(summarize(results))
+    print(f"saved to {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+data_locks のスナップショットを (テーブル, インデックス) ごとのキーの順に並べ、
+「このキーへの INSERT は待たされるか」「この範囲をロックする読み込みはどのロックとぶつかるか」に
+サーバーへ問い合わせずに O(log n) で答える (MySQL / InnoDB)
+
+InnoDB のレコードロックは LOCK_DATA のレコードに付き、種類によって守る範囲が違う
+- REC_NOT_GAP: そのレコードだけ
+- GAP: 直前のレコードとの間 (レコードは含まない)
+- ネクストキー (X / S): 直前のレコードとの間とそのレコード
+INSERT はキーの直後のレコードの手前のギャップに挿入意図ロックを取るので、
+直後のレコード (なければ supremum) に他のトランザクションの GAP / ネクストキーロックがあると待たされる
+
+「直後のレコード」はインデックスに実際にあるレコードで決まるので、read_index_keys で読んだキーを
+records に渡すと正確になる。渡さない場合はロックの付いたキーだけで判断するので、
+実際には間にロックのないレコードがあって待たされない INSERT も待たされると答える (安全側に倒れる)
+
+キーは LOCK_DATA の値のタプル (セカンダリインデックスでは末尾に主キーの値が付く) で、
+NULL < 数値 < 文字列 の順に比べる。文字列は照合順序を考慮せずに Python の順で比べるので、
+大文字 / 小文字やアクセントを区別しない照合順序の列では順序がずれることがある
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+
+from lock_footprint import read_indexes
+from util import lock_kind
+
+SUPREMUM = "supremum pseudo-record"
+
+LOCK_DATA_VALUE = re.compile(r"\s*('(?:[^'\\]|\\.|'')*'|[^,]+)\s*(?:,|$)")
+
+
+@dataclass(frozen=True)
+class HeldLock:
+    session: int
+    trx: str
+    # X / S
+    mode: str
+    # record / gap / next-key
+    kind: str
+    # LOCK_DATA の値のタプル (supremum の場合は None)
+    key: tuple
+
+    @property
+    def locks_record(self):
+        return self.kind in ("record", "next-key") and self.key is not None
+
+    @property
+    def locks_gap(self):
+        return self.kind in ("gap", "next-key")
+
+
+def parse_value(text):
+    if text == "NULL":
+        return None
+    if text.startswith("'"):
+        return text[1:-1].replace("''", "'").replace("\\'", "'")
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_lock_data(data):
+    """
+    LOCK_DATA ("3, 1" や "'one', 1" など) をキーのタプルにする。supremum は None
+    """
+    if data is None or data == SUPREMUM:
+        return None
+    return tuple(
+        parse_value(m.group(1).strip()) for m in LOCK_DATA_VALUE.finditer(data)
+    )
+
+
+def value_order(value):
+    if value is None:
+        return (0, 0)
+    if isinstance(value, str):
+        return (2, value)
+    return (1, value)
+
+
+def sort_key(key):
+    return tuple(value_order(value) for value in key)
+
+
+# 前方一致で範囲の上端を比べるとき、同じ接頭辞を持つどのキーよりも大きくするための要素
+AFTER_PREFIX = ((3,),)
+
+
+def conflicts(requested, held):
+    """
+    X は何とでも、S は X とだけぶつかる
+    """
+    return requested == "X" or held == "X"
+
+
+class IndexLocks:
+    """
+    1 つのインデックスのロックをキーの順に並べたもの
+
+    slots[i] は keys[i] のレコードに付いたロックのリストで、最後の slot は supremum
+    """
+
+    def __init__(self, keys, slots):
+        self.keys = keys
+        self.slots = slots
+
+    @classmethod
+    def build(cls, locks, records=()):
+        by_key = {}
+        supremum = []
+        for lock in locks:
+            if lock.key is None:
+                supremum.append(lock)
+            else:
+                by_key.setdefault(sort_key(lock.key), []).append(lock)
+        for record in records:
+            by_key.setdefault(sort_key(record), [])
+        keys = sorted(by_key)
+        return cls(keys, [by_key[key] for key in keys] + [supremum])
+
+    def successor(self, key):
+        """
+        key より大きい最初のレコードの slot の位置 (なければ supremum の位置)
+        """
+        return bisect_right(self.keys, sort_key(key))
+
+    def insert_blockers(self, key, trx=None):
+        """
+        key を INSERT したときに待たされる原因のロック (trx 自身のロックは除く)
+        """
+        position = self.successor(key)
+        blockers = [
+            lock for lock in self.slots[position] if lock.locks_gap and lock.trx != trx
+        ]
+        # 同じキーのレコードがロックされていれば、重複チェックの S ロックで待たされる
+        if position > 0 and self.keys[position - 1] == sort_key(key):
+            blockers += [
+                lock
+                for lock in self.slots[position - 1]
+                if lock.locks_record and lock.trx != trx and conflicts("S", lock.mode)
+            ]
+        return blockers
+
+    def range_blockers(self, low, high, mode="X", trx=None):
+        """
+        low <= キー <= high のレコードを mode でロックする読み込みを待たせるロック
+        low / high はキーの先頭の列だけでもよい (セカンダリインデックスの値だけなど)
+
+        ギャップロック同士はぶつからないので、レコードを含むロック (REC_NOT_GAP / ネクストキー) だけを見る
+        """
+        start = bisect_left(self.keys, sort_key(low))
+        end = bisect_right(self.keys, sort_key(high) + AFTER_PREFIX)
+        return [
+            lock
+            for slot in self.slots[start:end]
+            for lock in slot
+            if lock.locks_record and lock.trx != trx and conflicts(mode, lock.mode)
+        ]
+
+
+class GapLockIndex:
+    """
+    LockSnapshot (MySQL) の許可済みのレコードロックを (テーブル, インデックス) ごとの IndexLocks に分ける
+
+    records には (テーブル, インデックス) -> インデックスのキーのリスト を渡す (read_index_keys)
+    """
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    @classmethod
+    def from_snapshot(cls, snapshot, records=None):
+        records = records or {}
+        locks = {}
+        for row in snapshot.filter(lock_type="RECORD", granted=True).rows():
+            locks.setdefault((row["table"], row["index"]), []).append(
+                HeldLock(
+                    session=row["session"],
+                    trx=row["trx"],
+                    mode=row["mode"].split(",")[0],
+                    kind=lock_kind(row["mode"]),
+                    key=parse_lock_data(row["data"]),
+                )
+            )
+        return cls(
+            {
+                name: IndexLocks.build(
+                    [lock for lock in index_locks if lock.kind != "insert-intention"],
+                    records.get(name, ()),
+                )
+                for name, index_locks in locks.items()
+            }
+        )
+
+    def insert_blockers(self, table, index, key, trx=None):
+        index_locks = self.indexes.get((table, index))
+        return index_locks.insert_blockers(key, trx) if index_locks else []
+
+    def would_block_insert(self, table, keys, trx=None):
+        """
+        keys はインデックス名 -> その行のキー (セカンダリインデックスは主キーの値まで含める)
+        """
+        return [
+            lock
+            for index, key in keys.items()
+            for lock in self.insert_blockers(table, index, key, trx)
+        ]
+
+    def range_blockers(self, table, index, low, high=None, mode="X", trx=None):
+        index_locks = self.indexes.get((table, index))
+        if not index_locks:
+            return []
+        return index_locks.range_blockers(low, low if high is None else high, mode, trx)
+
+
+def read_index_keys(conn, table, index):
+    """
+    インデックスのキー (LOCK_DATA と同じ並び: インデックスの列、主キーの列) を読む
+    """
+    indexes = read_indexes(conn, [table])[table]
+    columns = list(indexes[index].columns)
+    columns += [c for c in indexes["PRIMARY"].columns if c not in columns]
+    names = ", ".join(f"`{column}`" for column in columns)
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {names} FROM `{table}` ORDER BY {names}")
+        return [tuple(row) for row in cur.fetchall()]
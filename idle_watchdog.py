@@ -0,0 +1,281 @@
+"""
+トランザクションの途中で止まったまま (idle in transaction) 他のセッションを待たせているセッションを見つけ、
+ポリシーに従ってログに出す / 文をキャンセルする / セッションを終了させる
+
+    python idle_watchdog.py mysql --policy 10:log,30:cancel,60:terminate --dry-run
+    python idle_watchdog.py postgresql --policy 5:log,20:terminate --interval 1
+
+1 回の確認は「idle in transaction のセッション」と「ロック待ちの関係 (WaitForGraph)」の 2 クエリで、
+idle のままポリシーの最初の秒数以上経ち、誰かを (直接) 待たせているセッションだけを対象にする
+
+ポリシーは 秒数:アクション をカンマでつないだもので、idle の時間が超えたうちで最も長い秒数のアクションを取る
+- log: 何もせずに記録だけする
+- cancel: 実行中の文を止める (MySQL は KILL QUERY、PostgreSQL は pg_cancel_backend)
+  idle のセッションには実行中の文がないので効かないことが多く、次の段階へ進むための猶予として使う
+- terminate: セッションを終了させてトランザクションをロールバックさせる (MySQL は KILL、PostgreSQL は pg_terminate_backend)
+--dry-run の場合は取るはずだったアクションを記録するだけで実行しない
+"""
+
+import argparse
+import time
+from dataclasses import dataclass
+
+from statement_stats import fingerprint
+from util import connect_mysql, connect_postgresql
+from wait_for_graph import WaitForGraph
+
+MYSQL_IDLE_QUERY = """
+select
+    t.PROCESSLIST_ID,
+    t.PROCESSLIST_USER,
+    t.PROCESSLIST_TIME,
+    trx.trx_started,
+    trx.trx_lock_structs,
+    s.SQL_TEXT
+from
+    information_schema.INNODB_TRX trx
+    join performance_schema.threads t on (t.PROCESSLIST_ID = trx.trx_mysql_thread_id)
+    left join performance_schema.events_statements_current s on (
+        s.THREAD_ID = t.THREAD_ID
+        and s.NESTING_EVENT_LEVEL = 0
+    )
+where
+    t.PROCESSLIST_COMMAND = 'Sleep'
+    and trx.trx_query is null
+    and (%(schema)s is null or t.PROCESSLIST_DB = %(schema)s)
+"""
+
+POSTGRESQL_IDLE_QUERY = """
+select
+    a.pid,
+    a.usename,
+    extract(epoch from clock_timestamp() - a.state_change),
+    a.xact_start,
+    (select count(*) from pg_locks l where l.pid = a.pid and l.granted),
+    a.query
+from
+    pg_stat_activity a
+where
+    a.state in ('idle in transaction', 'idle in transaction (aborted)')
+    and a.pid <> pg_backend_pid()
+    and (%(database)s::text is null or a.datname = %(database)s)
+"""
+
+ACTIONS = ("log", "cancel", "terminate")
+
+MYSQL_ACTIONS = {"cancel": "KILL QUERY %s", "terminate": "KILL %s"}
+
+POSTGRESQL_ACTIONS = {
+    "cancel": "select pg_cancel_backend(%s)",
+    "terminate": "select pg_terminate_backend(%s)",
+}
+
+
+@dataclass
+class IdleSession:
+    session: int
+    user: str
+    idle_seconds: float
+    trx_started: object
+    # MySQL はロック構造体の数、PostgreSQL は許可済みのロックの数
+    locks: int
+    last_statement: str
+
+
+@dataclass
+class Intervention:
+    session: int
+    action: str
+    idle_seconds: float
+    # 直接待たせているセッション / 直接・間接に待たされているセッションの数
+    waiters: list
+    stalled: int
+    last_statement: str
+    dry_run: bool
+    taken_at: float
+    error: str = None
+
+
+def parse_policy(text):
+    """
+    "10:log,30:cancel,60:terminate" を [(10.0, "log"), ...] (秒数の昇順) にする
+    """
+    rules = []
+    for rule in text.split(","):
+        after, _, action = rule.strip().partition(":")
+        if action not in ACTIONS:
+            raise ValueError(f"unknown action {action!r} in policy {text!r}")
+        rules.append((float(after), action))
+    return sorted(rules)
+
+
+def choose_action(policy, idle_seconds):
+    """
+    idle_seconds が超えたうちで最も長い秒数のアクション (どれも超えていなければ None)
+    """
+    action = None
+    for after, rule_action in policy:
+        if idle_seconds >= after:
+            action = rule_action
+    return action
+
+
+def capture_idle_mysql(conn, schema=None):
+    with conn.cursor() as cur:
+        cur.execute(MYSQL_IDLE_QUERY, {"schema": schema})
+        return [
+            IdleSession(session, user, float(idle), started, int(locks), sql)
+            for session, user, idle, started, locks, sql in cur.fetchall()
+        ]
+
+
+def capture_idle_postgresql(conn, database=None):
+    with conn.cursor() as cur:
+        cur.execute(POSTGRESQL_IDLE_QUERY, {"database": database})
+        return [
+            IdleSession(pid, user, float(idle), started, int(locks), sql)
+            for pid, user, idle, started, locks, sql in cur.fetchall()
+        ]
+
+
+class IdleWatchdog:
+    """
+    capture_idle() は IdleSession のリスト、capture_graph() は WaitForGraph を返す
+    execute(action, session) は cancel / terminate を実行する
+    """
+
+    def __init__(self, capture_idle, capture_graph, execute, policy, dry_run=False):
+        self.capture_idle = capture_idle
+        self.capture_graph = capture_graph
+        self.execute = execute
+        self.policy = policy
+        self.dry_run = dry_run
+        self.interventions = []
+        # セッションごとに最後に取ったアクション (同じアクションを繰り返さない)
+        self._last_action = {}
+
+    def check(self):
+        idle = self.capture_idle()
+        if not idle:
+            self._last_action.clear()
+            return []
+        graph = self.capture_graph()
+
+        taken = []
+        for session in idle:
+            waiters = graph.waiters.get(session.session)
+            action = choose_action(self.policy, session.idle_seconds)
+            if not waiters or action is None:
+                continue
+            if self._last_action.get(session.session) == action:
+                continue
+            self._last_action[session.session] = action
+
+            intervention = Intervention(
+                session=session.session,
+                action=action,
+                idle_seconds=session.idle_seconds,
+                waiters=sorted(waiters),
+                stalled=len(graph.stalled_by(session.session)),
+                last_statement=(
+                    fingerprint(session.last_statement)
+                    if session.last_statement
+                    else None
+                ),
+                dry_run=self.dry_run,
+                taken_at=time.time(),
+            )
+            if action != "log" and not self.dry_run:
+                try:
+                    self.execute(action, session.session)
+                except Exception as e:
+                    intervention.error = str(e)
+            taken.append(intervention)
+
+        current = {session.session for session in idle}
+        for session in [s for s in self._last_action if s not in current]:
+            del self._last_action[session]
+        self.interventions.extend(taken)
+        return taken
+
+
+def mysql_watchdog(conn, policy, dry_run=False, schema=None):
+    """
+    conn は KILL できる権限のある autocommit のコネクション
+    """
+
+    def execute(action, session):
+        with conn.cursor() as cur:
+            cur.execute(MYSQL_ACTIONS[action] % int(session))
+
+    return IdleWatchdog(
+        lambda: capture_idle_mysql(conn, schema=schema),
+        lambda: WaitForGraph.capture_mysql(conn, schema=schema),
+        execute,
+        policy,
+        dry_run=dry_run,
+    )
+
+
+def postgresql_watchdog(conn, policy, dry_run=False, database=None):
+    """
+    conn は autocommit のコネクション (pg_stat_activity はトランザクション内でキャッシュされるため)
+    """
+
+    def execute(action, session):
+        with conn.cursor() as cur:
+            cur.execute(POSTGRESQL_ACTIONS[action], (session,))
+
+    return IdleWatchdog(
+        lambda: capture_idle_postgresql(conn, database=database),
+        lambda: WaitForGraph.capture_postgresql(conn, database=database),
+        execute,
+        policy,
+        dry_run=dry_run,
+    )
+
+
+def create_watchdog(engine, policy, dry_run=False, schema=None):
+    if engine == "mysql":
+        conn = connect_mysql(root=True)
+        conn.autocommit = True
+        return mysql_watchdog(conn, policy, dry_run=dry_run, schema=schema)
+
+    conn = connect_postgresql()
+    conn.autocommit = True
+    return postgresql_watchdog(conn, policy, dry_run=dry_run, database=schema)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", choices=("mysql", "postgresql"))
+    parser.add_argument("--policy", type=parse_policy, default="30:log")
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--duration", type=float, default=None)
+    parser.add_argument("--schema", help="MySQL のスキーマ / PostgreSQL のデータベース")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    watchdog = create_watchdog(
+        args.engine, args.policy, dry_run=args.dry_run, schema=args.schema
+    )
+    deadline = time.monotonic() + args.duration if args.duration is not None else None
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            for intervention in watchdog.check():
+                print(
+                    f"{'[dry-run] ' if intervention.dry_run else ''}"
+                    f"{intervention.action} session={intervention.session} "
+                    f"idle={intervention.idle_seconds:.1f}s "
+                    f"waiters={intervention.waiters} stalled={intervention.stalled} "
+                    f"last={intervention.last_statement!r}"
+                    + (f" error={intervention.error}" if intervention.error else ""),
+                    flush=True,
+                )
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+SHOW ENGINE INNODB STATUS の出力をトランザクション・ロック構造体のレコードに変換する
+
+innodb_status_output_locks=ON のときに TRANSACTIONS セクションへ出力される
+TABLE LOCK / RECORD LOCKS 行と、それに続くレコードのダンプを 1 回の走査で読み取る
+
+LATEST DETECTED DEADLOCK セクション (最後に検出したデッドロック) も同じ形式のトランザクションと
+ロック構造体 (HOLDS THE LOCK(S) / WAITING FOR THIS LOCK TO BE GRANTED) として読み取る
+"""
+
+import re
+from dataclasses import dataclass, field
+
+SECTION_RULE = re.compile(r"^-{3,}$")
+SECTION_TITLE = re.compile(r"^[A-Z][A-Z0-9 /'()-]+$")
+
+TRANSACTION = re.compile(
+    r"^(?:---)?TRANSACTION (?P<trx_id>\d+), (?:(?P<active>ACTIVE) (?:\(PREPARED\) )?"
+    r"(?P<seconds>\d+) sec(?: (?P<operation>.+))?|(?P<state>.+))$"
+)
+LOCK_COUNTS = re.compile(
+    r"^(?P<lock_wait>LOCK WAIT )?(?P<lock_structs>\d+) lock struct\(s\), "
+    r"heap size \d+, (?P<row_locks>\d+) row lock\(s\)"
+    r"(?:, undo log entries (?P<undo_entries>\d+))?"
+)
+THREAD = re.compile(
+    r"^MySQL thread id (?P<thread_id>\d+), OS thread handle \d+, "
+    r"query id (?P<query_id>\d+)(?: (?P<rest>.*))?$"
+)
+TABLE_LOCK = re.compile(
+    r"^TABLE LOCK table `(?P<schema>[^`]+)`\.`(?P<table>[^`]+)` "
+    r"trx id (?P<trx_id>\d+) lock mode (?P<mode>\S+)(?P<flags>.*)$"
+)
+RECORD_LOCK = re.compile(
+    r"^RECORD LOCKS space id (?P<space_id>\d+) page no (?P<page_no>\d+) "
+    r"n bits (?P<n_bits>\d+) index (?P<index>\S+) of table "
+    r"`(?P<schema>[^`]+)`\.`(?P<table>[^`]+)` "
+    r"trx id (?P<trx_id>\d+) lock[_ ]mode (?P<mode>\S+)(?P<flags>.*)$"
+)
+RECORD = re.compile(r"^Record lock, heap no (?P<heap_no>\d+)")
+RECORD_FIELD = re.compile(
+    r"^ *(?P<no>\d+): (?:len (?P<length>\d+); hex (?P<hex>[0-9a-f]*)|SQL NULL)"
+)
+WAITING_HEADER = re.compile(r"^------- TRX HAS BEEN WAITING (?P<seconds>\d+) SEC")
+
+DEADLOCK_SECTION = "LATEST DETECTED DEADLOCK"
+DEADLOCK_DETECTED_AT = re.compile(r"^(?P<detected_at>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)")
+DEADLOCK_PART = re.compile(
+    r"^\*\*\* \((?P<no>\d+)\) (?P<part>TRANSACTION|HOLDS THE LOCK\(S\)"
+    r"|WAITING FOR THIS LOCK TO BE GRANTED):$"
+)
+DEADLOCK_ROLLBACK = re.compile(r"^\*\*\* WE ROLL BACK TRANSACTION \((?P<no>\d+)\)")
+
+SUPREMUM_HEX = b"supremum".hex()
+
+
+@dataclass
+class RecordDump:
+    heap_no: int
+    # (フィールド番号, 長さ, 16 進ダンプ) 。SQL NULL の場合は長さ・ダンプとも None
+    fields: list = field(default_factory=list)
+
+    @property
+    def supremum(self):
+        return len(self.fields) == 1 and self.fields[0][2] == SUPREMUM_HEX
+
+
+@dataclass
+class LockStruct:
+    kind: str
+    schema: str
+    table: str
+    trx_id: int
+    mode: str
+    index: str = None
+    space_id: int = None
+    page_no: int = None
+    gap: bool = False
+    rec_not_gap: bool = False
+    insert_intention: bool = False
+    waiting: bool = False
+    records: list = field(default_factory=list)
+
+    @property
+    def lock_type(self):
+        """
+        table / insert-intention / gap / record (rec but not gap) / next-key のいずれか
+        """
+        if self.kind == "TABLE":
+            return "table"
+        if self.insert_intention:
+            return "insert-intention"
+        if self.gap:
+            return "gap"
+        if self.rec_not_gap:
+            return "record"
+        return "next-key"
+
+    def matches(self, **criteria):
+        return all(getattr(self, k) == v for k, v in criteria.items())
+
+
+@dataclass
+class Transaction:
+    trx_id: int
+    state: str
+    active_seconds: int = None
+    operation: str = None
+    lock_wait: bool = False
+    lock_structs: int = 0
+    row_locks: int = 0
+    undo_entries: int = 0
+    thread_id: int = None
+    query_id: int = None
+    query: str = None
+    wait_seconds: int = None
+    waiting_for: LockStruct = None
+    locks: list = field(default_factory=list)
+
+
+@dataclass
+class Deadlock:
+    detected_at: str = None
+    # "*** (1) TRANSACTION" から順に並ぶ。locks は持っているロック、waiting_for は待っていたロック
+    transactions: list = field(default_factory=list)
+    # ロールバックされたトランザクションの番号 (1 始まり)
+    rolled_back: int = None
+
+    @property
+    def victim(self):
+        if self.rolled_back is None or self.rolled_back > len(self.transactions):
+            return None
+        return self.transactions[self.rolled_back - 1]
+
+
+@dataclass
+class InnodbStatus:
+    transactions: list = field(default_factory=list)
+    # 起動してからデッドロックを検出していない場合は None
+    deadlock: Deadlock = None
+
+    def transaction(self, trx_id=None, thread_id=None):
+        for trx in self.transactions:
+            if trx_id is not None and trx.trx_id != trx_id:
+                continue
+            if thread_id is not None and trx.thread_id != thread_id:
+                continue
+            return trx
+        return None
+
+    def find_locks(self, **criteria):
+        """
+        criteria は LockStruct の属性名と値 (lock_type も指定可)
+        """
+        return [
+            lock
+            for trx in self.transactions
+            for lock in trx.locks
+            if lock.matches(**criteria)
+        ]
+
+
+def _parse_flags(lock, flags):
+    lock.gap = "locks gap before rec" in flags
+    lock.rec_not_gap = "locks rec but not gap" in flags
+    lock.insert_intention = "insert intention" in flags
+    lock.waiting = flags.endswith("waiting")
+
+
+def _parse_lock(line):
+    m = RECORD_LOCK.match(line)
+    if m:
+        lock = LockStruct(
+            kind="RECORD",
+            schema=m.group("schema"),
+            table=m.group("table"),
+            trx_id=int(m.group("trx_id")),
+            mode=m.group("mode"),
+            index=m.group("index"),
+            space_id=int(m.group("space_id")),
+            page_no=int(m.group("page_no")),
+        )
+        _parse_flags(lock, m.group("flags"))
+        return lock
+
+    m = TABLE_LOCK.match(line)
+    if m:
+        lock = LockStruct(
+            kind="TABLE",
+            schema=m.group("schema"),
+            table=m.group("table"),
+            trx_id=int(m.group("trx_id")),
+            mode=m.group("mode"),
+        )
+        _parse_flags(lock, m.group("flags"))
+        return lock
+
+    return None
+
+
+def parse_innodb_status(text):
+    status = InnodbStatus()
+    lines = text.splitlines()
+    section = None
+    trx = None
+    lock = None
+    record = None
+    in_wait_block = False
+    query_lines = None
+
+    def flush_query():
+        nonlocal query_lines
+        if trx is not None and query_lines:
+            trx.query = "\n".join(query_lines)
+        query_lines = None
+
+    for i, line in enumerate(lines):
+        # セクションは "-----" / タイトル / "-----" の 3 行で始まる
+        if (
+            SECTION_RULE.match(line)
+            and i + 2 < len(lines)
+            and SECTION_TITLE.match(lines[i + 1])
+            and SECTION_RULE.match(lines[i + 2])
+        ):
+            flush_query()
+            section = lines[i + 1]
+            trx = lock = record = None
+            continue
+        if section == DEADLOCK_SECTION:
+            if status.deadlock is None:
+                status.deadlock = Deadlock()
+            m = DEADLOCK_DETECTED_AT.match(line)
+            if m and status.deadlock.detected_at is None:
+                status.deadlock.detected_at = m.group("detected_at")
+                continue
+            m = DEADLOCK_PART.match(line)
+            if m:
+                flush_query()
+                # 待っていたロックの後には区切り行がないので、見出しで切り替える
+                in_wait_block = m.group("part").startswith("WAITING")
+                lock = record = None
+                continue
+            m = DEADLOCK_ROLLBACK.match(line)
+            if m:
+                flush_query()
+                status.deadlock.rolled_back = int(m.group("no"))
+                trx = lock = record = None
+                continue
+        elif section != "TRANSACTIONS":
+            continue
+
+        m = TRANSACTION.match(line)
+        if m:
+            flush_query()
+            trx = Transaction(
+                trx_id=int(m.group("trx_id")),
+                state="ACTIVE" if m.group("active") else m.group("state"),
+                active_seconds=int(m.group("seconds")) if m.group("seconds") else None,
+                operation=m.group("operation"),
+            )
+            if section == DEADLOCK_SECTION:
+                status.deadlock.transactions.append(trx)
+            else:
+                status.transactions.append(trx)
+            lock = record = None
+            in_wait_block = False
+            continue
+        if trx is None:
+            continue
+
+        m = LOCK_COUNTS.match(line)
+        if m:
+            trx.lock_wait = bool(m.group("lock_wait"))
+            trx.lock_structs = int(m.group("lock_structs"))
+            trx.row_locks = int(m.group("row_locks"))
+            trx.undo_entries = int(m.group("undo_entries") or 0)
+            continue
+
+        m = THREAD.match(line)
+        if m:
+            trx.thread_id = int(m.group("thread_id"))
+            trx.query_id = int(m.group("query_id"))
+            # 続く行から次のロック行までは実行中のクエリ
+            query_lines = []
+            continue
+
+        m = WAITING_HEADER.match(line)
+        if m:
+            flush_query()
+            trx.wait_seconds = int(m.group("seconds"))
+            in_wait_block = True
+            lock = record = None
+            continue
+        if line == "------------------":
+            in_wait_block = False
+            lock = record = None
+            continue
+
+        parsed = _parse_lock(line)
+        if parsed:
+            flush_query()
+            lock = parsed
+            record = None
+            if in_wait_block:
+                trx.waiting_for = lock
+            else:
+                trx.locks.append(lock)
+            continue
+
+        m = RECORD.match(line)
+        if m and lock is not None:
+            record = RecordDump(heap_no=int(m.group("heap_no")))
+            lock.records.append(record)
+            continue
+
+        m = RECORD_FIELD.match(line)
+        if m and record is not None:
+            record.fields.append(
+                (
+                    int(m.group("no")),
+                    int(m.group("length")) if m.group("length") else None,
+                    m.group("hex"),
+                )
+            )
+            continue
+
+        if query_lines is not None:
+            if line.startswith("Trx read view") or line.startswith("mysql tables"):
+                flush_query()
+            elif line:
+                query_lines.append(line)
+
+    flush_query()
+    return status
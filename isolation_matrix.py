@@ -0,0 +1,241 @@
+"""
+lock_scenarios のシナリオを分離レベルごとに流し、ロックの取り方とコストを比べる
+
+    python isolation_matrix.py --workers 8 --duration 5
+    python isolation_matrix.py -e mysql -s gap -i "READ COMMITTED" -i "REPEATABLE READ"
+
+エンジン x 分離レベル x シナリオ ごとに
+1. 1 つめのトランザクションを実行したまま data_locks / pg_locks に現れるロックを記録し、
+   2 つめのトランザクションのどの文がロック待ちになるかを調べる
+2. bench_lock_contention と同じ方法でスループットを測る
+
+PostgreSQL の行ロック (FOR UPDATE など) は競合しない限り pg_locks に現れない点に注意
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import psycopg
+from mysql import connector
+from tabulate import tabulate
+
+from bench_lock_contention import (
+    ENGINES,
+    KEY_BASE,
+    RESULTS_DIR,
+    connect,
+    run_scenario,
+    setup,
+)
+from lock_scenarios import SCENARIOS
+from util import (
+    LockSnapshot,
+    classify_error,
+    connect_mysql,
+    connect_postgresql,
+    is_mysql_session_blocked,
+    is_postgresql_session_blocked,
+    wait_until_blocked,
+)
+
+ISOLATION_LEVELS = ("READ COMMITTED", "REPEATABLE READ", "SERIALIZABLE")
+
+# 2 つめのトランザクションがロック待ちにも終了にもならないまま時間切れになった場合の blocked_statement
+UNKNOWN = "unknown"
+
+
+def set_isolation(engine, conn, level):
+    if engine == "mysql":
+        with conn.cursor() as cur:
+            cur.execute(f"SET SESSION TRANSACTION ISOLATION LEVEL {level}")
+        return
+    conn.isolation_level = psycopg.IsolationLevel[level.replace(" ", "_")]
+
+
+def session_id(engine, conn):
+    return conn.connection_id if engine == "mysql" else conn.info.backend_pid
+
+
+class Transaction(threading.Thread):
+    """
+    文を 1 つずつ実行し、いま何番目の文を実行中かを外から見られるようにする
+    """
+
+    def __init__(self, engine, conn, statements, n):
+        super().__init__(daemon=True)
+        self.cur = conn.cursor(buffered=True) if engine == "mysql" else conn.cursor()
+        self.statements = [statement.format(n=n) for statement in statements]
+        self.current = None
+        self.outcome = None
+
+    def run(self):
+        try:
+            for i, statement in enumerate(self.statements):
+                self.current = i
+                self.cur.execute(statement)
+            self.outcome = "ok"
+        except (connector.Error, psycopg.Error) as e:
+            self.outcome = classify_error(e) or f"error: {e}"
+
+
+def describe_locks(snapshot):
+    return sorted(
+        {
+            " ".join(
+                str(value)
+                for value in (
+                    row["lock_type"],
+                    row["index"] or row["table"],
+                    row["mode"],
+                )
+            )
+            for row in snapshot.rows()
+        }
+    )
+
+
+def find_blocked_statement(second, wait):
+    """
+    wait() (wait_until_blocked) が真になった時点で second が実行中の文
+    待たずに終わった場合は None、時間切れになった場合は UNKNOWN
+    """
+    try:
+        blocked = wait()
+    except TimeoutError:
+        return UNKNOWN
+    return second.statements[second.current] if blocked else None
+
+
+def probe(engine, scenario, level):
+    """
+    1 つめのトランザクションが持つロックと、2 つめのトランザクションが待たされる文を調べる
+    """
+    setup(engine, scenario)
+    holder_statements = scenario.transactions[0]
+    contender_statements = scenario.transactions[-1]
+
+    monitor = connect_mysql(root=True) if engine == "mysql" else connect_postgresql()
+    monitor.autocommit = True
+    holder = connect(engine)
+    contender = connect(engine)
+    for conn in (holder, contender):
+        set_isolation(engine, conn, level)
+    try:
+        first = Transaction(engine, holder, holder_statements, KEY_BASE - 1)
+        first.run()
+        if engine == "mysql":
+            monitor_cur = monitor.cursor(buffered=True)
+            snapshot = LockSnapshot.capture_mysql(monitor)
+        else:
+            monitor_cur = monitor.cursor()
+            snapshot = LockSnapshot.capture_postgresql(monitor)
+        held = snapshot.filter(session=session_id(engine, holder))
+
+        second = Transaction(engine, contender, contender_statements, KEY_BASE - 2)
+        second.start()
+        contender_id = session_id(engine, contender)
+        is_blocked = (
+            is_mysql_session_blocked
+            if engine == "mysql"
+            else is_postgresql_session_blocked
+        )
+        blocked_statement = find_blocked_statement(
+            second,
+            lambda: wait_until_blocked(
+                lambda: is_blocked(monitor_cur, contender_id),
+                lambda: not second.is_alive(),
+            ),
+        )
+
+        holder.rollback()
+        second.join()
+        contender.rollback()
+        return {
+            "first_outcome": first.outcome,
+            "locks": describe_locks(held),
+            "blocked_statement": blocked_statement,
+            "second_outcome": second.outcome,
+        }
+    finally:
+        for conn in (monitor, holder, contender):
+            conn.close()
+
+
+def run_matrix(engines, scenarios, levels, workers, duration):
+    results = []
+    for engine in engines:
+        for level in levels:
+            for name in scenarios:
+                scenario = SCENARIOS[name]
+                result = {"isolation": level}
+                result.update(probe(engine, scenario, level))
+                result.update(
+                    run_scenario(
+                        engine,
+                        scenario,
+                        workers,
+                        duration,
+                        prepare=lambda conn: set_isolation(engine, conn, level),
+                    )
+                )
+                results.append(result)
+    return results
+
+
+def summarize(results):
+    rows = [
+        {
+            "engine": result["engine"],
+            "scenario": result["scenario"],
+            "isolation": result["isolation"],
+            "locks": len(result["locks"]),
+            "blocked_statement": result["blocked_statement"] or "",
+            "second": result["second_outcome"],
+            "tps": round(result["throughput"], 1),
+            "p99_ms": result["latency_ms"]["p99"],
+            "deadlock": f"{result['deadlock_rate']:.2%}",
+            "timeout": f"{result['timeout_rate']:.2%}",
+            "serialization": result["outcomes"].get("serialization", 0),
+        }
+        for result in sorted(
+            results, key=lambda r: (r["engine"], r["scenario"], r["isolation"])
+        )
+    ]
+    return tabulate(rows, headers="keys", tablefmt="psql", floatfmt=".2f")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-e", "--engine", choices=ENGINES, action="append")
+    parser.add_argument("-s", "--scenario", choices=SCENARIOS, action="append")
+    parser.add_argument("-i", "--isolation", choices=ISOLATION_LEVELS, action="append")
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=5.0)
+    parser.add_argument("-o", "--out")
+    args = parser.parse_args(argv)
+
+    results = run_matrix(
+        args.engine or ENGINES,
+        args.scenario or SCENARIOS,
+        args.isolation or ISOLATION_LEVELS,
+        args.workers,
+        args.duration,
+    )
+
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"isolation_matrix-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({"results": results}, f, indent=2)
+
+    print(summarize(results))
+    print(f"saved to {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+文を実行する前に、InnoDB が取るロックを EXPLAIN FORMAT=JSON とインデックスの定義から見積もる (MySQL)
+
+    python lock_footprint.py "SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE"
+    python lock_footprint.py --max-rows 100 "UPDATE t1 SET val = 'x' WHERE val = 'one'"
+
+REPEATABLE READ (と SERIALIZABLE) では
+- ユニークなインデックスの等価検索で行があれば、そのレコードだけのロック (REC_NOT_GAP)
+- 行がなければ、その値が入るはずのギャップのロック
+- それ以外のインデックスの検索 (ref / range) は、読んだレコードのネクストキーロックと、範囲の次のレコードのギャップロック
+- インデックスを使わない走査 (ALL / index) は、すべてのレコードと supremum のネクストキーロック (実質テーブルロック)
+- セカンダリインデックスで見つけた行は、PRIMARY のレコードもロックする (REC_NOT_GAP)
+READ COMMITTED では条件に合った行のレコードロックだけが残る
+
+ロックしない SELECT は何もロックせず、INSERT の行ロックは他のトランザクションと競合するまで
+data_locks に現れない (暗黙のロック) ので、どちらもテーブルのインテンションロックだけを見積もる
+"""
+
+import argparse
+import json
+import re
+from dataclasses import dataclass, field
+
+from util import connect_mysql, lock_kind
+
+MYSQL_INDEX_QUERY = """
+select
+    TABLE_NAME,
+    INDEX_NAME,
+    NON_UNIQUE = 0,
+    group_concat(COLUMN_NAME order by SEQ_IN_INDEX)
+from
+    information_schema.STATISTICS
+where
+    TABLE_SCHEMA = database()
+    and TABLE_NAME in ({tables})
+group by
+    TABLE_NAME,
+    INDEX_NAME,
+    NON_UNIQUE
+"""
+
+STATEMENT_TYPE = re.compile(r"^\s*(select|update|delete|insert|replace)\b", re.I)
+EXCLUSIVE_READ = re.compile(r"\bfor\s+update\b", re.I)
+SHARED_READ = re.compile(r"\bfor\s+share\b|\block\s+in\s+share\s+mode\b", re.I)
+TARGET_TABLE = re.compile(r"\b(?:from|update|into)\s+`?(\w+)`?", re.I)
+
+UNIQUE_ACCESS = ("system", "const", "eq_ref")
+SCAN_ACCESS = ("ALL", "index")
+
+
+@dataclass
+class Index:
+    name: str
+    unique: bool
+    columns: list
+
+
+@dataclass
+class PredictedLock:
+    table: str
+    # None の場合はどのインデックスでもよい (EXPLAIN からインデックスがわからない場合)
+    index: str
+    # lock_kind の種類 (record / gap / next-key) のうち現れてよいもの
+    kinds: tuple
+    # X / S
+    mode: str
+    key_range: str
+    # ロックするレコード数の見積もり
+    rows: int = 0
+
+
+@dataclass
+class LockFootprint:
+    statement: str
+    # テーブル -> IX / IS
+    table_locks: dict = field(default_factory=dict)
+    locks: list = field(default_factory=list)
+    # インデックスを使わずに走査するテーブル
+    full_scans: list = field(default_factory=list)
+
+    @property
+    def rows(self):
+        return sum(lock.rows for lock in self.locks)
+
+    @property
+    def gap_locking(self):
+        return any(kind != "record" for lock in self.locks for kind in lock.kinds)
+
+    def exceeds(self, max_rows):
+        """
+        レビューで止めるべき大きさか (全件走査か、ロックするレコード数の見積もりが max_rows を超える)
+        """
+        return bool(self.full_scans) or self.rows > max_rows
+
+    def check(self, snapshot):
+        """
+        実際のロック (1 セッション分の LockSnapshot) のうち、見積もりに当てはまらないものの説明を返す
+        """
+        violations = []
+        for row in snapshot.rows():
+            if row["lock_type"] == "TABLE":
+                if self.table_locks.get(row["table"]) != row["mode"]:
+                    violations.append(f"unexpected {row['table']} {row['mode']}")
+                continue
+            mode = row["mode"].split(",")[0]
+            kind = lock_kind(row["mode"])
+            if not any(
+                lock.table == row["table"]
+                and lock.index in (None, row["index"])
+                and lock.mode == mode
+                and kind in lock.kinds
+                for lock in self.locks
+            ):
+                violations.append(
+                    f"unexpected {row['table']}.{row['index']} {row['mode']} "
+                    f"{row['data']}"
+                )
+        return violations
+
+    def describe(self):
+        lines = [
+            f"{table} {mode}" for table, mode in sorted(self.table_locks.items())
+        ] + [
+            f"{lock.table}.{lock.index or '?'} {lock.mode} "
+            f"{'/'.join(lock.kinds)} {lock.key_range} (rows={lock.rows})"
+            for lock in self.locks
+        ]
+        return "\n".join(lines)
+
+
+def statement_mode(sql, isolation):
+    """
+    文が取る行ロックのモード (X / S)。ロックしない場合は None
+    """
+    match = STATEMENT_TYPE.match(sql)
+    statement_type = match.group(1).lower() if match else None
+    if statement_type in ("update", "delete", "insert", "replace"):
+        return "X"
+    if EXCLUSIVE_READ.search(sql):
+        return "X"
+    if SHARED_READ.search(sql):
+        return "S"
+    if statement_type == "select" and isolation == "SERIALIZABLE":
+        return "S"
+    return None
+
+
+def explain_tables(explain):
+    """
+    EXPLAIN FORMAT=JSON の結果からテーブルごとのアクセス方法を取り出す
+    """
+    block = explain.get("query_block", {})
+    if "table" in block:
+        return [block["table"]]
+    return [item["table"] for item in block.get("nested_loop", []) if "table" in item]
+
+
+def predict_table(table, indexes, mode, isolation):
+    name = table["table_name"]
+    access = table.get("access_type")
+    key = table.get("key")
+    rows = int(table.get("rows_examined_per_scan", 0))
+    key_parts = table.get("used_key_parts", [])
+    index = indexes.get(key) if key else None
+    repeatable = isolation in ("REPEATABLE READ", "SERIALIZABLE")
+
+    locks = []
+    if access in SCAN_ACCESS:
+        scanned = key if access == "index" else "PRIMARY"
+        locks.append(
+            PredictedLock(
+                name,
+                scanned,
+                ("next-key",) if repeatable else ("record",),
+                mode,
+                "all rows",
+                rows,
+            )
+        )
+    elif (
+        access in UNIQUE_ACCESS
+        and index is not None
+        and index.unique
+        and len(key_parts) == len(index.columns)
+    ):
+        condition = " and ".join(f"{column} = ?" for column in key_parts)
+        locks.append(PredictedLock(name, key, ("record",), mode, condition, rows))
+    else:
+        condition = (
+            " and ".join(f"{column} = ?" for column in key_parts)
+            if access in ("ref", "ref_or_null")
+            else f"range over ({', '.join(key_parts)})"
+        )
+        kinds = ("next-key", "gap") if repeatable else ("record",)
+        if repeatable and (index is None or index.unique):
+            # ユニークなインデックスの範囲の端はレコードだけのロックになることがある
+            kinds += ("record",)
+        # 範囲の次のレコードも (ギャップを含めて) ロックする
+        locks.append(
+            PredictedLock(
+                name, key, kinds, mode, condition, rows + (1 if repeatable else 0)
+            )
+        )
+
+    if key not in (None, "PRIMARY") or access == "index":
+        locks.append(
+            PredictedLock(
+                name, "PRIMARY", ("record",), mode, f"rows found by {key}", rows
+            )
+        )
+    return locks
+
+
+def predict(sql, explain, indexes, isolation="REPEATABLE READ"):
+    """
+    indexes はテーブル名 -> インデックス名 -> Index
+    """
+    footprint = LockFootprint(sql)
+    mode = statement_mode(sql, isolation)
+    if mode is None:
+        return footprint
+
+    tables = explain_tables(explain)
+    intention = "IX" if mode == "X" else "IS"
+    statement_type = STATEMENT_TYPE.match(sql)
+    if statement_type and statement_type.group(1).lower() in ("insert", "replace"):
+        match = TARGET_TABLE.search(sql)
+        if match:
+            footprint.table_locks[match.group(1)] = intention
+        return footprint
+
+    if not tables:
+        # 主キーなどで探した行がない場合 ("no matching row in const table") は
+        # EXPLAIN にテーブルが現れないので、文からテーブルを探してギャップロックだけを見積もる
+        match = TARGET_TABLE.search(sql)
+        if match:
+            footprint.table_locks[match.group(1)] = intention
+            if isolation in ("REPEATABLE READ", "SERIALIZABLE"):
+                footprint.locks.append(
+                    PredictedLock(match.group(1), None, ("gap",), mode, "no row", 0)
+                )
+        return footprint
+
+    for table in tables:
+        name = table["table_name"]
+        footprint.table_locks[name] = intention
+        if table.get("access_type") in SCAN_ACCESS:
+            footprint.full_scans.append(name)
+        footprint.locks.extend(
+            predict_table(table, indexes.get(name, {}), mode, isolation)
+        )
+    return footprint
+
+
+def read_indexes(conn, tables):
+    if not tables:
+        return {}
+    with conn.cursor() as cur:
+        cur.execute(
+            MYSQL_INDEX_QUERY.format(tables=", ".join(["%s"] * len(tables))),
+            tuple(tables),
+        )
+        rows = cur.fetchall()
+    indexes = {}
+    for table, name, unique, columns in rows:
+        indexes.setdefault(table, {})[name] = Index(
+            name, bool(unique), columns.split(",")
+        )
+    return indexes
+
+
+def analyze(conn, sql, isolation=None):
+    """
+    conn で EXPLAIN して見積もる (文そのものは実行しない)
+    """
+    with conn.cursor() as cur:
+        if isolation is None:
+            cur.execute("SELECT @@transaction_isolation")
+            (isolation,) = cur.fetchone()
+            isolation = isolation.replace("-", " ")
+        cur.execute(f"EXPLAIN FORMAT=JSON {sql}")
+        ((plan,),) = cur.fetchall()
+    explain = json.loads(plan)
+    tables = {table["table_name"] for table in explain_tables(explain)}
+    match = TARGET_TABLE.search(sql)
+    if match:
+        tables.add(match.group(1))
+    return predict(sql, explain, read_indexes(conn, sorted(tables)), isolation)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("statement")
+    parser.add_argument("--isolation")
+    parser.add_argument("--max-rows", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    conn = connect_mysql()
+    try:
+        footprint = analyze(conn, args.statement, args.isolation)
+    finally:
+        conn.close()
+    print(footprint.describe())
+    if footprint.exceeds(args.max_rows):
+        print(f"rejected: locks more than {args.max_rows} rows or scans a table")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,225 @@
+"""
+ロック状況を一定間隔でサンプリングし、ロックごとのタイムラインを作る
+
+    python lock_sampler.py mysql --interval 0.05 --duration 30 --out timeline.json
+    python lock_sampler.py postgresql --out timeline.csv
+
+監視対象への負荷を抑えるため
+- 1 回のサンプリングは LockSnapshot の 1 クエリだけ
+- 前回との差分 (増えた / 消えたロック) だけをリングバッファに保持する
+- サンプリングにかかった時間が間隔に対して max_duty を超える場合は間隔を広げる
+"""
+
+import argparse
+import csv
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+from util import LockSnapshot, connect_mysql, connect_postgresql
+
+TIMELINE_COLUMNS = (
+    "session",
+    "trx",
+    "lock_type",
+    "schema",
+    "table",
+    "index",
+    "mode",
+    "data",
+    "granted",
+    "first_seen",
+    "last_seen",
+    "wait_seconds",
+)
+
+
+class LockSpan:
+    """
+    1 つのロックを観測した期間
+
+    待ち (granted=False) で観測されてから獲得 (granted=True) または消滅するまでを待ち時間とする
+    """
+
+    __slots__ = ("key", "first_seen", "last_seen", "granted", "wait_started", "wait")
+
+    def __init__(self, key, granted, seen_at):
+        self.key = key
+        self.first_seen = seen_at
+        self.last_seen = seen_at
+        self.granted = granted
+        self.wait_started = None if granted else seen_at
+        self.wait = None
+
+    def observe(self, granted, seen_at):
+        self.last_seen = seen_at
+        if granted and self.wait_started is not None:
+            self.wait = seen_at - self.wait_started
+            self.wait_started = None
+        self.granted = granted
+
+    def close(self, seen_at):
+        if self.wait_started is not None:
+            self.wait = seen_at - self.wait_started
+            self.wait_started = None
+
+    def as_dict(self):
+        session, trx, lock_type, schema, table, index, mode, data = self.key
+        return {
+            "session": session,
+            "trx": trx,
+            "lock_type": lock_type,
+            "schema": schema,
+            "table": table,
+            "index": index,
+            "mode": mode,
+            "data": data,
+            "granted": self.granted,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "wait_seconds": (
+                self.wait
+                if self.wait_started is None
+                else self.last_seen - self.wait_started
+            ),
+        }
+
+
+def span_key(row):
+    # granted 以外が同じなら同じロックとみなす (待ち -> 獲得 の遷移を追えるように)
+    session, trx, lock_type, schema, table, index, mode, _, data = row
+    return (session, trx, lock_type, schema, table, index, mode, data)
+
+
+class LockSampler:
+    def __init__(self, capture, interval=0.1, capacity=10000, max_duty=0.1):
+        self.capture = capture
+        self.interval = interval
+        self.max_duty = max_duty
+        # (観測時刻, 増えたロック, 消えたロック)
+        self.changes = deque(maxlen=capacity)
+        self.finished = deque(maxlen=capacity)
+        self.active = {}
+        self.samples = 0
+        self._previous = LockSnapshot.from_rows([])
+        # バックグラウンドのスレッドで capture() などが失敗した場合の例外 (stop() で送出する)
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        started = time.monotonic()
+        snapshot = self.capture()
+        acquired, released = self._previous.diff(snapshot)
+        self._previous = snapshot
+        self.samples += 1
+
+        seen_at = snapshot.taken_at
+        if len(acquired) or len(released):
+            self.changes.append((seen_at, acquired, released))
+
+        current = {}
+        for row in snapshot:
+            current[span_key(row)] = row[7]
+        for key in [key for key in self.active if key not in current]:
+            span = self.active.pop(key)
+            span.close(seen_at)
+            self.finished.append(span)
+        for key, granted in current.items():
+            if key in self.active:
+                self.active[key].observe(granted, seen_at)
+            else:
+                self.active[key] = LockSpan(key, granted, seen_at)
+        return time.monotonic() - started
+
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                elapsed = self.sample()
+                self._stop.wait(max(self.interval, elapsed / self.max_duty) - elapsed)
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        サンプリングが途中で失敗していた場合はその例外を送出する (タイムラインは失敗するまでの分しかない)
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def timeline(self):
+        spans = list(self.finished) + list(self.active.values())
+        return sorted(
+            (span.as_dict() for span in spans),
+            key=lambda row: (row["first_seen"], str(row["session"])),
+        )
+
+    def export_json(self, f):
+        json.dump(self.timeline(), f, indent=2, default=str)
+
+    def export_csv(self, f):
+        writer = csv.DictWriter(f, fieldnames=TIMELINE_COLUMNS)
+        writer.writeheader()
+        writer.writerows(self.timeline())
+
+
+def create_capture(engine):
+    if engine == "mysql":
+        conn = connect_mysql(root=True)
+        conn.autocommit = True
+        return lambda: LockSnapshot.capture_mysql(conn)
+
+    # pg_stat_activity はトランザクション内でキャッシュされるので autocommit にする
+    conn = connect_postgresql()
+    conn.autocommit = True
+    return lambda: LockSnapshot.capture_postgresql(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", choices=("mysql", "postgresql"))
+    parser.add_argument("--interval", type=float, default=0.1)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--capacity", type=int, default=10000)
+    parser.add_argument("--max-duty", type=float, default=0.1)
+    parser.add_argument("--out", default="-")
+    args = parser.parse_args(argv)
+
+    sampler = LockSampler(
+        create_capture(args.engine),
+        interval=args.interval,
+        capacity=args.capacity,
+        max_duty=args.max_duty,
+    )
+    with sampler:
+        time.sleep(args.duration)
+
+    f = sys.stdout if args.out == "-" else open(args.out, "w", newline="")
+    try:
+        if args.out.endswith(".csv"):
+            sampler.export_csv(f)
+        else:
+            sampler.export_json(f)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+ベンチマークなどで繰り返し流すロック競合のシナリオ
+
+テストで確認しているロックの種類ごとに、競合する文の組を MySQL / PostgreSQL の両方で定義する
+{n} はワーカーごと・実行ごとに重複しない整数に置き換える (INSERT の主キー用)
+"""
+
+from dataclasses import dataclass, field
+
+T1_SETUP = {
+    "mysql": """
+    DROP TABLE IF EXISTS `t1`;
+    CREATE TABLE `t1` (
+      `num` int NOT NULL,
+      `val` varchar(32) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL,
+      `val_length` int unsigned NOT NULL,
+      PRIMARY KEY (`num`),
+      KEY `idx_vallength` (`val_length`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+    INSERT INTO `t1`
+        (`num`, `val`, `val_length`)
+    VALUES
+        (1, 'one', 3),
+        (2, 'two', 3),
+        (3, 'three', 5),
+        (5, 'five', 4);
+    """,
+    "postgresql": """
+    drop table if exists t1;
+    create table t1
+    (
+        num        integer primary key,
+        val        varchar(32) not null,
+        val_length integer not null
+    );
+    create index idx_vallength on t1 (val_length);
+    insert into t1
+        (num, val, val_length)
+    values
+        (1, 'one', 3),
+        (2, 'two', 3),
+        (3, 'three', 5),
+        (5, 'five', 4);
+    """,
+}
+
+LOCK_SAMPLE_SETUP = {
+    "mysql": """
+    DROP TABLE IF EXISTS `lock_sample`;
+    CREATE TABLE `lock_sample` (
+        `id` bigint(20) NOT NULL,
+        `val1` int(11) NOT NULL,
+        PRIMARY KEY (`id`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    INSERT INTO `lock_sample`
+        (`id`, `val1`)
+    VALUES
+        (1, 1),
+        (2, 2),
+        (3, 10),
+        (4, 10),
+        (5, 4),
+        (6, 10);
+    """,
+    "postgresql": """
+    drop table if exists lock_sample;
+    create table lock_sample
+    (
+        id   bigint primary key,
+        val1 integer not null
+    );
+    insert into lock_sample
+        (id, val1)
+    values
+        (1, 1),
+        (2, 2),
+        (3, 10),
+        (4, 10),
+        (5, 4),
+        (6, 10);
+    """,
+}
+
+
+@dataclass
+class LockScenario:
+    name: str
+    description: str
+    # dialect -> テーブルを用意するスクリプト
+    setup: dict
+    # 1 トランザクションで実行する文のリスト。ワーカー i は transactions[i % len] を繰り返す
+    transactions: list = field(default_factory=list)
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in [
+        LockScenario(
+            name="record",
+            description="同じ行を FOR UPDATE で取り合う (レコードロック)",
+            setup=T1_SETUP,
+            transactions=[
+                [
+                    "SELECT * FROM t1 WHERE num = 1 FOR UPDATE",
+                    "UPDATE t1 SET val = 'one' WHERE num = 1",
+                ],
+            ],
+        ),
+        LockScenario(
+            name="gap",
+            description="val_length = 3 の FOR UPDATE と、その手前のギャップへの INSERT",
+            setup=T1_SETUP,
+            transactions=[
+                ["SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE"],
+                [
+                    "INSERT INTO t1 (num, val, val_length) VALUES ({n}, 'ju', 2)",
+                    "DELETE FROM t1 WHERE num = {n}",
+                ],
+            ],
+        ),
+        LockScenario(
+            name="next_key",
+            description="範囲の FOR UPDATE (ネクストキーロック) と範囲内の UPDATE",
+            setup=T1_SETUP,
+            transactions=[
+                ["SELECT * FROM t1 WHERE val_length BETWEEN 3 AND 4 FOR UPDATE"],
+                ["UPDATE t1 SET val = 'five' WHERE val_length = 4"],
+            ],
+        ),
+        LockScenario(
+            name="insert_intention",
+            description="同じギャップへの INSERT 同士 (挿入意図ロックは互いに競合しない)",
+            setup=T1_SETUP,
+            transactions=[
+                [
+                    "INSERT INTO t1 (num, val, val_length) VALUES ({n}, 'ju', 2)",
+                    "DELETE FROM t1 WHERE num = {n}",
+                ],
+            ],
+        ),
+    ]
+}
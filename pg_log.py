@@ -0,0 +1,233 @@
+"""
+PostgreSQL のログファイルを前回読んだ位置から読み進め、pid ごとのイベントに変換する
+
+log_line_prefix は既定の '%m [%p] ' を前提とする
+
+    2024-11-24 10:00:00.123 UTC [123] LOG:  duration: 215.018 ms  statement: SELECT ...
+    2024-11-24 10:00:01.123 UTC [123] LOG:  process 123 still waiting for ShareLock on ...
+    2024-11-24 10:00:01.123 UTC [123] DETAIL:  Process holding the lock: 122. Wait queue: 123.
+
+DETAIL / HINT / CONTEXT / STATEMENT の行とタブで始まる継続行は、同じ pid の直前のイベントにまとめる
+
+デッドロックは検出したプロセス (ロールバックされる側) の ERROR として、DETAIL に待ちの関係と各プロセスの文が出る
+
+    2024-11-24 10:00:02.123 UTC [123] ERROR:  deadlock detected
+    2024-11-24 10:00:02.123 UTC [123] DETAIL:  Process 123 waits for ShareLock on transaction 741; blocked by process 124.
+    	Process 124 waits for ShareLock on transaction 740; blocked by process 123.
+    	Process 123: UPDATE t1 SET val = 'x' WHERE num = 2
+    	Process 124: UPDATE t1 SET val = 'x' WHERE num = 1
+"""
+
+import os
+import re
+import time
+from dataclasses import dataclass, field
+
+from util import LOCK_WAIT_TIMEOUT, poll_intervals
+
+POSTGRESQL_LOG_PATH = "/var/log/postgresql/postgresql.log"
+
+LOG_LINE = re.compile(
+    r"^(?P<logged_at>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?(?: \S+)?) "
+    r"\[(?P<pid>\d+)\] (?P<severity>[A-Z]+[0-9]?):  (?P<message>.*)$"
+)
+LOCK_WAIT = re.compile(
+    r"^process \d+ (?P<state>still waiting|acquired|avoided deadlock|detected deadlock)"
+    r" for (?P<mode>\S+) on (?P<target>.+?) after (?P<ms>[\d.]+) ms"
+)
+DURATION = re.compile(
+    r"^duration: (?P<ms>[\d.]+) ms(?:  (?:statement|execute [^:]*|parse [^:]*|"
+    r"bind [^:]*): (?P<statement>.*))?$",
+    re.DOTALL,
+)
+DEADLOCK_WAIT = re.compile(
+    r"^Process (?P<pid>\d+) waits for (?P<mode>\S+) on (?P<target>.+?); "
+    r"blocked by process (?P<blocker>\d+)\.$"
+)
+DEADLOCK_QUERY = re.compile(r"^Process (?P<pid>\d+): (?P<query>.*)$")
+ATTACHED = {"DETAIL": "detail", "HINT": "hint", "CONTEXT": "context"}
+
+
+@dataclass
+class DeadlockWait:
+    pid: int
+    mode: str
+    target: str
+    blocked_by: int
+
+
+@dataclass
+class PgDeadlock:
+    # ロールバックされた (エラーを受け取った) プロセス
+    victim: int
+    waits: list = field(default_factory=list)
+    # pid -> 実行していた文
+    queries: dict = field(default_factory=dict)
+
+
+@dataclass
+class LogEvent:
+    logged_at: str
+    pid: int
+    severity: str
+    message: str
+    detail: str = None
+    hint: str = None
+    context: str = None
+    statement: str = None
+
+    @property
+    def kind(self):
+        """
+        lock_wait (log_lock_waits) / duration (log_min_duration_statement) /
+        deadlock / message のいずれか
+        """
+        if self.severity == "LOG" and LOCK_WAIT.match(self.message):
+            return "lock_wait"
+        if self.severity == "LOG" and DURATION.match(self.message):
+            return "duration"
+        if self.message == "deadlock detected":
+            return "deadlock"
+        return "message"
+
+    @property
+    def duration_ms(self):
+        m = LOCK_WAIT.match(self.message) or DURATION.match(self.message)
+        return float(m.group("ms")) if m else None
+
+    @property
+    def lock_wait(self):
+        """
+        log_lock_waits のイベントなら (状態, ロックモード, 対象) を返す
+        """
+        m = LOCK_WAIT.match(self.message)
+        return (m.group("state"), m.group("mode"), m.group("target")) if m else None
+
+    @property
+    def deadlock(self):
+        """
+        デッドロックのイベントなら DETAIL を PgDeadlock にして返す
+        """
+        if self.kind != "deadlock":
+            return None
+        deadlock = PgDeadlock(victim=self.pid)
+        for line in (self.detail or "").splitlines():
+            m = DEADLOCK_WAIT.match(line)
+            if m:
+                deadlock.waits.append(
+                    DeadlockWait(
+                        pid=int(m.group("pid")),
+                        mode=m.group("mode"),
+                        target=m.group("target"),
+                        blocked_by=int(m.group("blocker")),
+                    )
+                )
+                continue
+            m = DEADLOCK_QUERY.match(line)
+            if m:
+                deadlock.queries[int(m.group("pid"))] = m.group("query")
+        return deadlock
+
+    @property
+    def query(self):
+        # duration のメッセージに含まれる文か、STATEMENT 行の文
+        m = DURATION.match(self.message)
+        if m and m.group("statement") is not None:
+            return m.group("statement")
+        return self.statement
+
+    def matches(self, **criteria):
+        return all(getattr(self, k) == v for k, v in criteria.items())
+
+
+class PostgresqlLogTailer:
+    def __init__(self, path=POSTGRESQL_LOG_PATH, from_start=False):
+        self.path = path
+        # 既存のログは読まず、作成した時点以降に書かれた分だけを対象にする
+        self.offset = 0 if from_start else os.path.getsize(path)
+        self.events = []
+        self.by_pid = {}
+        self._partial = b""
+        self._last = None
+
+    def read(self):
+        """
+        前回からの差分を読んで、新しく増えたイベントを返す
+        """
+        if os.path.getsize(self.path) < self.offset:
+            # ログがローテートされた / 切り詰められた
+            self.offset = 0
+            self._partial = b""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+
+        # 書きかけの最終行は次回に回す
+        data = self._partial + data
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+
+        added = []
+        for line in data[:end].decode("utf-8", errors="replace").splitlines():
+            event = self._parse_line(line)
+            if event is not None:
+                added.append(event)
+        return added
+
+    def _parse_line(self, line):
+        m = LOG_LINE.match(line)
+        if not m:
+            if line.startswith("\t") and self._last is not None:
+                self._append(self._last, line[1:])
+            return None
+
+        pid = int(m.group("pid"))
+        severity = m.group("severity")
+        message = m.group("message")
+        previous = self.by_pid.get(pid)
+        if severity == "STATEMENT" and previous:
+            previous[-1].statement = message
+            self._last = (previous[-1], "statement")
+            return None
+        if severity in ATTACHED and previous:
+            setattr(previous[-1], ATTACHED[severity], message)
+            self._last = (previous[-1], ATTACHED[severity])
+            return None
+
+        event = LogEvent(
+            logged_at=m.group("logged_at"),
+            pid=pid,
+            severity=severity,
+            message=message,
+        )
+        self.events.append(event)
+        self.by_pid.setdefault(pid, []).append(event)
+        self._last = (event, "message")
+        return event
+
+    @staticmethod
+    def _append(last, line):
+        event, name = last
+        setattr(event, name, f"{getattr(event, name)}\n{line}")
+
+    def find(self, pid=None, **criteria):
+        """
+        読み込み済みのイベントを絞り込む (criteria は LogEvent の属性名と値、kind も指定可)
+        """
+        events = self.events if pid is None else self.by_pid.get(pid, [])
+        return [event for event in events if event.matches(**criteria)]
+
+    def wait_for(self, pid=None, timeout=LOCK_WAIT_TIMEOUT, **criteria):
+        """
+        条件に合うイベントが書かれるまで読み進め、最初に見つかったものを返す
+        """
+        for interval in poll_intervals(timeout=timeout):
+            self.read()
+            found = self.find(pid=pid, **criteria)
+            if found:
+                return found[0]
+            time.sleep(interval)
+        raise TimeoutError(
+            f"no log event matching pid={pid} {criteria} within {timeout}s"
+        )
@@ -0,0 +1,156 @@
+"""
+テストクラス単位でワーカープロセスに振り分けて並列実行するランナー
+
+ワーカーごとに専用の MySQL スキーマ / PostgreSQL データベースを用意し、
+MYSQL_DATABASE / POSTGRES_DB をそれに向けてからテストを実行する。
+
+    python runner.py -j 4
+"""
+
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from os import environ
+
+import psycopg
+from mysql import connector
+from psycopg import sql
+
+from statement_stats import STATEMENT_STATS_ENV, StatementStats, take_current_stats
+from util import mysql_connect_params, postgresql_conninfo
+
+
+def iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from iter_tests(test)
+        else:
+            yield test
+
+
+def collect_shards(start_dir, pattern, workers):
+    """
+    テストクラスごとにまとめ、テスト数の多いクラスから空いているワーカーに詰めていく
+    """
+    suite = unittest.defaultTestLoader.discover(start_dir, pattern=pattern)
+    classes = {}
+    for test in iter_tests(suite):
+        if isinstance(test, unittest.loader._FailedTest):
+            raise ImportError(f"failed to load {test.id()}: {test._exception}")
+        key = f"{type(test).__module__}.{type(test).__qualname__}"
+        classes.setdefault(key, []).append(test.id())
+
+    shards = [[] for _ in range(workers)]
+    for _, ids in sorted(classes.items(), key=lambda kv: (-len(kv[1]), kv[0])):
+        min(shards, key=len).extend(ids)
+    return [shard for shard in shards if shard]
+
+
+def worker_env(index):
+    return {
+        "MYSQL_DATABASE": f"{environ['MYSQL_DATABASE']}_w{index}",
+        "POSTGRES_DB": f"{environ['POSTGRES_DB']}_w{index}",
+    }
+
+
+def create_mysql_namespace(database):
+    conn = connector.connect(**mysql_connect_params(root=True))
+    try:
+        cur = conn.cursor()
+        cur.execute(f"CREATE DATABASE IF NOT EXISTS `{database}`")
+        cur.execute(
+            f"GRANT ALL PRIVILEGES ON `{database}`.* TO '{environ['MYSQL_USER']}'@'%'"
+        )
+    finally:
+        conn.close()
+
+
+def create_postgresql_namespace(dbname):
+    # CREATE DATABASE はテンプレートに他の接続があると失敗するので、ワーカー起動前に順番に作る
+    with psycopg.connect(conninfo=postgresql_conninfo(), autocommit=True) as conn:
+        exists = conn.execute(
+            "select 1 from pg_database where datname = %s", (dbname,)
+        ).fetchone()
+        if not exists:
+            conn.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(dbname)))
+
+    with psycopg.connect(
+        conninfo=postgresql_conninfo(dbname=dbname), autocommit=True
+    ) as conn:
+        conn.execute("create extension if not exists pg_stat_statements")
+
+
+def run_shard(env, test_ids):
+    environ.update(env)
+    suite = unittest.defaultTestLoader.loadTestsFromNames(test_ids)
+    stream = io.StringIO()
+    result = unittest.TextTestRunner(stream=stream, verbosity=2).run(suite)
+    # ワーカーの終了時には書き出さず、親プロセスでまとめる
+    stats = take_current_stats()
+    if stats is not None:
+        stats.collect()
+    return {
+        "env": env,
+        "statement_stats": stats.to_dict() if stats is not None else None,
+        "output": stream.getvalue(),
+        "run": result.testsRun,
+        "failures": len(result.failures),
+        "errors": len(result.errors),
+        "skipped": len(result.skipped),
+        "successful": result.wasSuccessful(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("-s", "--start-directory", default=".")
+    parser.add_argument("-p", "--pattern", default="test*.py")
+    args = parser.parse_args(argv)
+
+    shards = collect_shards(args.start_directory, args.pattern, max(args.jobs, 1))
+    envs = [worker_env(index) for index in range(len(shards))]
+    for env in envs:
+        create_mysql_namespace(env["MYSQL_DATABASE"])
+        create_postgresql_namespace(env["POSTGRES_DB"])
+
+    started = time.monotonic()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as executor:
+        results = list(executor.map(run_shard, envs, shards))
+    elapsed = time.monotonic() - started
+
+    for result in results:
+        env = result["env"]
+        print(
+            f"=== {env['MYSQL_DATABASE']} / {env['POSTGRES_DB']} ===", file=sys.stderr
+        )
+        print(result["output"], file=sys.stderr)
+
+    if environ.get(STATEMENT_STATS_ENV):
+        stats = StatementStats()
+        for result in results:
+            if result["statement_stats"] is not None:
+                stats.merge(StatementStats.from_dict(result["statement_stats"]))
+        stats.dump(environ[STATEMENT_STATS_ENV])
+        print(stats.summarize(), file=sys.stderr)
+
+    run = sum(result["run"] for result in results)
+    failures = sum(result["failures"] for result in results)
+    errors = sum(result["errors"] for result in results)
+    skipped = sum(result["skipped"] for result in results)
+    print(
+        f"Ran {run} tests in {elapsed:.3f}s on {len(results)} workers "
+        f"(failures={failures}, errors={errors}, skipped={skipped})",
+        file=sys.stderr,
+    )
+    return 0 if all(result["successful"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""
+複数セッションのロックのシナリオを宣言的に書いて実行する
+
+    Scenario(
+        name="gap_lock",
+        engine="mysql",
+        setup="CREATE TABLE ...; INSERT INTO ...;",
+        steps=[
+            "A: BEGIN",
+            "A: SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE",
+            "B: BEGIN",
+            Step("B", "INSERT INTO t1 VALUES (10, 'ju', 2)", blocks=True),
+            Step(CHECK, "SELECT ... FROM performance_schema.data_locks", table="..."),
+            "A: ROLLBACK",
+        ],
+    )
+
+- "セッション名: SQL" の文字列は Step(セッション名, SQL) と同じ
+- セッションはプールから借りたコネクションで、ステップに初めて出てきた順に用意する
+- CHECK はロックの確認用のセッション (MySQL は root、autocommit)
+- blocks=True のステップはロック待ちになったことを確認したら次のステップへ進む
+  同じセッションの次のステップ (またはシナリオの終わり) で完了を待ち、expect と比べる
+- SQL の {A} などはセッション A の接続 ID (pid) に、{database} はスキーマ名に置き換える
+  table の {A} のセルも同じくセッション A の接続 ID と比べる
+"""
+
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from os import environ
+
+import psycopg
+from mysql import connector
+from psycopg.rows import dict_row
+
+from table_compare import compare_table
+from util import (
+    LOCK_WAIT_TIMEOUT,
+    classify_error,
+    fixture_plan,
+    is_mysql_session_blocked,
+    is_postgresql_session_blocked,
+    mysql_pool,
+    postgresql_pool,
+    release_connections,
+    setup_mysql_fixture,
+    setup_postgresql_fixture,
+    wait_until_blocked,
+)
+
+CHECK = "check"
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+@dataclass
+class Step:
+    session: str
+    sql: str
+    # ロック待ちになることを期待する
+    blocks: bool = False
+    # ok / deadlock / timeout / serialization / error
+    expect: str = "ok"
+    # 結果を assertTableEqual と同じ形式で比べる
+    table: str = None
+    label: str = None
+
+    @classmethod
+    def parse(cls, line):
+        session, sql = line.split(":", 1)
+        return cls(session.strip(), sql.strip())
+
+
+@dataclass
+class Scenario:
+    name: str
+    engine: str
+    setup: str = None
+    steps: list = field(default_factory=list)
+
+    def __post_init__(self):
+        self.steps = [
+            Step.parse(step) if isinstance(step, str) else step for step in self.steps
+        ]
+
+    @property
+    def sessions(self):
+        names = []
+        for step in self.steps:
+            if step.session != CHECK and step.session not in names:
+                names.append(step.session)
+        return names
+
+
+@dataclass
+class StepResult:
+    step: Step
+    sql: str
+    blocked: bool = False
+    outcome: str = None
+    rows: list = None
+    error: Exception = None
+
+
+@dataclass
+class ScenarioResult:
+    scenario: Scenario
+    # セッション名 -> 接続 ID (pid)
+    sessions: dict = field(default_factory=dict)
+    steps: list = field(default_factory=list)
+    failures: list = field(default_factory=list)
+
+    def __getitem__(self, label):
+        for result in self.steps:
+            if result.step.label == label:
+                return result
+        raise KeyError(label)
+
+
+def execute_step(conn, engine, sql, result):
+    cursor = (
+        conn.cursor(dictionary=True, buffered=True)
+        if engine == "mysql"
+        else conn.cursor(row_factory=dict_row)
+    )
+    try:
+        cursor.execute(sql)
+        if cursor.description:
+            result.rows = cursor.fetchall()
+        result.outcome = "ok"
+    except (connector.Error, psycopg.Error) as e:
+        result.outcome = classify_error(e) or "error"
+        result.error = e
+    finally:
+        cursor.close()
+
+
+class ScenarioRunner:
+    def __init__(self, scenario, timeout=LOCK_WAIT_TIMEOUT):
+        self.scenario = scenario
+        self.engine = scenario.engine
+        self.timeout = timeout
+        self.result = ScenarioResult(scenario)
+        self.connections = []
+        self.threads = []
+        self.sessions = {}
+        self.pending = {}
+
+    def acquire(self, root=False):
+        if self.engine == "mysql":
+            pool = mysql_pool(root=root)
+        else:
+            pool = postgresql_pool()
+        conn = pool.acquire()
+        self.connections.append((pool, conn))
+        return conn
+
+    def session_id(self, conn):
+        return conn.connection_id if self.engine == "mysql" else conn.info.backend_pid
+
+    def is_blocked(self, conn):
+        if self.engine == "mysql":
+            return is_mysql_session_blocked(self.check_cur, self.session_id(conn))
+        return is_postgresql_session_blocked(self.check_cur, self.session_id(conn))
+
+    def substitute(self, sql):
+        values = {name: str(value) for name, value in self.result.sessions.items()}
+        values["database"] = (
+            environ["MYSQL_DATABASE"]
+            if self.engine == "mysql"
+            else environ["POSTGRES_DB"]
+        )
+        return PLACEHOLDER.sub(lambda m: values.get(m.group(1), m.group(0)), sql)
+
+    def fail(self, result, message):
+        self.result.failures.append(f"{result.step.session}: {result.sql}: {message}")
+
+    def verify(self, result):
+        step = result.step
+        if result.outcome != step.expect:
+            self.fail(
+                result,
+                f"expected {step.expect} but {result.outcome}"
+                + (f" ({result.error})" if result.error else ""),
+            )
+            return False
+        if step.table is not None:
+            message = compare_table(
+                step.table, result.rows or [], **self.result.sessions
+            )
+            if message is not None:
+                self.fail(result, message)
+                return False
+        return True
+
+    def finish(self, session):
+        if session not in self.pending:
+            return True
+        thread, result = self.pending.pop(session)
+        thread.join(timeout=self.timeout * 2)
+        if thread.is_alive():
+            self.fail(result, "did not finish")
+            return False
+        return self.verify(result)
+
+    def run_step(self, step):
+        if step.session == CHECK:
+            result = StepResult(step, self.substitute(step.sql))
+            self.result.steps.append(result)
+            execute_step(self.check_conn, self.engine, result.sql, result)
+            return self.verify(result)
+
+        if not self.finish(step.session):
+            return False
+        conn = self.sessions[step.session]
+        result = StepResult(step, self.substitute(step.sql))
+        self.result.steps.append(result)
+
+        thread = threading.Thread(
+            target=execute_step, args=(conn, self.engine, result.sql, result)
+        )
+        thread.start()
+        self.threads.append((thread, conn))
+        try:
+            result.blocked = wait_until_blocked(
+                lambda: self.is_blocked(conn),
+                lambda: not thread.is_alive(),
+                timeout=self.timeout,
+            )
+        except TimeoutError as e:
+            self.fail(result, str(e))
+            return False
+
+        if result.blocked != step.blocks:
+            self.fail(
+                result, "waited for a lock" if result.blocked else "did not block"
+            )
+            return False
+        if result.blocked:
+            self.pending[step.session] = (thread, result)
+            return True
+        thread.join()
+        return self.verify(result)
+
+    def run(self):
+        try:
+            self.check_conn = self.acquire(root=True)
+            if self.scenario.setup is not None:
+                if self.engine == "mysql":
+                    setup_mysql_fixture(self.check_conn, self.scenario.setup)
+                else:
+                    setup_postgresql_fixture(self.check_conn, self.scenario.setup)
+                self.check_conn.commit()
+            self.check_conn.autocommit = True
+            self.check_cur = self.check_conn.cursor()
+            for name in self.scenario.sessions:
+                self.sessions[name] = self.acquire()
+                self.result.sessions[name] = self.session_id(self.sessions[name])
+
+            for step in self.scenario.steps:
+                if not self.run_step(step):
+                    break
+            else:
+                for session in list(self.pending):
+                    self.finish(session)
+        finally:
+            release_connections(self.connections, self.threads)
+        return self.result
+
+
+def run_scenario(scenario, timeout=LOCK_WAIT_TIMEOUT):
+    return ScenarioRunner(scenario, timeout=timeout).run()
+
+
+def scenario_tables(scenario):
+    """
+    シナリオの setup が作るテーブルの集合 ((engine, table) の組)
+    setup がない場合や、どのテーブルを触るか分からない場合は None
+    """
+    if scenario.setup is None:
+        return None
+    _, tables = fixture_plan(scenario.setup, scenario.engine)
+    if tables is None:
+        return None
+    return {(scenario.engine, table) for table in tables}
+
+
+def group_scenarios(scenarios):
+    """
+    同じテーブルを使うシナリオを同じグループにまとめ、(グループごとの添字のリスト, 単独で流すシナリオの添字) を返す
+
+    どのテーブルを使うか分からないシナリオはほかのどのシナリオとも同時に流さない
+    """
+    groups = []
+    isolated = []
+    for index, scenario in enumerate(scenarios):
+        tables = scenario_tables(scenario)
+        if tables is None:
+            isolated.append(index)
+            continue
+        indexes = [index]
+        for group in [group for group in groups if group[0] & tables]:
+            groups.remove(group)
+            tables |= group[0]
+            indexes += group[1]
+        groups.append((tables, indexes))
+    return [sorted(indexes) for _, indexes in groups], isolated
+
+
+def run_scenarios(scenarios, max_workers=4, timeout=LOCK_WAIT_TIMEOUT):
+    """
+    シナリオを並行に実行し、scenarios と同じ順で結果を返す
+
+    同じテーブルを使うシナリオ (group_scenarios) は 1 つのスレッドで順に流し、
+    どのテーブルを使うか分からないシナリオは最後に 1 つずつ流す
+    """
+    groups, isolated = group_scenarios(scenarios)
+    results = [None] * len(scenarios)
+
+    def run_group(indexes):
+        for index in indexes:
+            results[index] = run_scenario(scenarios[index], timeout)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run_group, groups))
+    run_group(isolated)
+    return results
@@ -0,0 +1,323 @@
+"""
+1 行 (または少数の行・ギャップ) に多数のセッションが詰まる状況を 1 つのイベントループで再現する
+
+    python session_simulator.py mysql --spot t1_row --sessions 2000
+    python session_simulator.py postgresql --spot lock_sample_row --hot-rows 3 --sessions 1000
+
+1. ブロッカーのセッションがホットな行をロックする
+2. 多数のセッションが同じ行 (ギャップ) をロックしようとして待ち行列になる
+3. 待ち行列が伸びきったらブロッカーが commit し、全員がロックを取って commit し終えるまでを測る
+
+待ち行列の長さの推移 / ブロッカーの commit から捌けきるまでの時間 / 待っているセッションあたりの
+サーバー側のメモリ (MySQL は performance_schema の memory_summary_by_thread_by_event_name) を返す
+PostgreSQL 14 は他のバックエンドのメモリ使用量を SQL で取れないので memory は None になる
+
+セッション数はサーバーの max_connections (db/ 以下の設定) を超えないようにする
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from dataclasses import dataclass
+
+import psycopg
+from mysql import connector
+from mysql.connector import aio as aio_connector
+
+from lock_scenarios import LOCK_SAMPLE_SETUP, T1_SETUP
+from util import (
+    async_execute_mysql_script,
+    async_execute_postgresql_script,
+    classify_error,
+    mysql_connect_params,
+    postgresql_conninfo,
+)
+
+# ロック待ちのスレッド (並列実行時に他のスキーマの分を数えないよう、ロック対象のスキーマで絞る)
+MYSQL_WAITING_THREADS = """
+select
+    w.REQUESTING_THREAD_ID
+from
+    performance_schema.data_lock_waits w
+    join performance_schema.data_locks l on (
+        l.ENGINE = w.ENGINE
+        and l.ENGINE_LOCK_ID = w.REQUESTING_ENGINE_LOCK_ID
+    )
+where
+    l.OBJECT_SCHEMA = database()
+"""
+
+MYSQL_QUEUE_DEPTH_QUERY = f"""
+select count(distinct REQUESTING_THREAD_ID) from ({MYSQL_WAITING_THREADS}) w
+"""
+
+POSTGRESQL_QUEUE_DEPTH_QUERY = """
+select count(*) from pg_stat_activity
+where wait_event_type = 'Lock' and datname = current_database()
+"""
+
+MYSQL_WAITING_MEMORY_QUERY = f"""
+select
+    avg(used)
+from (
+    select
+        sum(CURRENT_NUMBER_OF_BYTES_USED) as used
+    from
+        performance_schema.memory_summary_by_thread_by_event_name
+    where
+        THREAD_ID in ({MYSQL_WAITING_THREADS})
+    group by
+        THREAD_ID
+) s
+"""
+
+
+@dataclass
+class HotSpot:
+    name: str
+    # dialect -> テーブルを用意するスクリプト
+    setup: dict
+    # ロック対象のキー。--hot-rows で先頭から何個使うかを決める
+    keys: list
+    # {keys} はロック対象のキーのカンマ区切り
+    holder: str
+    # {key} はセッションが狙うキー、{n} はセッションごとに重複しない整数
+    waiter: str
+
+
+SPOTS = {
+    spot.name: spot
+    for spot in [
+        HotSpot(
+            name="t1_row",
+            setup=T1_SETUP,
+            keys=[1, 2, 3, 5],
+            holder="SELECT * FROM t1 WHERE num IN ({keys}) FOR UPDATE",
+            waiter="SELECT * FROM t1 WHERE num = {key} FOR UPDATE",
+        ),
+        HotSpot(
+            name="t1_gap",
+            setup=T1_SETUP,
+            keys=[3],
+            holder="SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE",
+            waiter="INSERT INTO t1 (num, val, val_length) VALUES ({n}, 'ju', 2)",
+        ),
+        HotSpot(
+            name="lock_sample_row",
+            setup=LOCK_SAMPLE_SETUP,
+            keys=[1, 2, 3, 4, 5, 6],
+            holder="SELECT * FROM lock_sample WHERE id IN ({keys}) FOR UPDATE",
+            waiter="SELECT * FROM lock_sample WHERE id = {key} FOR UPDATE",
+        ),
+    ]
+}
+
+KEY_BASE = 1_000_000
+
+
+async def execute(engine, conn, sql):
+    if engine == "mysql":
+        cur = await conn.cursor()
+        await cur.execute(sql)
+        if cur.description:
+            await cur.fetchall()
+        await cur.close()
+    else:
+        await conn.execute(sql)
+
+
+async def query_value(engine, conn, sql):
+    if engine == "mysql":
+        cur = await conn.cursor()
+        await cur.execute(sql)
+        (value,) = await cur.fetchone()
+        await cur.close()
+        return value
+    return (await (await conn.execute(sql)).fetchone())[0]
+
+
+async def setup(engine, conn, spot):
+    if engine == "mysql":
+        await async_execute_mysql_script(conn, spot.setup[engine])
+    else:
+        await async_execute_postgresql_script(conn, spot.setup[engine])
+    await conn.commit()
+
+
+async def simulate(
+    engine,
+    connect,
+    monitor,
+    spot,
+    sessions,
+    hot_rows=1,
+    hold=0.0,
+    interval=0.05,
+    connect_concurrency=100,
+    timeout=60.0,
+):
+    """
+    connect() は autocommit でない新しいコネクションを返すコルーチン関数
+    monitor は確認用のコネクション (autocommit、MySQL は PROCESS 権限が必要)
+    """
+    if not 1 <= hot_rows <= len(spot.keys):
+        raise ValueError(f"hot_rows must be between 1 and {len(spot.keys)}")
+    keys = spot.keys[:hot_rows]
+    depth_query = (
+        MYSQL_QUEUE_DEPTH_QUERY if engine == "mysql" else POSTGRESQL_QUEUE_DEPTH_QUERY
+    )
+
+    holder = await connect()
+    await setup(engine, holder, spot)
+
+    # 接続を先に張っておき、ロック待ちの開始をそろえる
+    semaphore = asyncio.Semaphore(connect_concurrency)
+
+    async def open_session():
+        async with semaphore:
+            return await connect()
+
+    waiters = await asyncio.gather(*[open_session() for _ in range(sessions)])
+    await execute(engine, holder, spot.holder.format(keys=", ".join(map(str, keys))))
+
+    outcomes = {}
+    finished_at = []
+
+    async def wait_and_commit(index, conn):
+        sql = spot.waiter.format(key=keys[index % len(keys)], n=KEY_BASE + index)
+        try:
+            await execute(engine, conn, sql)
+            if hold:
+                await asyncio.sleep(hold)
+            await conn.commit()
+            outcome = "ok"
+        except (connector.Error, psycopg.Error) as e:
+            outcome = classify_error(e) or "error"
+            await conn.rollback()
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        finished_at.append(time.monotonic())
+
+    started = time.monotonic()
+    timeline = []
+
+    async def sample_depth():
+        depth = await query_value(engine, monitor, depth_query)
+        timeline.append((round(time.monotonic() - started, 4), depth))
+        return depth
+
+    tasks = [
+        asyncio.create_task(wait_and_commit(index, conn))
+        for index, conn in enumerate(waiters)
+    ]
+
+    # 全セッションがロック待ちになる (またはロック待ちにならずに終わる) まで待ち行列を伸ばす
+    memory = None
+    deadline = started + timeout
+    while time.monotonic() < deadline:
+        depth = await sample_depth()
+        if depth + len(finished_at) >= sessions:
+            break
+        await asyncio.sleep(interval)
+    peak = max((depth for _, depth in timeline), default=0)
+    if engine == "mysql":
+        memory = await query_value(engine, monitor, MYSQL_WAITING_MEMORY_QUERY)
+
+    released_at = time.monotonic()
+    await holder.commit()
+    while not all(task.done() for task in tasks):
+        await sample_depth()
+        await asyncio.sleep(interval)
+    await asyncio.gather(*tasks)
+    await sample_depth()
+
+    for conn in [holder, *waiters]:
+        await conn.close()
+
+    return {
+        "engine": engine,
+        "spot": spot.name,
+        "sessions": sessions,
+        "hot_rows": hot_rows,
+        "peak_queue_depth": peak,
+        "time_to_drain": (max(finished_at) - released_at if finished_at else 0.0),
+        "memory_per_waiting_session": float(memory) if memory is not None else None,
+        "outcomes": outcomes,
+        "queue_depth": timeline,
+    }
+
+
+async def connect_mysql_async(root=False, autocommit=False, lock_wait_timeout=None):
+    conn = await aio_connector.connect(**mysql_connect_params(root=root))
+    if lock_wait_timeout is not None:
+        cur = await conn.cursor()
+        await cur.execute(f"SET innodb_lock_wait_timeout = {int(lock_wait_timeout)}")
+        await cur.close()
+    await conn.set_autocommit(autocommit)
+    return conn
+
+
+async def connect_postgresql_async(autocommit=False, lock_wait_timeout=None):
+    conn = await psycopg.AsyncConnection.connect(
+        conninfo=postgresql_conninfo(), autocommit=True
+    )
+    if lock_wait_timeout is not None:
+        await conn.execute(f"SET lock_timeout = '{int(lock_wait_timeout)}s'")
+    await conn.set_autocommit(autocommit)
+    return conn
+
+
+async def run(args):
+    if args.engine == "mysql":
+        monitor = await connect_mysql_async(root=True, autocommit=True)
+
+        def connect():
+            return connect_mysql_async(lock_wait_timeout=args.lock_wait_timeout)
+
+    else:
+        monitor = await connect_postgresql_async(autocommit=True)
+
+        def connect():
+            return connect_postgresql_async(lock_wait_timeout=args.lock_wait_timeout)
+
+    try:
+        return await simulate(
+            args.engine,
+            connect,
+            monitor,
+            SPOTS[args.spot],
+            args.sessions,
+            hot_rows=args.hot_rows,
+            hold=args.hold,
+            interval=args.interval,
+            connect_concurrency=args.connect_concurrency,
+        )
+    finally:
+        await monitor.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", choices=("mysql", "postgresql"))
+    parser.add_argument("--spot", choices=SPOTS, default="t1_row")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--hot-rows", type=int, default=1)
+    parser.add_argument("--hold", type=float, default=0.0)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--lock-wait-timeout", type=float, default=120)
+    parser.add_argument("--out", default="-")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    if args.out == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+"""
+文ごとの実行時間とロック待ち時間のヒストグラム
+
+環境変数 STATEMENT_STATS に出力先のパスを指定すると、テストの基底クラスが払い出すコネクションの
+カーソルの execute を計測し、終了時に JSON で書き出す
+
+    STATEMENT_STATS=bench_results/statement_stats.json python -m unittest discover
+    STATEMENT_STATS=bench_results/statement_stats.json python runner.py -j 4
+
+- 文はリテラルを ? に置き換えたフィンガープリントごとに、結果 (ok / timeout / deadlock /
+  serialization / error) で分けて集計する
+- wall はクライアントから見た実行時間、lock はサーバーが記録したロック待ち時間
+  (MySQL の performance_schema.events_statements_history.LOCK_TIME。8.0.28 以降は行ロックの待ちを含む)
+- PostgreSQL は文ごとのロック待ち時間を取れないので、書き出すときに pg_stat_statements の
+  集計 (calls / total_exec_time / max_exec_time) を同じフィンガープリントに付ける
+"""
+
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from os import environ
+
+import psycopg
+from mysql import connector
+from tabulate import tabulate
+
+STATEMENT_STATS_ENV = "STATEMENT_STATS"
+
+# 相対誤差が 1 / 2^(SUB_BUCKET_BITS - 1) 以下になるように値を丸める
+SUB_BUCKET_BITS = 8
+SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+
+FINGERPRINT_PATTERNS = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), "?"),
+    (re.compile(r"\$\d+|%s|%\(\w+\)s"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"\(\?(?:, ?\?)*\)(?:, ?\(\?(?:, ?\?)*\))+"), "(...)"),
+    (re.compile(r"\(\?(?:, ?\?)+\)"), "(...)"),
+]
+
+MYSQL_LOCK_TIME_QUERY = """
+select
+    h.LOCK_TIME
+from
+    performance_schema.events_statements_history h
+    join performance_schema.threads t on (t.THREAD_ID = h.THREAD_ID)
+where
+    t.PROCESSLIST_ID = %s
+order by
+    h.EVENT_ID desc
+limit 1
+"""
+
+POSTGRESQL_STATEMENTS_QUERY = """
+select
+    s.query,
+    s.calls,
+    s.total_exec_time,
+    s.max_exec_time
+from
+    pg_stat_statements s
+    join pg_database d on (d.oid = s.dbid)
+where
+    d.datname = current_database()
+"""
+
+
+def fingerprint(sql):
+    """
+    リテラルやパラメーターを ? に置き換え、空白をまとめて小文字にする
+    """
+    text = sql.strip().rstrip(";")
+    for pattern, replacement in FINGERPRINT_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text.strip().lower()
+
+
+def bucket_index(value):
+    if value < 2 * SUB_BUCKET_HALF:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return shift * SUB_BUCKET_HALF + (value >> shift)
+
+
+def bucket_range(index):
+    """
+    バケットに入る値の範囲 (下限, 上限) を返す
+    """
+    if index < 2 * SUB_BUCKET_HALF:
+        return index, index
+    shift, offset = divmod(index - 2 * SUB_BUCKET_HALF, SUB_BUCKET_HALF)
+    shift += 1
+    lowest = (SUB_BUCKET_HALF + offset) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+
+class Histogram:
+    """
+    マイクロ秒単位の値を対数 - 線形のバケットで数える (HdrHistogram と同じ考え方)
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        value = max(round(seconds * 1_000_000), 0)
+        index = bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        """
+        p パーセンタイルの値 (マイクロ秒、バケットの上限)
+        """
+        if not self.count:
+            return None
+        rank = max(1, -(-self.count * p // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(bucket_range(index)[1], self.max)
+        return self.max
+
+    def summary(self):
+        """
+        ミリ秒単位の要約
+        """
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count / 1000,
+            "min_ms": self.min / 1000,
+            "p50_ms": self.percentile(50) / 1000,
+            "p90_ms": self.percentile(90) / 1000,
+            "p99_ms": self.percentile(99) / 1000,
+            "max_ms": self.max / 1000,
+        }
+
+    def to_dict(self):
+        return {
+            **self.summary(),
+            "buckets": [
+                [*bucket_range(index), count]
+                for index, count in sorted(self.counts.items())
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        for lowest, _, count in data["buckets"]:
+            histogram.counts[bucket_index(lowest)] = count
+        histogram.count = data["count"]
+        if histogram.count:
+            histogram.total = round(data["mean_ms"] * 1000 * histogram.count)
+            histogram.min = round(data["min_ms"] * 1000)
+            histogram.max = round(data["max_ms"] * 1000)
+        return histogram
+
+
+class StatementStats:
+    """
+    (エンジン, フィンガープリント, 結果) ごとの wall / lock のヒストグラム
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.server = {}
+        # 書き出す前に呼ぶ関数 (サーバー側の集計の取り込みなど)
+        self.collectors = set()
+        self._lock = threading.Lock()
+
+    def entry(self, key):
+        if key not in self.entries:
+            self.entries[key] = {"wall": Histogram(), "lock": Histogram()}
+        return self.entries[key]
+
+    def record(self, engine, sql, outcome, wall, lock=None):
+        key = (engine, fingerprint(sql), outcome)
+        with self._lock:
+            entry = self.entry(key)
+            entry["wall"].record(wall)
+            if lock is not None:
+                entry["lock"].record(lock)
+
+    def add_server(self, key, calls, total_exec_ms, max_exec_ms):
+        server = self.server.setdefault(
+            key, {"calls": 0, "total_exec_ms": 0.0, "max_exec_ms": 0.0}
+        )
+        server["calls"] += calls
+        server["total_exec_ms"] += total_exec_ms
+        server["max_exec_ms"] = max(server["max_exec_ms"], max_exec_ms)
+
+    def merge(self, other):
+        with self._lock:
+            for key, entry in other.entries.items():
+                for name, histogram in entry.items():
+                    self.entry(key)[name].merge(histogram)
+            for key, server in other.server.items():
+                self.add_server(key, **server)
+
+    def collect_postgresql(self, conn):
+        """
+        pg_stat_statements の集計をフィンガープリントごとに取り込む (拡張がなければ何もしない)
+        """
+        try:
+            rows = conn.execute(POSTGRESQL_STATEMENTS_QUERY).fetchall()
+        except psycopg.Error:
+            conn.rollback()
+            return
+        conn.rollback()
+        with self._lock:
+            for query, calls, total, maximum in rows:
+                self.add_server(
+                    ("postgresql", fingerprint(query)), calls, total, maximum
+                )
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "statements": [
+                    {
+                        "engine": engine,
+                        "fingerprint": statement,
+                        "outcome": outcome,
+                        "wall": entry["wall"].to_dict(),
+                        "lock": entry["lock"].to_dict(),
+                        "server": self.server.get((engine, statement)),
+                    }
+                    for (engine, statement, outcome), entry in sorted(
+                        self.entries.items()
+                    )
+                ]
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for statement in data["statements"]:
+            key = (statement["engine"], statement["fingerprint"], statement["outcome"])
+            stats.entries[key] = {
+                name: Histogram.from_dict(statement[name]) for name in ("wall", "lock")
+            }
+            if statement["server"] is not None:
+                stats.server[key[:2]] = statement["server"]
+        return stats
+
+    def collect(self):
+        for collector in list(self.collectors):
+            collector(self)
+
+    def dump(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summarize(self, limit=20):
+        """
+        wall の p99 が大きい順に表にする
+        """
+        rows = []
+        for statement in self.to_dict()["statements"]:
+            wall, lock = statement["wall"], statement["lock"]
+            rows.append(
+                {
+                    "engine": statement["engine"],
+                    "outcome": statement["outcome"],
+                    "count": wall["count"],
+                    "wall_p50_ms": wall.get("p50_ms"),
+                    "wall_p99_ms": wall.get("p99_ms"),
+                    "wall_max_ms": wall.get("max_ms"),
+                    "lock_p99_ms": lock.get("p99_ms"),
+                    "statement": statement["fingerprint"][:60],
+                }
+            )
+        rows.sort(key=lambda row: -(row["wall_p99_ms"] or 0))
+        return tabulate(rows[:limit], headers="keys", tablefmt="psql", floatfmt=".2f")
+
+
+class MySqlLockTime:
+    """
+    直前に実行した文の LOCK_TIME を root のコネクションで読む
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def __call__(self, connection_id):
+        with self._lock:
+            with self.conn.cursor() as cur:
+                cur.execute(MYSQL_LOCK_TIME_QUERY, (connection_id,))
+                row = cur.fetchone()
+        # ピコ秒
+        return row[0] / 1e12 if row and row[0] is not None else None
+
+
+class InstrumentedCursor:
+    """
+    execute / executemany の時間と結果を記録するカーソルのラッパー
+    """
+
+    def __init__(self, cursor, engine, stats, classify, session_id, lock_time=None):
+        self._cursor = cursor
+        self._engine = engine
+        self._stats = stats
+        self._classify = classify
+        self._session_id = session_id
+        self._lock_time = lock_time
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+    def _measure(self, method, sql, *args, **kwargs):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            result = method(sql, *args, **kwargs)
+        except (connector.Error, psycopg.Error) as e:
+            outcome = self._classify(e) or "error"
+            raise
+        finally:
+            wall = time.perf_counter() - started
+            lock = self._lock_time(self._session_id) if self._lock_time else None
+            self._stats.record(self._engine, str(sql), outcome, wall, lock)
+        return self if result is self._cursor else result
+
+    def execute(self, sql, *args, **kwargs):
+        return self._measure(self._cursor.execute, sql, *args, **kwargs)
+
+    def executemany(self, sql, *args, **kwargs):
+        return self._measure(self._cursor.executemany, sql, *args, **kwargs)
+
+
+def instrument(conn, engine, stats, classify, lock_time=None):
+    """
+    conn.cursor() (psycopg の conn.execute も含む) が計測するカーソルを返すようにする
+    classify はエラーを結果の名前にする関数 (util.classify_error)
+    """
+    if "cursor" in vars(conn):
+        return conn
+    cursor = type(conn).cursor
+    session_id = conn.connection_id if engine == "mysql" else conn.info.backend_pid
+
+    def instrumented_cursor(*args, **kwargs):
+        return InstrumentedCursor(
+            cursor(conn, *args, **kwargs),
+            engine,
+            stats,
+            classify,
+            session_id,
+            lock_time,
+        )
+
+    conn.cursor = instrumented_cursor
+    return conn
+
+
+def uninstrument(conn):
+    vars(conn).pop("cursor", None)
+    return conn
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def current_stats():
+    """
+    STATEMENT_STATS が指定されていればプロセス全体で共有する StatementStats を返す
+    """
+    global _stats
+    if not environ.get(STATEMENT_STATS_ENV):
+        return None
+    with _stats_lock:
+        if _stats is None:
+            _stats = StatementStats()
+            atexit.register(dump_current_stats)
+        return _stats
+
+
+def take_current_stats():
+    """
+    共有している StatementStats を取り出す (以降の終了時の書き出しはしない)
+    """
+    global _stats
+    with _stats_lock:
+        stats, _stats = _stats, None
+    return stats
+
+
+def dump_current_stats():
+    stats = take_current_stats()
+    if stats is None:
+        return
+    stats.collect()
+    stats.dump(environ[STATEMENT_STATS_ENV])
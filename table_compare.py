@@ -0,0 +1,158 @@
+"""
+assertTableEqual の比較
+
+期待値の psql 風の表 (format_table と同じ形式) を一度だけパースしてキャッシュし、
+実際の行とセルごとに比べる。表の文字列を組み立てるのは一致しなかったときだけ
+
+    | {p_a} | transactionid | {t_a} |
+
+のようにセル全体が {名前} のセルは、compare_table(..., p_a=pid, t_a=txid) で渡した値と比べる
+列の幅や左寄せ / 右寄せは比較に影響しない
+"""
+
+import re
+from functools import lru_cache
+
+from tabulate import tabulate
+
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+class ParsedTable:
+    def __init__(self, headers, rows):
+        self.headers = headers
+        self.rows = rows
+        # プレースホルダーを含むセルの位置 (行, 列) -> 名前
+        self.placeholders = {
+            (i, j): match.group(1)
+            for i, row in enumerate(rows)
+            for j, cell in enumerate(row)
+            if (match := PLACEHOLDER.fullmatch(cell))
+        }
+
+
+def split_row(line):
+    return tuple(cell.strip() for cell in line.strip()[1:-1].split("|"))
+
+
+@lru_cache(maxsize=None)
+def parse_table(text):
+    """
+    psql 風の表をヘッダーと行 (セルの文字列のタプル) に分ける。形式が崩れている場合は None
+    """
+    lines = [line for line in text.strip().splitlines() if line.strip()]
+    if not lines:
+        return ParsedTable((), [])
+    # 罫線 (+---+) と、ヘッダーの下の区切り (|---+---|) を除く
+    rows = [
+        split_row(line)
+        for line in lines
+        if line.lstrip().startswith("|") and not line.lstrip().startswith("|-")
+    ]
+    if not rows or any(len(row) != len(rows[0]) for row in rows):
+        return None
+    return ParsedTable(rows[0], rows[1:])
+
+
+def format_cell(value):
+    """
+    tabulate と同じ表記でセルを文字列にする
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return format(value, "g")
+    return str(value)
+
+
+def format_table(rows):
+    """
+    dict の行のリストを assertTableEqual で比べる形式 (psql 風) の文字列にする
+    """
+    return tabulate(rows, headers="keys", tablefmt="psql", stralign="left")
+
+
+def render_expected(text, values):
+    return PLACEHOLDER.sub(
+        lambda m: format_cell(values.get(m.group(1), m.group(0))), text.strip()
+    )
+
+
+def expected_rows(expected, values):
+    rows = []
+    for i, row in enumerate(expected.rows):
+        cells = list(row)
+        for j, cell in enumerate(cells):
+            name = expected.placeholders.get((i, j))
+            if name is not None and name in values:
+                cells[j] = format_cell(values[name])
+        rows.append(dict(zip(expected.headers, cells)))
+    return rows
+
+
+def diff_cells(expected, actual, values):
+    """
+    一致しないセルの説明のリストを返す (一致する場合は空)
+    """
+    if not actual:
+        return (
+            [] if not expected.rows else [f"expected {len(expected.rows)} rows but 0"]
+        )
+
+    if isinstance(actual[0], dict):
+        headers = tuple(actual[0])
+        if headers != expected.headers:
+            return [f"expected columns {list(expected.headers)} but {list(headers)}"]
+        actual = [tuple(row.values()) for row in actual]
+
+    differences = []
+    if len(actual) != len(expected.rows):
+        differences.append(f"expected {len(expected.rows)} rows but {len(actual)}")
+    for i, (expected_row, actual_row) in enumerate(zip(expected.rows, actual)):
+        if len(actual_row) != len(expected_row):
+            differences.append(
+                f"row {i + 1}: expected {len(expected_row)} columns "
+                f"but {len(actual_row)}"
+            )
+            continue
+        for j, (expected_cell, value) in enumerate(zip(expected_row, actual_row)):
+            name = expected.placeholders.get((i, j))
+            if name is not None and name in values:
+                expected_cell = format_cell(values[name])
+            actual_cell = format_cell(value)
+            if expected_cell != actual_cell:
+                column = expected.headers[j] if expected.headers else j + 1
+                differences.append(
+                    f"row {i + 1}, {column}: expected {expected_cell!r} "
+                    f"but {actual_cell!r}"
+                )
+    return differences
+
+
+def compare_table(expected, actual, **values):
+    """
+    一致する場合は None、一致しない場合はセルごとの差分と両方の表を含むメッセージを返す
+    """
+    parsed = parse_table(expected)
+    differences = (
+        diff_cells(parsed, actual, values)
+        if parsed is not None
+        else ["expected table could not be parsed"]
+    )
+    if not differences:
+        return None
+
+    # セルの表記が tabulate と違う値 (Decimal など) もあるので、最後に表全体でも比べる
+    actual_table = format_table(actual)
+    if render_expected(expected, values) == actual_table:
+        return None
+    # 表示用に期待値も同じ形式で組み立て直す (列の幅をそろえる)
+    expected_table = (
+        format_table(expected_rows(parsed, values))
+        if parsed is not None
+        else expected.strip()
+    )
+    return "\n".join(
+        differences
+        + ["", f"Expected:\n{expected_table}", "", f"Actual:\n{actual_table}"]
+    )
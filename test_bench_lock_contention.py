@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+from bench_lock_contention import percentile, run_scenario
+from lock_scenarios import SCENARIOS
+from util import MySqlBaseTest, PostgresqlBaseTest
+
+
+class BenchLockContentionTest(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+
+def assert_result(test, result, engine):
+    test.assertEqual(
+        (result["engine"], result["scenario"], result["workers"]),
+        (engine, "record", 2),
+    )
+    test.assertGreaterEqual(result["elapsed"], 0.5)
+    test.assertGreater(result["committed"], 0)
+    test.assertEqual(sum(result["outcomes"].values()), result["transactions"])
+    test.assertLessEqual(result["latency_ms"]["p50"], result["latency_ms"]["p99"])
+    test.assertLessEqual(result["latency_ms"]["p99"], result["latency_ms"]["max"])
+    test.assertGreaterEqual(result["lock_wait"]["seconds"], 0.0)
+
+
+class MySqlBenchLockContentionTest(MySqlBaseTest):
+    def test_run_scenario(self):
+        result = run_scenario("mysql", SCENARIOS["record"], 2, 0.5)
+        assert_result(self, result, "mysql")
+
+
+class PostgresqlBenchLockContentionTest(PostgresqlBaseTest):
+    def test_run_scenario(self):
+        result = run_scenario("postgresql", SCENARIOS["record"], 2, 0.5)
+        assert_result(self, result, "postgresql")
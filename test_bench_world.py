@@ -0,0 +1,42 @@
+import random
+from argparse import Namespace
+from collections import Counter
+from unittest import TestCase
+
+from bench_world import WorldData, WorldWorker, Zipf, language_prefix
+
+
+class ZipfTest(TestCase):
+    def test_uniform(self):
+        zipf = Zipf(4, 0)
+        rng = random.Random(0)
+        counts = Counter(zipf.sample(rng) for _ in range(40000))
+        self.assertEqual(sorted(counts), [0, 1, 2, 3])
+        for count in counts.values():
+            self.assertAlmostEqual(count / 40000, 0.25, delta=0.02)
+
+    def test_skewed(self):
+        zipf = Zipf(100, 1.2)
+        rng = random.Random(0)
+        counts = Counter(zipf.sample(rng) for _ in range(40000))
+        self.assertTrue(all(0 <= rank < 100 for rank in counts))
+        self.assertGreater(counts[0], counts[1])
+        self.assertGreater(counts[1], counts[10])
+        # 1 / sum(1 / k^1.2) ≒ 0.278
+        self.assertAlmostEqual(counts[0] / 40000, 0.278, delta=0.02)
+
+
+class WorldWorkerTest(TestCase):
+    def test_code_range(self):
+        # 人口の多い順なので Code の順とは関係がない
+        countries = ["CHN", "IND", "USA", "IDN", "BRA"]
+        world = WorldData(countries, [1], 0)
+        worker = WorldWorker(None, 0, 0, world, Namespace(seed=0, range_width=3))
+        self.assertEqual(worker.code_range("IND"), ("IND", "USA"))
+        self.assertEqual(worker.code_range("BRA"), ("BRA", "IDN"))
+        self.assertEqual(worker.code_range("USA"), ("USA", "USA"))
+
+    def test_language_prefix(self):
+        self.assertEqual(language_prefix(30, 1), 28)
+        self.assertEqual(language_prefix(30, 100000), 24)
+        self.assertEqual(language_prefix(30, 100001), 23)
@@ -0,0 +1,139 @@
+from unittest import TestCase
+
+from blocker_attribution import (
+    BlockerAttribution,
+    HistoryStatement,
+    LockWait,
+    capture_lock_waits,
+)
+from lock_scenarios import T1_SETUP
+from util import MySqlBaseTest
+
+
+def lock_wait(history, waiting_session=2, wait_seconds=1.0, wait_started="t0"):
+    return LockWait(
+        waiting_session=waiting_session,
+        blocking_session=1,
+        schema="mysql",
+        table="t1",
+        index="idx_vallength",
+        mode="X",
+        lock_data="3, 1",
+        index_columns=["val_length"],
+        wait_started=wait_started,
+        wait_seconds=wait_seconds,
+        waiting_sql="INSERT INTO t1 (num, val, val_length) VALUES (10, 'ju', 2)",
+        history=history,
+    )
+
+
+class BlockerAttributionTest(TestCase):
+    def test_blocking_statement(self):
+        wait = lock_wait(
+            [
+                HistoryStatement(1, "UPDATE t1 SET val = 'x' WHERE val_length = 3"),
+                HistoryStatement(2, "COMMIT"),
+                HistoryStatement(3, "SELECT * FROM t2 WHERE id = 1 FOR UPDATE"),
+                HistoryStatement(4, "SELECT * FROM t1 WHERE num = 1 FOR UPDATE"),
+                HistoryStatement(5, "SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE"),
+                HistoryStatement(6, "SELECT * FROM t1 WHERE val_length = 3"),
+            ]
+        )
+        self.assertEqual(
+            wait.blocking_statement.sql,
+            "SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE",
+        )
+
+    def test_in_transaction_wins(self):
+        wait = lock_wait(
+            [
+                HistoryStatement(
+                    1, "SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE", False
+                ),
+                HistoryStatement(2, "DELETE FROM t2", True),
+            ]
+        )
+        self.assertEqual(wait.blocking_statement.sql, "DELETE FROM t2")
+
+    def test_unknown(self):
+        self.assertIsNone(lock_wait([HistoryStatement(1, "BEGIN")]).blocking_statement)
+
+    def test_report(self):
+        for_update = [
+            HistoryStatement(1, "SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE")
+        ]
+        attribution = BlockerAttribution()
+        attribution.add([lock_wait(for_update, wait_seconds=0.5)])
+        # 同じ待ちを後のスナップショットで見た場合は待ち時間を置き換える
+        attribution.add(
+            [
+                lock_wait(for_update, wait_seconds=1.5),
+                lock_wait(for_update, waiting_session=3, wait_seconds=1.0),
+                lock_wait([], waiting_session=4, wait_seconds=0.1),
+            ]
+        )
+        self.assertEqual(
+            attribution.report(),
+            [
+                {
+                    "statement": "select * from t1 where val_length = ? for update",
+                    "waits": 2,
+                    "blocked_seconds": 2.5,
+                    "max_wait_seconds": 1.5,
+                    "locks": ["t1.idx_vallength X"],
+                },
+                {
+                    "statement": None,
+                    "waits": 1,
+                    "blocked_seconds": 0.1,
+                    "max_wait_seconds": 0.1,
+                    "locks": ["t1.idx_vallength X"],
+                },
+            ],
+        )
+
+
+class MySqlBlockerAttributionTest(MySqlBaseTest):
+    def test_capture_lock_waits(self):
+        """
+        idle のまま待たせているセッションの履歴から、ギャップロックを取った FOR UPDATE を見つける
+        """
+        self.setup_tables(T1_SETUP["mysql"])
+        locking = "SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE"
+
+        conn1 = self.create_connection(fresh=True)
+        cur1 = conn1.cursor(buffered=True)
+        cur1.execute("BEGIN")
+        cur1.execute(locking)
+        # 後から実行した、ロックを取らない文は選ばない
+        cur1.execute("SELECT * FROM t1 WHERE num = 5")
+
+        conn2 = self.create_connection()
+        cur2 = conn2.cursor()
+        cur2.execute("BEGIN")
+        thread = self.start_blocking(
+            conn2,
+            cur2.execute,
+            "INSERT INTO t1 (num, val, val_length) VALUES (10, 'ju', 2)",
+        )
+
+        conn_chk = self.create_connection(root=True)
+        conn_chk.autocommit = True
+        waits = capture_lock_waits(conn_chk, schema=self.database)
+        self.assertGreater(len(waits), 0)
+        for wait in waits:
+            self.assertEqual(
+                (wait.waiting_session, wait.blocking_session),
+                (conn2.connection_id, conn1.connection_id),
+            )
+            self.assertEqual((wait.table, wait.index), ("t1", "idx_vallength"))
+            self.assertEqual(wait.index_columns, ["val_length"])
+            self.assertIn("INSERT INTO t1", wait.waiting_sql)
+            # events_transactions_current で今のトランザクションの中の文と確認できる
+            (statement,) = [h for h in wait.history if h.sql == locking]
+            self.assertTrue(statement.in_transaction)
+            self.assertEqual(wait.blocking_statement.sql, locking)
+
+        conn1.rollback()
+        thread.join()
+        conn2.rollback()
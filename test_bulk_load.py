@@ -0,0 +1,80 @@
+from dataclasses import replace
+from types import GeneratorType
+from unittest import TestCase
+
+from bulk_load import TABLES, bulk_load, chunks, generate_rows, mysql_lines
+from util import MySqlBaseTest, PostgresqlBaseTest
+
+
+class BulkLoadTest(TestCase):
+    def test_generate_rows(self):
+        rows = generate_rows(TABLES["t1"], 3, start=10)
+        self.assertIsInstance(rows, GeneratorType)
+        rows = list(rows)
+        self.assertEqual([num for num, _, _ in rows], [11, 12, 13])
+        for _, val, val_length in rows:
+            self.assertEqual(len(val), val_length)
+        self.assertEqual(rows, list(generate_rows(TABLES["t1"], 3, start=10)))
+
+    def test_chunks(self):
+        self.assertEqual(list(chunks(25, 10)), [(0, 10), (10, 10), (20, 5)])
+        self.assertEqual(list(chunks(0, 10)), [])
+
+    def test_mysql_lines(self):
+        self.assertEqual(
+            list(mysql_lines([(1, "a\tb", None), (2, "c\\d\ne", 3)])),
+            ["1\ta\\tb\t\\N\n", "2\tc\\\\d\\ne\t3\n"],
+        )
+
+    def test_index_sql(self):
+        table = TABLES["t1"]
+        self.assertEqual(
+            table.index_sql("mysql"),
+            ["ALTER TABLE `t1` ADD INDEX `idx_vallength` (`val_length`)"],
+        )
+        self.assertEqual(
+            table.index_sql("postgresql"),
+            [
+                "alter table t1 add primary key (num)",
+                "create index idx_vallength on t1 (val_length)",
+            ],
+        )
+
+
+# PostgreSQL のインデックス名はスキーマ内で一意なので t1 の idx_vallength と分ける
+BULK_T1 = replace(
+    TABLES["t1"], name="bulk_t1", indexes={"idx_bulk_vallength": ["val_length"]}
+)
+
+
+class MySqlBulkLoadTest(MySqlBaseTest):
+    def test_bulk_load(self):
+        bulk_load("mysql", BULK_T1, 25000, chunk_rows=10000)
+
+        conn = self.create_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*), COUNT(DISTINCT num), MAX(num) FROM bulk_t1")
+        self.assertEqual(cur.fetchall(), [(25000, 25000, 25000)])
+        cur.execute(
+            "SELECT INDEX_NAME FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = database() AND TABLE_NAME = 'bulk_t1' "
+            "ORDER BY INDEX_NAME"
+        )
+        self.assertEqual(cur.fetchall(), [("idx_bulk_vallength",), ("PRIMARY",)])
+        conn.rollback()
+
+
+class PostgresqlBulkLoadTest(PostgresqlBaseTest):
+    def test_bulk_load(self):
+        bulk_load("postgresql", BULK_T1, 25000, chunk_rows=10000)
+
+        conn = self.create_connection()
+        cur = conn.cursor()
+        cur.execute("select count(*), count(distinct num), max(num) from bulk_t1")
+        self.assertEqual(cur.fetchall(), [(25000, 25000, 25000)])
+        cur.execute(
+            "select indexname from pg_indexes where tablename = 'bulk_t1' "
+            "order by indexname"
+        )
+        self.assertEqual(cur.fetchall(), [("bulk_t1_pkey",), ("idx_bulk_vallength",)])
+        conn.rollback()
@@ -0,0 +1,172 @@
+import random
+from unittest import TestCase
+
+import psycopg
+from mysql import connector
+
+from deadlock_harness import (
+    POLICIES,
+    DeadlockRecorder,
+    LockStep,
+    cross_update_steps,
+    describe_innodb_deadlock,
+    gap_insert_steps,
+)
+from lock_scenarios import T1_SETUP
+from pg_log import PostgresqlLogTailer
+from util import MySqlBaseTest, PostgresqlBaseTest, classify_error
+
+
+class RetryPolicyTest(TestCase):
+    def test_ordered(self):
+        steps = [LockStep(5, "b"), LockStep(1, "a"), LockStep(5, "c")]
+        self.assertEqual(
+            [step.sql for step in POLICIES["ordered"].prepare(steps)], ["a", "b", "c"]
+        )
+        self.assertEqual(POLICIES["immediate"].prepare(steps), steps)
+
+    def test_backoff(self):
+        rng = random.Random(0)
+        self.assertEqual(POLICIES["immediate"].delay(3, rng), 0.0)
+        backoff = POLICIES["backoff"]
+        for attempt in range(10):
+            delay = backoff.delay(attempt, rng)
+            self.assertGreaterEqual(delay, 0.0)
+            self.assertLessEqual(delay, min(0.1, 0.001 * 2**attempt))
+
+    def test_steps(self):
+        rng = random.Random(0)
+        for _ in range(20):
+            first, second = cross_update_steps(rng, 0)
+            self.assertNotEqual(first.key, second.key)
+            self.assertEqual(len({step.key for step in gap_insert_steps(rng, 0)}), 1)
+
+
+class MySqlDeadlockHarnessTest(MySqlBaseTest):
+    def run_deadlock(self, first, second):
+        """
+        conn1 が first[0]、conn2 が second[0] を実行した後、conn2 の second[1] を待たせてから
+        conn1 の first[1] を実行する。デッドロックでロールバックされたセッションを返す
+        """
+        self.setup_tables(T1_SETUP["mysql"])
+        conn1 = self.create_connection()
+        cur1 = conn1.cursor(buffered=True)
+        conn2 = self.create_connection()
+        cur2 = conn2.cursor(buffered=True)
+        cur1.execute("BEGIN")
+        cur1.execute(first[0])
+        cur2.execute("BEGIN")
+        cur2.execute(second[0])
+
+        errors = {}
+
+        def operation2():
+            try:
+                cur2.execute(second[1])
+            except connector.Error as e:
+                errors[conn2.connection_id] = classify_error(e)
+
+        thread = self.start_blocking(conn2, operation2)
+        try:
+            cur1.execute(first[1])
+        except connector.Error as e:
+            errors[conn1.connection_id] = classify_error(e)
+        if conn1.connection_id not in errors:
+            cur1.execute("ROLLBACK")
+        thread.join()
+        cur2.execute("ROLLBACK")
+
+        (victim,) = errors
+        self.assertEqual(errors[victim], "deadlock")
+        return victim, {conn1.connection_id, conn2.connection_id}
+
+    def test_cross_update(self):
+        recorder = DeadlockRecorder("mysql")
+        victim, sessions = self.run_deadlock(
+            [
+                "UPDATE t1 SET val = 'a' WHERE num = 1",
+                "UPDATE t1 SET val = 'a' WHERE num = 2",
+            ],
+            [
+                "UPDATE t1 SET val = 'b' WHERE num = 2",
+                "UPDATE t1 SET val = 'b' WHERE num = 1",
+            ],
+        )
+
+        conn_chk = self.create_connection(root=True)
+        deadlock = self.show_innodb_status(conn_chk.cursor()).deadlock
+        self.assertEqual({trx.thread_id for trx in deadlock.transactions}, sessions)
+        self.assertEqual(deadlock.victim.thread_id, victim)
+        for trx in deadlock.transactions:
+            self.assertEqual(trx.waiting_for.lock_type, "record")
+            self.assertEqual(trx.waiting_for.index, "PRIMARY")
+
+        described = describe_innodb_deadlock(deadlock)
+        self.assertEqual(described["rolled_back"], deadlock.victim.trx_id)
+        self.assertEqual(len(described["transactions"]), 2)
+
+        # 実行前から残っていたデッドロックは含めない
+        self.assertEqual(recorder.collect(), [described])
+        self.assertEqual(DeadlockRecorder("mysql").collect(), [])
+
+    def test_gap_insert(self):
+        """
+        同じギャップのロックは両方が取れるが、INSERT の挿入意図ロックは互いのギャップロックを待つ
+        """
+        steps = [step.sql for step in gap_insert_steps(random.Random(0), 0)]
+        victim, sessions = self.run_deadlock(steps, steps)
+
+        conn_chk = self.create_connection(root=True)
+        deadlock = self.show_innodb_status(conn_chk.cursor()).deadlock
+        self.assertEqual(deadlock.victim.thread_id, victim)
+        self.assertEqual(
+            {trx.waiting_for.lock_type for trx in deadlock.transactions},
+            {"insert-intention"},
+        )
+
+
+class PostgresqlDeadlockHarnessTest(PostgresqlBaseTest):
+    def test_cross_update(self):
+        self.setup_tables(T1_SETUP["postgresql"])
+        log = PostgresqlLogTailer()
+
+        conn1 = self.create_connection()
+        cur1 = conn1.cursor()
+        cur1.execute("set deadlock_timeout = '100ms'")
+        (pid1,) = cur1.execute("select pg_backend_pid()").fetchone()
+        conn2 = self.create_connection()
+        cur2 = conn2.cursor()
+        cur2.execute("set deadlock_timeout = '100ms'")
+        (pid2,) = cur2.execute("select pg_backend_pid()").fetchone()
+
+        cur1.execute("update t1 set val = 'a' where num = 1")
+        cur2.execute("update t1 set val = 'b' where num = 2")
+
+        errors = {}
+
+        def operation2():
+            try:
+                cur2.execute("update t1 set val = 'b' where num = 1")
+            except psycopg.Error as e:
+                errors[pid2] = classify_error(e)
+
+        thread = self.start_blocking(conn2, operation2)
+        try:
+            cur1.execute("update t1 set val = 'a' where num = 2")
+        except psycopg.Error as e:
+            errors[pid1] = classify_error(e)
+        thread.join()
+        conn1.rollback()
+        conn2.rollback()
+
+        (victim,) = errors
+        self.assertEqual(errors[victim], "deadlock")
+
+        event = log.wait_for(pid=victim, kind="deadlock")
+        deadlock = event.deadlock
+        self.assertEqual(deadlock.victim, victim)
+        self.assertEqual(
+            {(wait.pid, wait.blocked_by) for wait in deadlock.waits},
+            {(pid1, pid2), (pid2, pid1)},
+        )
+        self.assertEqual(set(deadlock.queries), {pid1, pid2})
@@ -0,0 +1,162 @@
+from unittest import TestCase
+
+from mysql import connector
+
+from gap_lock_index import GapLockIndex, parse_lock_data, read_index_keys
+from lock_scenarios import T1_SETUP
+from util import LockSnapshot, MySqlBaseTest, classify_error
+
+# test_innodb_layer_lock の SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE で取られるロック
+VALLENGTH_FOR_UPDATE = [
+    ("idx_vallength", "X", "3, 1"),
+    ("idx_vallength", "X", "3, 2"),
+    ("idx_vallength", "X,GAP", "4, 5"),
+    ("PRIMARY", "X,REC_NOT_GAP", "1"),
+    ("PRIMARY", "X,REC_NOT_GAP", "2"),
+]
+
+
+def snapshot(locks, trx="100"):
+    return LockSnapshot.from_rows(
+        [(1, trx, "TABLE", "test", "t1", None, "IX", True, None)]
+        + [
+            (1, trx, "RECORD", "test", "t1", index, mode, True, data)
+            for index, mode, data in locks
+        ]
+    )
+
+
+class ParseLockDataTest(TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_lock_data("3, 1"), (3, 1))
+        self.assertEqual(parse_lock_data("'one', 1"), ("one", 1))
+        self.assertEqual(parse_lock_data("'a, b', NULL"), ("a, b", None))
+        self.assertIsNone(parse_lock_data("supremum pseudo-record"))
+
+
+class GapLockIndexTest(TestCase):
+    def test_insert_into_gap(self):
+        index = GapLockIndex.from_snapshot(snapshot(VALLENGTH_FOR_UPDATE))
+
+        # infimum から (3, 1) までのギャップ
+        (blocker,) = index.insert_blockers("t1", "idx_vallength", (2, 10))
+        self.assertEqual(
+            (blocker.trx, blocker.kind, blocker.key), ("100", "next-key", (3, 1))
+        )
+        # (3, 2) から (4, 5) までのギャップ
+        (blocker,) = index.insert_blockers("t1", "idx_vallength", (3, 10))
+        self.assertEqual((blocker.kind, blocker.key), ("gap", (4, 5)))
+        # (4, 5) より後ろはロックされていない
+        self.assertEqual(index.insert_blockers("t1", "idx_vallength", (4, 10)), [])
+        self.assertEqual(index.insert_blockers("t1", "idx_vallength", (6, 10)), [])
+        # 自分のトランザクションのロックでは待たない
+        self.assertEqual(
+            index.insert_blockers("t1", "idx_vallength", (2, 10), trx="100"), []
+        )
+
+    def test_would_block_insert(self):
+        index = GapLockIndex.from_snapshot(snapshot(VALLENGTH_FOR_UPDATE))
+        self.assertEqual(
+            len(
+                index.would_block_insert(
+                    "t1", {"PRIMARY": (10,), "idx_vallength": (2, 10)}
+                )
+            ),
+            1,
+        )
+        # REC_NOT_GAP はギャップを守らない
+        self.assertEqual(
+            index.would_block_insert("t1", {"PRIMARY": (0,), "idx_vallength": (6, 0)}),
+            [],
+        )
+
+    def test_records(self):
+        """
+        ロックのないレコードが間にあれば、そのレコードの手前に INSERT しても待たない
+        """
+        locks = [("PRIMARY", "X", "5")]
+        conservative = GapLockIndex.from_snapshot(snapshot(locks))
+        exact = GapLockIndex.from_snapshot(
+            snapshot(locks), records={("t1", "PRIMARY"): [(1,), (2,), (3,), (5,)]}
+        )
+        self.assertEqual(len(conservative.insert_blockers("t1", "PRIMARY", (0,))), 1)
+        self.assertEqual(exact.insert_blockers("t1", "PRIMARY", (0,)), [])
+        self.assertEqual(len(exact.insert_blockers("t1", "PRIMARY", (4,))), 1)
+
+    def test_supremum(self):
+        index = GapLockIndex.from_snapshot(
+            snapshot(
+                [("PRIMARY", "X", "5"), ("PRIMARY", "X", "supremum pseudo-record")]
+            )
+        )
+        self.assertEqual(len(index.insert_blockers("t1", "PRIMARY", (100,))), 1)
+
+    def test_range_blockers(self):
+        index = GapLockIndex.from_snapshot(snapshot(VALLENGTH_FOR_UPDATE))
+        self.assertEqual(
+            [lock.key for lock in index.range_blockers("t1", "idx_vallength", (3,))],
+            [(3, 1), (3, 2)],
+        )
+        # GAP のロックはレコードの読み込みを待たせない
+        self.assertEqual(index.range_blockers("t1", "idx_vallength", (4,), (9,)), [])
+        self.assertEqual(
+            [lock.key for lock in index.range_blockers("t1", "PRIMARY", (0,), (1,))],
+            [(1,)],
+        )
+
+    def test_shared(self):
+        index = GapLockIndex.from_snapshot(
+            snapshot([("PRIMARY", "S,REC_NOT_GAP", "1")])
+        )
+        self.assertEqual(index.range_blockers("t1", "PRIMARY", (1,), mode="S"), [])
+        self.assertEqual(len(index.range_blockers("t1", "PRIMARY", (1,), mode="X")), 1)
+        # 同じキーの INSERT は重複チェックの S ロックを取るので、S のロックとはぶつからない
+        self.assertEqual(index.insert_blockers("t1", "PRIMARY", (1,)), [])
+
+
+class MySqlGapLockIndexTest(MySqlBaseTest):
+    def test_predict_insert(self):
+        """
+        スナップショットから予測した結果が、実際に INSERT したときに待たされるかどうかと一致すること
+        """
+        self.setup_tables(T1_SETUP["mysql"])
+        conn_chk = self.create_connection(root=True)
+
+        conn1 = self.create_connection()
+        cur1 = conn1.cursor()
+        cur1.execute("BEGIN")
+        cur1.execute("SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE")
+        cur1.fetchall()
+
+        records = {
+            ("t1", index): read_index_keys(conn_chk, "t1", index)
+            for index in ("PRIMARY", "idx_vallength")
+        }
+        index = GapLockIndex.from_snapshot(self.lock_snapshot(conn_chk), records)
+
+        conn2 = self.create_connection()
+        cur2 = conn2.cursor()
+        cur2.execute("SET innodb_lock_wait_timeout = 1")
+        for num, val_length in [(10, 2), (11, 3), (12, 4), (13, 6)]:
+            with self.subTest(val_length=val_length):
+                blockers = index.would_block_insert(
+                    "t1", {"PRIMARY": (num,), "idx_vallength": (val_length, num)}
+                )
+                self.assertTrue(
+                    all(lock.session == conn1.connection_id for lock in blockers)
+                )
+
+                cur2.execute("BEGIN")
+                try:
+                    cur2.execute(
+                        "INSERT INTO t1 (num, val, val_length) VALUES (%s, 'x', %s)",
+                        (num, val_length),
+                    )
+                    blocked = False
+                except connector.Error as e:
+                    self.assertEqual(classify_error(e), "timeout")
+                    blocked = True
+                cur2.execute("ROLLBACK")
+                self.assertEqual(bool(blockers), blocked)
+
+        cur1.execute("ROLLBACK")
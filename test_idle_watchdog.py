@@ -0,0 +1,174 @@
+import time
+from unittest import TestCase
+
+from idle_watchdog import (
+    IdleSession,
+    IdleWatchdog,
+    choose_action,
+    mysql_watchdog,
+    parse_policy,
+    postgresql_watchdog,
+)
+from util import MySqlBaseTest, PostgresqlBaseTest
+from wait_for_graph import WaitForGraph
+
+
+def idle_session(session, idle_seconds):
+    return IdleSession(session, "app", idle_seconds, None, 2, "UPDATE t1 SET val = 1")
+
+
+class PolicyTest(TestCase):
+    def test_parse_policy(self):
+        policy = parse_policy("60:terminate, 10:log,30:cancel")
+        self.assertEqual(policy, [(10.0, "log"), (30.0, "cancel"), (60.0, "terminate")])
+        self.assertIsNone(choose_action(policy, 5))
+        self.assertEqual(choose_action(policy, 10), "log")
+        self.assertEqual(choose_action(policy, 45), "cancel")
+        self.assertEqual(choose_action(policy, 600), "terminate")
+        with self.assertRaises(ValueError):
+            parse_policy("10:kill")
+
+
+class IdleWatchdogTest(TestCase):
+    def test_check(self):
+        idle = [[idle_session(1, 15), idle_session(3, 100)]]
+        executed = []
+        watchdog = IdleWatchdog(
+            lambda: idle[-1],
+            # 1 が 2 を、2 が 4 を待たせている。3 は誰も待たせていない
+            lambda: WaitForGraph([(2, 1), (4, 2)]),
+            lambda action, session: executed.append((action, session)),
+            parse_policy("10:log,60:terminate"),
+        )
+
+        (intervention,) = watchdog.check()
+        self.assertEqual(
+            (intervention.session, intervention.action, intervention.waiters),
+            (1, "log", [2]),
+        )
+        self.assertEqual(intervention.stalled, 2)
+        self.assertEqual(intervention.last_statement, "update t1 set val = ?")
+        self.assertEqual(executed, [])
+
+        # 同じアクションは繰り返さず、時間が経つと次の段階へ進む
+        self.assertEqual(watchdog.check(), [])
+        idle.append([idle_session(1, 61)])
+        (intervention,) = watchdog.check()
+        self.assertEqual(intervention.action, "terminate")
+        self.assertEqual(executed, [("terminate", 1)])
+
+    def test_dry_run(self):
+        executed = []
+        watchdog = IdleWatchdog(
+            lambda: [idle_session(1, 100)],
+            lambda: WaitForGraph([(2, 1)]),
+            lambda action, session: executed.append((action, session)),
+            parse_policy("0:terminate"),
+            dry_run=True,
+        )
+        (intervention,) = watchdog.check()
+        self.assertEqual(
+            (intervention.action, intervention.dry_run), ("terminate", True)
+        )
+        self.assertEqual(executed, [])
+
+
+class MySqlIdleWatchdogTest(MySqlBaseTest):
+    def test_terminate(self):
+        """
+        idle in transaction のまま他のセッションを待たせているセッションを KILL すると、待っていたセッションが進む
+        """
+        self.setup_tables(
+            """
+        DROP TABLE IF EXISTS `t1`;
+        CREATE TABLE `t1` (`num` int NOT NULL, `val` int NOT NULL, PRIMARY KEY (`num`)) ENGINE=InnoDB;
+        INSERT INTO `t1` (`num`, `val`) VALUES (1, 0);
+        """
+        )
+        conn1 = self.create_connection(fresh=True)
+        cur1 = conn1.cursor()
+        cur1.execute("BEGIN")
+        cur1.execute("UPDATE t1 SET val = 1 WHERE num = 1")
+
+        conn2 = self.create_connection()
+        cur2 = conn2.cursor()
+        cur2.execute("BEGIN")
+
+        def operation2():
+            cur2.execute("UPDATE t1 SET val = 2 WHERE num = 1")
+
+        thread = self.start_blocking(conn2, operation2)
+
+        conn_chk = self.create_connection(root=True)
+        conn_chk.autocommit = True
+        policy = parse_policy("0:terminate")
+
+        dry_run = mysql_watchdog(conn_chk, policy, dry_run=True, schema=self.database)
+        (intervention,) = dry_run.check()
+        self.assertEqual(intervention.session, conn1.connection_id)
+        self.assertEqual(intervention.waiters, [conn2.connection_id])
+        self.assertEqual(
+            intervention.last_statement, "update t1 set val = ? where num = ?"
+        )
+        self.assertTrue(thread.is_alive())
+
+        watchdog = mysql_watchdog(conn_chk, policy, schema=self.database)
+        (intervention,) = watchdog.check()
+        self.assertIsNone(intervention.error)
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        cur2.execute("COMMIT")
+
+        cur_chk = conn_chk.cursor()
+        cur_chk.execute(f"SELECT val FROM {self.database}.t1 WHERE num = 1")
+        self.assertEqual(cur_chk.fetchall(), [(2,)])
+
+
+class PostgresqlIdleWatchdogTest(PostgresqlBaseTest):
+    def test_terminate(self):
+        """
+        idle in transaction のまま他のセッションを待たせているバックエンドを pg_terminate_backend で終了させる
+        """
+        self.setup_tables(
+            """
+        drop table if exists t1;
+        create table t1 (num integer primary key, val integer not null);
+        insert into t1 (num, val) values (1, 0);
+        """
+        )
+        conn1 = self.create_connection(fresh=True)
+        cur1 = conn1.cursor()
+        cur1.execute("update t1 set val = 1 where num = 1")
+        (pid1,) = cur1.execute("select pg_backend_pid()").fetchone()
+
+        conn2 = self.create_connection()
+        cur2 = conn2.cursor()
+        (pid2,) = cur2.execute("select pg_backend_pid()").fetchone()
+
+        def operation2():
+            cur2.execute("update t1 set val = 2 where num = 1")
+
+        thread = self.start_blocking(conn2, operation2)
+        # state_change からの経過時間で判定するので、少しだけ idle の時間を作る
+        time.sleep(0.1)
+
+        conn_chk = self.create_connection()
+        conn_chk.autocommit = True
+        policy = parse_policy("0.05:terminate")
+
+        dry_run = postgresql_watchdog(
+            conn_chk, policy, dry_run=True, database=self.database
+        )
+        (intervention,) = dry_run.check()
+        self.assertEqual((intervention.session, intervention.waiters), (pid1, [pid2]))
+        self.assertTrue(thread.is_alive())
+
+        watchdog = postgresql_watchdog(conn_chk, policy, database=self.database)
+        (intervention,) = watchdog.check()
+        self.assertIsNone(intervention.error)
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        conn2.commit()
+
+        cur2.execute("select val from t1 where num = 1")
+        self.assertEqual(cur2.fetchall(), [(2,)])
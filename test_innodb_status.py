@@ -0,0 +1,226 @@
+from unittest import TestCase
+
+from innodb_status import parse_innodb_status
+
+STATUS = """
+=====================================
+2024-11-24 10:00:00 0x7f0000000700 INNODB MONITOR OUTPUT
+=====================================
+Per second averages calculated from the last 5 seconds
+-----------------
+BACKGROUND THREAD
+-----------------
+srv_master_thread loops: 1 srv_active, 0 srv_shutdown, 100 srv_idle
+------------
+TRANSACTIONS
+------------
+Trx id counter 1850
+Purge done for trx's n:o < 1848 undo n:o < 0 state: running but idle
+History list length 0
+LIST OF TRANSACTIONS FOR EACH SESSION:
+---TRANSACTION 421596154395512, not started
+0 lock struct(s), heap size 1128, 0 row lock(s)
+---TRANSACTION 1849, ACTIVE 3 sec starting index read
+mysql tables in use 1, locked 1
+LOCK WAIT 2 lock struct(s), heap size 1128, 1 row lock(s)
+MySQL thread id 9, OS thread handle 139973390251776, query id 35 172.18.0.4 root statistics
+SELECT * FROM lock_sample WHERE id = 3 FOR UPDATE
+------- TRX HAS BEEN WAITING 3 SEC FOR THIS LOCK TO BE GRANTED:
+RECORD LOCKS space id 2 page no 4 n bits 80 index PRIMARY of table `mysql`.`lock_sample` trx id 1849 lock_mode X locks rec but not gap waiting
+Record lock, heap no 4 PHYSICAL RECORD: n_fields 4; compact format; info bits 0
+ 0: len 8; hex 8000000000000003; asc         ;;
+ 1: len 6; hex 000000000738; asc      8;;
+ 2: len 7; hex 82000000a50110; asc        ;;
+ 3: len 4; hex 80000003; asc     ;;
+
+------------------
+TABLE LOCK table `mysql`.`lock_sample` trx id 1849 lock mode IX
+RECORD LOCKS space id 2 page no 4 n bits 80 index PRIMARY of table `mysql`.`lock_sample` trx id 1849 lock_mode X locks rec but not gap waiting
+Record lock, heap no 4 PHYSICAL RECORD: n_fields 4; compact format; info bits 0
+ 0: len 8; hex 8000000000000003; asc         ;;
+ 1: len 6; hex 000000000738; asc      8;;
+ 2: len 7; hex 82000000a50110; asc        ;;
+ 3: len 4; hex 80000003; asc     ;;
+
+---TRANSACTION 1848, ACTIVE 5 sec
+3 lock struct(s), heap size 1128, 3 row lock(s), undo log entries 1
+MySQL thread id 8, OS thread handle 139973391308544, query id 33 172.18.0.4 root starting
+SHOW ENGINE INNODB STATUS
+TABLE LOCK table `mysql`.`lock_sample` trx id 1848 lock mode IX
+RECORD LOCKS space id 2 page no 4 n bits 80 index PRIMARY of table `mysql`.`lock_sample` trx id 1848 lock_mode X locks rec but not gap
+Record lock, heap no 4 PHYSICAL RECORD: n_fields 4; compact format; info bits 0
+ 0: len 8; hex 8000000000000003; asc         ;;
+ 1: len 6; hex 000000000738; asc      8;;
+ 2: len 7; hex 82000000a50110; asc        ;;
+ 3: SQL NULL;
+
+RECORD LOCKS space id 2 page no 4 n bits 80 index PRIMARY of table `mysql`.`lock_sample` trx id 1848 lock_mode X
+Record lock, heap no 1 PHYSICAL RECORD: n_fields 1; compact format; info bits 0
+ 0: len 8; hex 73757072656d756d; asc supremum;;
+
+RECORD LOCKS space id 2 page no 5 n bits 80 index idx_val1 of table `mysql`.`lock_sample` trx id 1848 lock_mode X locks gap before rec insert intention waiting
+Record lock, heap no 3 PHYSICAL RECORD: n_fields 2; compact format; info bits 0
+ 0: len 4; hex 80000004; asc     ;;
+ 1: len 8; hex 8000000000000005; asc         ;;
+
+--------
+FILE I/O
+--------
+I/O thread 0 state: waiting for completed aio requests (insert buffer thread)
+"""
+
+DEADLOCK_STATUS = """
+=====================================
+2024-11-24 10:05:00 0x7f0000000700 INNODB MONITOR OUTPUT
+=====================================
+------------------------
+LATEST DETECTED DEADLOCK
+------------------------
+2024-11-24 10:04:58 0x7f0000000800
+*** (1) TRANSACTION:
+TRANSACTION 1860, ACTIVE 2 sec inserting
+mysql tables in use 1, locked 1
+LOCK WAIT 3 lock struct(s), heap size 1128, 2 row lock(s)
+MySQL thread id 12, OS thread handle 139973390251776, query id 80 172.18.0.4 app update
+INSERT INTO t1 (num, val, val_length) VALUES (4, 'four', 4)
+
+*** (1) HOLDS THE LOCK(S):
+RECORD LOCKS space id 3 page no 4 n bits 80 index PRIMARY of table `mysql`.`t1` trx id 1860 lock_mode X locks gap before rec
+Record lock, heap no 5 PHYSICAL RECORD: n_fields 5; compact format; info bits 0
+ 0: len 4; hex 80000005; asc     ;;
+ 1: len 6; hex 000000000740; asc      @;;
+
+*** (1) WAITING FOR THIS LOCK TO BE GRANTED:
+RECORD LOCKS space id 3 page no 4 n bits 80 index PRIMARY of table `mysql`.`t1` trx id 1860 lock_mode X locks gap before rec insert intention waiting
+Record lock, heap no 5 PHYSICAL RECORD: n_fields 5; compact format; info bits 0
+ 0: len 4; hex 80000005; asc     ;;
+ 1: len 6; hex 000000000740; asc      @;;
+
+*** (2) TRANSACTION:
+TRANSACTION 1861, ACTIVE 1 sec inserting
+mysql tables in use 1, locked 1
+LOCK WAIT 3 lock struct(s), heap size 1128, 2 row lock(s)
+MySQL thread id 13, OS thread handle 139973391308544, query id 81 172.18.0.4 app update
+INSERT INTO t1 (num, val, val_length) VALUES (4, 'four', 4)
+
+*** (2) HOLDS THE LOCK(S):
+RECORD LOCKS space id 3 page no 4 n bits 80 index PRIMARY of table `mysql`.`t1` trx id 1861 lock_mode X locks gap before rec
+Record lock, heap no 5 PHYSICAL RECORD: n_fields 5; compact format; info bits 0
+ 0: len 4; hex 80000005; asc     ;;
+ 1: len 6; hex 000000000740; asc      @;;
+
+*** (2) WAITING FOR THIS LOCK TO BE GRANTED:
+RECORD LOCKS space id 3 page no 4 n bits 80 index PRIMARY of table `mysql`.`t1` trx id 1861 lock_mode X locks gap before rec insert intention waiting
+Record lock, heap no 5 PHYSICAL RECORD: n_fields 5; compact format; info bits 0
+ 0: len 4; hex 80000005; asc     ;;
+ 1: len 6; hex 000000000740; asc      @;;
+
+*** WE ROLL BACK TRANSACTION (2)
+------------
+TRANSACTIONS
+------------
+Trx id counter 1862
+LIST OF TRANSACTIONS FOR EACH SESSION:
+---TRANSACTION 1860, ACTIVE 3 sec
+3 lock struct(s), heap size 1128, 2 row lock(s), undo log entries 1
+MySQL thread id 12, OS thread handle 139973390251776, query id 82 172.18.0.4 app starting
+SHOW ENGINE INNODB STATUS
+--------
+FILE I/O
+--------
+"""
+
+
+class InnodbStatusTest(TestCase):
+    def test_transactions(self):
+        status = parse_innodb_status(STATUS)
+        self.assertListEqual(
+            [(trx.trx_id, trx.state) for trx in status.transactions],
+            [(421596154395512, "not started"), (1849, "ACTIVE"), (1848, "ACTIVE")],
+        )
+
+        waiting = status.transaction(thread_id=9)
+        self.assertEqual(waiting.trx_id, 1849)
+        self.assertTrue(waiting.lock_wait)
+        self.assertEqual(waiting.wait_seconds, 3)
+        self.assertEqual(waiting.operation, "starting index read")
+        self.assertEqual(
+            waiting.query, "SELECT * FROM lock_sample WHERE id = 3 FOR UPDATE"
+        )
+        self.assertEqual(waiting.waiting_for.lock_type, "record")
+        self.assertTrue(waiting.waiting_for.waiting)
+        self.assertEqual(len(waiting.locks), 2)
+
+        holding = status.transaction(trx_id=1848)
+        self.assertEqual(
+            (holding.lock_structs, holding.row_locks, holding.undo_entries), (3, 3, 1)
+        )
+        self.assertEqual(holding.query, "SHOW ENGINE INNODB STATUS")
+
+    def test_lock_structs(self):
+        status = parse_innodb_status(STATUS)
+        self.assertListEqual(
+            [
+                (lock.trx_id, lock.index, lock.mode, lock.lock_type, lock.waiting)
+                for lock in status.find_locks(schema="mysql", table="lock_sample")
+            ],
+            [
+                (1849, None, "IX", "table", False),
+                (1849, "PRIMARY", "X", "record", True),
+                (1848, None, "IX", "table", False),
+                (1848, "PRIMARY", "X", "record", False),
+                (1848, "PRIMARY", "X", "next-key", False),
+                (1848, "idx_val1", "X", "insert-intention", True),
+            ],
+        )
+
+        record_lock = status.find_locks(trx_id=1848, lock_type="record")[0]
+        self.assertEqual((record_lock.space_id, record_lock.page_no), (2, 4))
+        self.assertListEqual(
+            record_lock.records[0].fields,
+            [
+                (0, 8, "8000000000000003"),
+                (1, 6, "000000000738"),
+                (2, 7, "82000000a50110"),
+                (3, None, None),
+            ],
+        )
+        self.assertTrue(status.find_locks(lock_type="next-key")[0].records[0].supremum)
+        self.assertTrue(status.find_locks(lock_type="insert-intention")[0].gap)
+
+    def test_no_deadlock(self):
+        self.assertIsNone(parse_innodb_status(STATUS).deadlock)
+
+    def test_deadlock(self):
+        status = parse_innodb_status(DEADLOCK_STATUS)
+        deadlock = status.deadlock
+        self.assertEqual(deadlock.detected_at, "2024-11-24 10:04:58")
+        self.assertListEqual(
+            [
+                (trx.trx_id, trx.thread_id, trx.operation, trx.query)
+                for trx in deadlock.transactions
+            ],
+            [
+                (
+                    1860,
+                    12,
+                    "inserting",
+                    "INSERT INTO t1 (num, val, val_length) VALUES (4, 'four', 4)",
+                ),
+                (
+                    1861,
+                    13,
+                    "inserting",
+                    "INSERT INTO t1 (num, val, val_length) VALUES (4, 'four', 4)",
+                ),
+            ],
+        )
+        for trx in deadlock.transactions:
+            self.assertEqual([lock.lock_type for lock in trx.locks], ["gap"])
+            self.assertEqual(trx.waiting_for.lock_type, "insert-intention")
+            self.assertTrue(trx.waiting_for.waiting)
+        self.assertEqual(deadlock.victim.trx_id, 1861)
+
+        # TRANSACTIONS セクションのトランザクションとは混ざらない
+        self.assertListEqual([trx.trx_id for trx in status.transactions], [1860])
+        self.assertEqual(status.transactions[0].query, "SHOW ENGINE INNODB STATUS")
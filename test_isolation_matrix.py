@@ -0,0 +1,46 @@
+from unittest import TestCase, mock
+
+from isolation_matrix import (
+    UNKNOWN,
+    Transaction,
+    describe_locks,
+    find_blocked_statement,
+)
+from util import LockSnapshot
+
+
+class IsolationMatrixTest(TestCase):
+    def test_describe_locks(self):
+        snapshot = LockSnapshot.from_rows(
+            [
+                (8, 1848, "TABLE", "mysql", "t1", None, "IX", True, None),
+                (8, 1848, "RECORD", "mysql", "t1", "idx_vallength", "X", True, "3, 1"),
+                (8, 1848, "RECORD", "mysql", "t1", "idx_vallength", "X", True, "3, 2"),
+                (
+                    8,
+                    1848,
+                    "RECORD",
+                    "mysql",
+                    "t1",
+                    "idx_vallength",
+                    "X,GAP",
+                    True,
+                    "4, 5",
+                ),
+            ]
+        )
+        self.assertListEqual(
+            describe_locks(snapshot),
+            ["RECORD idx_vallength X", "RECORD idx_vallength X,GAP", "TABLE t1 IX"],
+        )
+
+    def test_find_blocked_statement(self):
+        second = Transaction("postgresql", mock.Mock(), ["select 1", "select {n}"], 2)
+        second.current = 1
+
+        def timeout():
+            raise TimeoutError("session did not reach lock wait within 5.0s")
+
+        self.assertEqual(find_blocked_statement(second, lambda: True), "select 2")
+        self.assertIsNone(find_blocked_statement(second, lambda: False))
+        self.assertEqual(find_blocked_statement(second, timeout), UNKNOWN)
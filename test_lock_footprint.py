@@ -0,0 +1,173 @@
+from unittest import TestCase
+
+from lock_footprint import Index, analyze, predict
+from lock_scenarios import T1_SETUP
+from util import LockSnapshot, MySqlBaseTest
+
+T1_INDEXES = {
+    "t1": {
+        "PRIMARY": Index("PRIMARY", True, ["num"]),
+        "idx_vallength": Index("idx_vallength", False, ["val_length"]),
+    }
+}
+
+
+def explain(access_type, key=None, used_key_parts=(), rows=1):
+    table = {
+        "table_name": "t1",
+        "access_type": access_type,
+        "rows_examined_per_scan": rows,
+    }
+    if key is not None:
+        table.update(key=key, used_key_parts=list(used_key_parts))
+    return {"query_block": {"select_id": 1, "table": table}}
+
+
+def snapshot(*locks):
+    return LockSnapshot.from_rows(
+        [
+            (1, 100, lock_type, "test", "t1", index, mode, True, data)
+            for lock_type, index, mode, data in locks
+        ]
+    )
+
+
+class LockFootprintTest(TestCase):
+    def test_unique_lookup(self):
+        footprint = predict(
+            "SELECT * FROM t1 WHERE num = 1 FOR UPDATE",
+            explain("const", "PRIMARY", ["num"]),
+            T1_INDEXES,
+        )
+        self.assertEqual(footprint.table_locks, {"t1": "IX"})
+        self.assertEqual(
+            [(lock.index, lock.kinds) for lock in footprint.locks],
+            [("PRIMARY", ("record",))],
+        )
+        self.assertFalse(footprint.gap_locking)
+        self.assertEqual(
+            footprint.check(
+                snapshot(
+                    ("TABLE", None, "IX", None),
+                    ("RECORD", "PRIMARY", "X,REC_NOT_GAP", "1"),
+                )
+            ),
+            [],
+        )
+        self.assertEqual(
+            footprint.check(snapshot(("RECORD", "PRIMARY", "X", "1"))),
+            ["unexpected t1.PRIMARY X 1"],
+        )
+
+    def test_secondary_index(self):
+        footprint = predict(
+            "SELECT * FROM t1 WHERE val_length = 3 FOR SHARE",
+            explain("ref", "idx_vallength", ["val_length"], rows=2),
+            T1_INDEXES,
+        )
+        self.assertEqual(footprint.table_locks, {"t1": "IS"})
+        self.assertEqual(
+            [(lock.index, lock.mode, lock.kinds) for lock in footprint.locks],
+            [
+                ("idx_vallength", "S", ("next-key", "gap")),
+                ("PRIMARY", "S", ("record",)),
+            ],
+        )
+        self.assertEqual(footprint.rows, 5)
+        self.assertTrue(footprint.gap_locking)
+
+    def test_read_committed(self):
+        footprint = predict(
+            "UPDATE t1 SET val = 'x' WHERE val_length = 3",
+            explain("range", "idx_vallength", ["val_length"], rows=2),
+            T1_INDEXES,
+            isolation="READ COMMITTED",
+        )
+        self.assertFalse(footprint.gap_locking)
+        self.assertEqual(footprint.rows, 4)
+
+    def test_full_scan(self):
+        footprint = predict(
+            "DELETE FROM t1 WHERE val = 'one'", explain("ALL", rows=4), T1_INDEXES
+        )
+        self.assertEqual(footprint.full_scans, ["t1"])
+        self.assertTrue(footprint.exceeds(1000))
+        self.assertEqual(
+            footprint.check(
+                snapshot(("RECORD", "PRIMARY", "X", "supremum pseudo-record"))
+            ),
+            [],
+        )
+
+    def test_no_matching_row(self):
+        footprint = predict(
+            "SELECT * FROM t1 WHERE num = 4 FOR UPDATE",
+            {
+                "query_block": {
+                    "select_id": 1,
+                    "message": "no matching row in const table",
+                }
+            },
+            T1_INDEXES,
+        )
+        self.assertEqual(footprint.table_locks, {"t1": "IX"})
+        self.assertEqual(
+            footprint.check(snapshot(("RECORD", "PRIMARY", "X,GAP", "5"))), []
+        )
+
+    def test_not_locking(self):
+        sql = "SELECT * FROM t1 WHERE num = 1"
+        explained = explain("const", "PRIMARY", ["num"])
+        self.assertEqual(predict(sql, explained, T1_INDEXES).table_locks, {})
+        self.assertEqual(
+            predict(sql, explained, T1_INDEXES, "SERIALIZABLE").table_locks,
+            {"t1": "IS"},
+        )
+
+    def test_insert(self):
+        footprint = predict(
+            "INSERT INTO t1 (num, val, val_length) VALUES (4, 'four', 4)",
+            {"query_block": {"select_id": 1, "table": {"table_name": "t1"}}},
+            T1_INDEXES,
+        )
+        self.assertEqual(footprint.table_locks, {"t1": "IX"})
+        self.assertEqual(footprint.locks, [])
+
+
+class MySqlLockFootprintTest(MySqlBaseTest):
+    def test_scenario_statements(self):
+        """
+        T1_SETUP のテーブルで、見積もりが実際の data_locks と一致すること
+        """
+        self.setup_tables(T1_SETUP["mysql"])
+        cases = [
+            ("SELECT * FROM t1 WHERE num = 1 FOR UPDATE", {"PRIMARY"}),
+            ("SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE", None),
+            ("SELECT * FROM t1 WHERE num BETWEEN 3 AND 4 FOR SHARE", {"PRIMARY"}),
+            ("UPDATE t1 SET val = 'x' WHERE val_length = 4", None),
+            ("SELECT * FROM t1 WHERE num = 4 FOR UPDATE", {"PRIMARY"}),
+            ("UPDATE t1 SET val_length = 0 WHERE val = 'one'", {"PRIMARY"}),
+        ]
+
+        conn = self.create_connection()
+        conn_chk = self.create_connection(root=True)
+
+        for sql, indexes in cases:
+            with self.subTest(sql=sql):
+                footprint = analyze(conn, sql)
+                cur = conn.cursor()
+                cur.execute("BEGIN")
+                cur.execute(sql)
+                if cur.with_rows:
+                    cur.fetchall()
+                actual = self.lock_snapshot(conn_chk).filter(session=conn.connection_id)
+                cur.execute("ROLLBACK")
+
+                self.assertEqual(footprint.check(actual), [])
+                if indexes is None:
+                    indexes = {
+                        lock.index for lock in footprint.locks if lock.index is not None
+                    }
+                self.assertEqual(
+                    {row["index"] for row in actual.rows() if row["index"]}, indexes
+                )
@@ -0,0 +1,73 @@
+import io
+import json
+from unittest import TestCase
+
+from lock_sampler import LockSampler
+from util import LockSnapshot
+
+HOLDER = (8, 1848, "RECORD", "mysql", "t1", "PRIMARY", "X,REC_NOT_GAP", True, "1")
+WAITER = (9, 1849, "RECORD", "mysql", "t1", "PRIMARY", "X,REC_NOT_GAP", False, "1")
+GRANTED = (9, 1849, "RECORD", "mysql", "t1", "PRIMARY", "X,REC_NOT_GAP", True, "1")
+
+
+class LockSamplerTest(TestCase):
+    def test_timeline(self):
+        snapshots = iter(
+            [
+                LockSnapshot.from_rows([HOLDER], taken_at=10.0),
+                LockSnapshot.from_rows([HOLDER, WAITER], taken_at=10.5),
+                LockSnapshot.from_rows([HOLDER, WAITER], taken_at=11.0),
+                LockSnapshot.from_rows([GRANTED], taken_at=12.5),
+                LockSnapshot.from_rows([], taken_at=13.0),
+            ]
+        )
+        sampler = LockSampler(lambda: next(snapshots), capacity=2)
+        for _ in range(5):
+            sampler.sample()
+
+        # 変化のなかったサンプルは保持せず、リングバッファは直近 capacity 件だけ
+        self.assertListEqual([change[0] for change in sampler.changes], [12.5, 13.0])
+
+        f = io.StringIO()
+        sampler.export_json(f)
+        self.assertListEqual(
+            [
+                (
+                    row["session"],
+                    row["first_seen"],
+                    row["last_seen"],
+                    row["wait_seconds"],
+                )
+                for row in json.loads(f.getvalue())
+            ],
+            [(8, 10.0, 11.0, None), (9, 10.5, 12.5, 2.0)],
+        )
+
+    def test_export_csv(self):
+        snapshots = iter([LockSnapshot.from_rows([HOLDER, WAITER], taken_at=1.0)])
+        sampler = LockSampler(lambda: next(snapshots))
+        sampler.sample()
+
+        f = io.StringIO()
+        sampler.export_csv(f)
+        lines = f.getvalue().splitlines()
+        self.assertEqual(
+            lines[0],
+            "session,trx,lock_type,schema,table,index,mode,data,granted,"
+            "first_seen,last_seen,wait_seconds",
+        )
+        self.assertEqual(len(lines), 3)
+
+    def test_capture_error(self):
+        def capture():
+            if sampler.samples:
+                raise ConnectionError("monitor connection lost")
+            return LockSnapshot.from_rows([HOLDER], taken_at=1.0)
+
+        sampler = LockSampler(capture, interval=0.01)
+        sampler.start()
+        sampler._thread.join(timeout=5)
+        self.assertFalse(sampler._thread.is_alive())
+        with self.assertRaises(ConnectionError):
+            sampler.stop()
+        self.assertEqual(sampler.samples, 1)
@@ -1,6 +1,3 @@
-import re
-import threading
-
 from util import MySqlBaseTest
 
 
@@ -182,14 +179,13 @@ class MySqlLockTiqwablogTest(MySqlBaseTest):
 
             # RECORD LOCKS や locks rec but not gap が書かれている行から、ここでは lock_sample テーブルの PRIMARY インデックス 上には record exclusive lock を取得していることがわかります。
             cur.execute("SELECT * FROM lock_sample WHERE id = 2 FOR UPDATE")
-            cur.execute("SHOW ENGINE INNODB STATUS")
-            _, _, status = cur.fetchall()[0]
-            self.assertRegex(
+            status = self.show_innodb_status(cur)
+            self.assertInnodbLock(
                 status,
-                re.compile(
-                    r"^RECORD LOCKS space id \d+ page no \d+ n bits \d+ index PRIMARY of table `mysql`\.`lock_sample` trx id \d+ lock_mode X locks rec but not gap$",
-                    re.MULTILINE,
-                ),
+                table="lock_sample",
+                index="PRIMARY",
+                mode="X",
+                lock_type="record",
             )
 
         """
@@ -219,14 +215,9 @@ class MySqlLockTiqwablogTest(MySqlBaseTest):
 
             # SHOW ENGINE INNODB STATUS では RECORD LOCKS ... locks gap before rec と表示されます。
             cur.execute("SELECT * FROM lock_sample WHERE id = 6 FOR UPDATE")
-            cur.execute("SHOW ENGINE INNODB STATUS")
-            _, _, status = cur.fetchall()[0]
-            self.assertRegex(
-                status,
-                re.compile(
-                    r"^RECORD LOCKS space id \d+ page no \d+ n bits \d+ index PRIMARY of table `mysql`\.`lock_sample` trx id \d+ lock_mode X locks gap before rec$",
-                    re.MULTILINE,
-                ),
+            status = self.show_innodb_status(cur)
+            self.assertInnodbLock(
+                status, table="lock_sample", index="PRIMARY", mode="X", lock_type="gap"
             )
 
         """
@@ -255,14 +246,13 @@ class MySqlLockTiqwablogTest(MySqlBaseTest):
             # RECORD LOCKS の行で lock_mode X で終わっているのが record lock, gap lock との違いになります。
             # FIXME: 例で説明されていた WHERE id BETWEEN 6 AND 7 ではギャップロックになった
             cur.execute("SELECT * FROM lock_sample WHERE id >= 6 FOR UPDATE")
-            cur.execute("SHOW ENGINE INNODB STATUS")
-            _, _, status = cur.fetchall()[0]
-            self.assertRegex(
+            status = self.show_innodb_status(cur)
+            self.assertInnodbLock(
                 status,
-                re.compile(
-                    r"^RECORD LOCKS space id \d+ page no \d+ n bits \d+ index PRIMARY of table `mysql`\.`lock_sample` trx id \d+ lock_mode X$",
-                    re.MULTILINE,
-                ),
+                table="lock_sample",
+                index="PRIMARY",
+                mode="X",
+                lock_type="next-key",
             )
 
     def test_dml_exclusive_lock(self):
@@ -293,14 +283,13 @@ class MySqlLockTiqwablogTest(MySqlBaseTest):
             cur = conn.cursor(buffered=True)
 
             cur.execute("UPDATE lock_sample SET val1 = 10 WHERE id = 2")
-            cur.execute("SHOW ENGINE INNODB STATUS")
-            _, _, status = cur.fetchall()[0]
-            self.assertRegex(
+            status = self.show_innodb_status(cur)
+            self.assertInnodbLock(
                 status,
-                re.compile(
-                    r"^RECORD LOCKS space id \d+ page no \d+ n bits \d+ index PRIMARY of table `mysql`\.`lock_sample` trx id \d+ lock_mode X locks rec but not gap$",
-                    re.MULTILINE,
-                ),
+                table="lock_sample",
+                index="PRIMARY",
+                mode="X",
+                lock_type="record",
             )
 
     def test_lock_using_select(self):
@@ -334,14 +323,13 @@ class MySqlLockTiqwablogTest(MySqlBaseTest):
             cur = conn.cursor(buffered=True)
 
             cur.execute("SELECT * FROM lock_sample WHERE val1 = 2 FOR UPDATE")
-            cur.execute("SHOW ENGINE INNODB STATUS")
-            _, _, status = cur.fetchall()[0]
-            self.assertRegex(
+            status = self.show_innodb_status(cur)
+            self.assertInnodbLock(
                 status,
-                re.compile(
-                    r"^RECORD LOCKS space id \d+ page no \d+ n bits \d+ index PRIMARY of table `mysql`\.`lock_sample` trx id \d+ lock_mode X$",
-                    re.MULTILINE,
-                ),
+                table="lock_sample",
+                index="PRIMARY",
+                mode="X",
+                lock_type="next-key",
             )
 
     def test_lock_wait(self):
@@ -371,31 +359,25 @@ class MySqlLockTiqwablogTest(MySqlBaseTest):
         t_a_cur = t_a_conn.cursor(buffered=True)
 
         t_a_cur.execute("SELECT * FROM lock_sample WHERE id = 3 FOR UPDATE")
-        t_a_cur.execute("SHOW ENGINE INNODB STATUS")
-        _, _, status = t_a_cur.fetchall()[0]
-        self.assertRegex(
-            status,
-            re.compile(
-                r"^RECORD LOCKS space id \d+ page no \d+ n bits \d+ index PRIMARY of table `mysql`\.`lock_sample` trx id \d+ lock_mode X locks rec but not gap$",
-                re.MULTILINE,
-            ),
+        status = self.show_innodb_status(t_a_cur)
+        self.assertInnodbLock(
+            status, table="lock_sample", index="PRIMARY", mode="X", lock_type="record"
         )
 
-        def t_b():
-            t_b_conn = self.create_connection(root=True)
-            t_b_cur = t_b_conn.cursor(buffered=True)
-            t_b_cur.execute("SELECT * FROM lock_sample WHERE id = 3 FOR UPDATE")
-
-        thread = threading.Thread(target=t_b)
-        thread.start()
-        thread.join(timeout=0.1)
+        t_b_conn = self.create_connection(root=True)
+        t_b_cur = t_b_conn.cursor(buffered=True)
+        self.start_blocking(
+            t_b_conn,
+            t_b_cur.execute,
+            "SELECT * FROM lock_sample WHERE id = 3 FOR UPDATE",
+        )
 
-        t_a_cur.execute("SHOW ENGINE INNODB STATUS")
-        _, _, status = t_a_cur.fetchall()[0]
-        self.assertRegex(
+        status = self.show_innodb_status(t_a_cur)
+        self.assertInnodbLock(
             status,
-            re.compile(
-                r"^RECORD LOCKS space id \d+ page no \d+ n bits \d+ index PRIMARY of table `mysql`\.`lock_sample` trx id \d+ lock_mode X locks rec but not gap waiting$",
-                re.MULTILINE,
-            ),
+            table="lock_sample",
+            index="PRIMARY",
+            mode="X",
+            lock_type="record",
+            waiting=True,
         )
@@ -1,6 +1,6 @@
-import asyncio
-import threading
-
+from blocker_attribution import capture_lock_waits
+from lock_scenarios import T1_SETUP
+from scenario import CHECK, Scenario, Step, run_scenario
 from util import MySqlAsyncBaseTest, MySqlBaseTest
 
 
@@ -61,6 +61,8 @@ class MySqlLockUnyoKanriNyumonTest(MySqlBaseTest):
             LOCK_DATA
         from
             performance_schema.data_locks
+        where
+            OBJECT_SCHEMA = database()
         order by 1, 2, 3, 4, 5, 6;
         """
 
@@ -97,9 +99,31 @@ class MySqlLockUnyoKanriNyumonTest(MySqlBaseTest):
         def operation2():
             cur2.execute("INSERT INTO t1 (num, val, val_length) values (10, 'ju', 2)")
 
-        thread2 = threading.Thread(target=operation2)
-        thread2.start()
-        thread2.join(timeout=0.1)
+        before = self.lock_snapshot(conn_chk)
+        self.start_blocking(conn2, operation2)
+        acquired, released = before.diff(self.lock_snapshot(conn_chk))
+
+        """
+        INSERT の前後のスナップショットを比べると、増えたのは conn2 のテーブルの IX ロックと、(3, 1) の手前のギャップへの挿入意図ロック (待ち) だけ
+        """
+        self.assertEqual(len(released), 0)
+        self.assertListEqual(
+            sorted(
+                (
+                    row["lock_type"],
+                    row["index"],
+                    row["mode"],
+                    row["granted"],
+                    row["data"],
+                )
+                for row in acquired.filter(session=conn2.connection_id).rows()
+            ),
+            [
+                ("RECORD", "idx_vallength", "X,GAP,INSERT_INTENTION", False, "3, 1"),
+                ("TABLE", None, "IX", True, None),
+            ],
+        )
+        self.assertEqual(len(acquired), 2)
 
         check_lock_waits_query = """
         select
@@ -112,6 +136,8 @@ class MySqlLockUnyoKanriNyumonTest(MySqlBaseTest):
             blocking_lock_mode
         from
             sys.innodb_lock_waits
+        where
+            locked_table_schema = database()
         order by 1, 2, 3, 4, 5, 6, 7;
         """
 
@@ -160,9 +186,7 @@ class MySqlLockUnyoKanriNyumonTest(MySqlBaseTest):
         def operation4():
             cur4.execute("SELECT * FROM t1 WHERE val_length = 3 FOR SHARE")
 
-        thread4 = threading.Thread(target=operation4)
-        thread4.start()
-        thread4.join(timeout=0.1)
+        self.start_blocking(conn4, operation4)
 
         cur_chk.execute(check_lock_waits_query)
         actual = cur_chk.fetchall()
@@ -219,9 +243,7 @@ class MySqlLockUnyoKanriNyumonTest(MySqlBaseTest):
             cur2.reset()
             cur2.execute("INSERT INTO t1 (num, val, val_length) values (10, 'ju', 2)")
 
-        thread2 = threading.Thread(target=operation2)
-        thread2.start()
-        thread2.join(timeout=0.1)
+        self.start_blocking(conn2, operation2)
 
         conn_chk = self.create_connection(root=True)
         cur_chk = conn_chk.cursor(dictionary=True)
@@ -234,22 +256,29 @@ class MySqlLockUnyoKanriNyumonTest(MySqlBaseTest):
             blocking_query
         from
             sys.innodb_lock_waits
+        where
+            locked_table_schema = database()
         order by 1, 2, 3, 4, 5;
         """
         cur_chk.execute(check_lock_waits_query)
 
         actual = cur_chk.fetchall()
         self.assertTableEqual(
-            """
+            f"""
 +-----------------------+---------------------+----------------+------------------------------------------------------------+------------------+
 | locked_table_schema   | locked_table_name   | locked_index   | waiting_query                                              | blocking_query   |
 |-----------------------+---------------------+----------------+------------------------------------------------------------+------------------|
-| mysql                 | t1                  | idx_vallength  | INSERT INTO t1 (num, val, val_length) values (10, 'ju', 2) |                  |
+| {self.database:<21} | t1                  | idx_vallength  | INSERT INTO t1 (num, val, val_length) values (10, 'ju', 2) |                  |
 +-----------------------+---------------------+----------------+------------------------------------------------------------+------------------+
             """,
             actual,
         )
 
+        # 待ちの関係をグラフにすると、先頭で待たせているのは conn1 だとわかる
+        graph = self.wait_for_graph(conn_chk)
+        self.assertListEqual(graph.root_blockers(), [conn1.connection_id])
+        self.assertDictEqual(graph.stall_counts(), {conn1.connection_id: 1})
+
         """
         実際にどのクエリが該当のInnoDBロックを取得したかを特定する方法はありません
         必要に応じてperformance_schema.events_statements_historyテーブルをたどって過去のクエリを探索する必要があります
@@ -276,6 +305,8 @@ class MySqlLockUnyoKanriNyumonTest(MySqlBaseTest):
             performance_schema.threads as w_t
         on
             w_trx.trx_mysql_thread_id = w_t.PROCESSLIST_ID
+        where
+            w.locked_table_schema = database()
         """
 
         cur_chk.execute(check_lock_query)
@@ -322,6 +353,108 @@ class MySqlLockUnyoKanriNyumonTest(MySqlBaseTest):
             actual,
         )
 
+        # 上の手順をまとめて 1 クエリで行い、待たせているロックを取った文を推定する
+        (wait,) = capture_lock_waits(conn_chk, schema=self.database)
+        self.assertEqual(wait.waiting_session, conn2.connection_id)
+        self.assertEqual(wait.blocking_session, conn1.connection_id)
+        self.assertEqual((wait.table, wait.index), ("t1", "idx_vallength"))
+        self.assertEqual(
+            wait.waiting_sql,
+            "INSERT INTO t1 (num, val, val_length) values (10, 'ju', 2)",
+        )
+        self.assertEqual(
+            wait.blocking_statement.sql,
+            "SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE",
+        )
+
+    def test_innodb_layer_lock_scenario(self):
+        """
+        test_innodb_layer_lock と同じ流れをシナリオとして書いたもの
+        """
+        result = run_scenario(
+            Scenario(
+                name="innodb_layer_lock",
+                engine="mysql",
+                setup=T1_SETUP["mysql"],
+                steps=[
+                    Step(
+                        CHECK,
+                        "SELECT @@transaction_isolation AS isolation",
+                        table="""
++-----------------+
+| isolation       |
+|-----------------|
+| REPEATABLE-READ |
++-----------------+
+""",
+                    ),
+                    "A: BEGIN",
+                    "A: SELECT * FROM t1 WHERE val_length = 3 FOR UPDATE",
+                    Step(
+                        CHECK,
+                        """
+                        select
+                            OBJECT_NAME,
+                            INDEX_NAME,
+                            LOCK_TYPE,
+                            LOCK_MODE,
+                            LOCK_STATUS,
+                            LOCK_DATA
+                        from
+                            performance_schema.data_locks
+                        where
+                            OBJECT_SCHEMA = database()
+                        order by 1, 2, 3, 4, 5, 6
+                        """,
+                        table="""
++---------------+---------------+-------------+---------------+---------------+-------------+
+| OBJECT_NAME   | INDEX_NAME    | LOCK_TYPE   | LOCK_MODE     | LOCK_STATUS   | LOCK_DATA   |
+|---------------+---------------+-------------+---------------+---------------+-------------|
+| t1            |               | TABLE       | IX            | GRANTED       |             |
+| t1            | idx_vallength | RECORD      | X             | GRANTED       | 3, 1        |
+| t1            | idx_vallength | RECORD      | X             | GRANTED       | 3, 2        |
+| t1            | idx_vallength | RECORD      | X,GAP         | GRANTED       | 4, 5        |
+| t1            | PRIMARY       | RECORD      | X,REC_NOT_GAP | GRANTED       | 1           |
+| t1            | PRIMARY       | RECORD      | X,REC_NOT_GAP | GRANTED       | 2           |
++---------------+---------------+-------------+---------------+---------------+-------------+
+""",
+                    ),
+                    "B: BEGIN",
+                    Step(
+                        "B",
+                        "INSERT INTO t1 (num, val, val_length) values (10, 'ju', 2)",
+                        blocks=True,
+                    ),
+                    Step(
+                        CHECK,
+                        """
+                        select
+                            locked_table_name,
+                            locked_index,
+                            waiting_pid,
+                            blocking_pid
+                        from
+                            sys.innodb_lock_waits
+                        where
+                            locked_table_schema = database()
+                        """,
+                        label="lock_waits",
+                    ),
+                    "A: ROLLBACK",
+                    # A のロールバックで B の INSERT が完了する
+                    "B: ROLLBACK",
+                ],
+            )
+        )
+        self.assertListEqual(result.failures, [])
+        self.assertListEqual(
+            [
+                (row["locked_index"], row["waiting_pid"], row["blocking_pid"])
+                for row in result["lock_waits"].rows
+            ],
+            [("idx_vallength", result.sessions["B"], result.sessions["A"])],
+        )
+
 
 class MySqlLockUnyoKanriNyumonAsyncTest(MySqlAsyncBaseTest):
     """
@@ -381,6 +514,8 @@ class MySqlLockUnyoKanriNyumonAsyncTest(MySqlAsyncBaseTest):
             LOCK_DATA
         from
             performance_schema.data_locks
+        where
+            OBJECT_SCHEMA = database()
         order by 1, 2, 3, 4, 5, 6;
         """
 
@@ -413,13 +548,10 @@ class MySqlLockUnyoKanriNyumonAsyncTest(MySqlAsyncBaseTest):
         conn2 = await self.create_connection()
         cur2 = await conn2.cursor()
         await cur2.execute("BEGIN")
-        executed = asyncio.create_task(
-            cur2.execute("INSERT INTO t1 (num, val, val_length) values (10, 'ju', 2)")
+        await self.start_blocking(
+            conn2,
+            cur2.execute("INSERT INTO t1 (num, val, val_length) values (10, 'ju', 2)"),
         )
-        try:
-            await asyncio.wait_for(executed, timeout=0.1)
-        except asyncio.TimeoutError:
-            pass
 
         check_lock_waits_query = """
         select
@@ -432,6 +564,8 @@ class MySqlLockUnyoKanriNyumonAsyncTest(MySqlAsyncBaseTest):
             blocking_lock_mode
         from
             sys.innodb_lock_waits
+        where
+            locked_table_schema = database()
         order by 1, 2, 3, 4, 5, 6, 7;
         """
 
@@ -0,0 +1,105 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from pg_log import PostgresqlLogTailer
+
+LOG = """\
+2024-11-24 10:00:00.100 UTC [120] LOG:  database system is ready to accept connections
+2024-11-24 10:00:01.000 UTC [123] WARNING:  there is already a transaction in progress
+2024-11-24 10:00:02.000 UTC [123] LOG:  process 123 still waiting for ShareLock on transaction 740 after 1000.123 ms
+2024-11-24 10:00:02.000 UTC [123] DETAIL:  Process holding the lock: 122. Wait queue: 123.
+2024-11-24 10:00:02.000 UTC [123] CONTEXT:  while locking tuple (0,1) in relation "test_table_a"
+2024-11-24 10:00:02.000 UTC [123] STATEMENT:  SELECT 'lock from b'
+\tFROM test_table_a WHERE i = 1 FOR UPDATE
+"""
+
+
+class PostgresqlLogTailerTest(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def write(self, text):
+        with open(self.path, "a") as f:
+            f.write(text)
+
+    def test_read_increment(self):
+        self.write(LOG)
+        tailer = PostgresqlLogTailer(self.path)
+        self.assertListEqual(tailer.read(), [])
+
+        # 書きかけの行は改行が書かれるまで読まない
+        self.write("2024-11-24 10:00:03.000 UTC [123] LOG:  duration: 1215.018 ms")
+        self.assertListEqual(tailer.read(), [])
+        self.write("  statement: SELECT 'lock from b'\n")
+        events = tailer.read()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].kind, "duration")
+        self.assertEqual(events[0].duration_ms, 1215.018)
+        self.assertEqual(events[0].query, "SELECT 'lock from b'")
+
+    def test_events_by_pid(self):
+        self.write(LOG)
+        tailer = PostgresqlLogTailer(self.path, from_start=True)
+        tailer.read()
+
+        self.assertListEqual(
+            [event.kind for event in tailer.find(pid=123)], ["message", "lock_wait"]
+        )
+        wait = tailer.wait_for(pid=123, kind="lock_wait", timeout=0.1)
+        self.assertEqual(
+            wait.lock_wait, ("still waiting", "ShareLock", "transaction 740")
+        )
+        self.assertEqual(wait.detail, "Process holding the lock: 122. Wait queue: 123.")
+        self.assertEqual(
+            wait.query, "SELECT 'lock from b'\nFROM test_table_a WHERE i = 1 FOR UPDATE"
+        )
+        with self.assertRaises(TimeoutError):
+            tailer.wait_for(pid=122, timeout=0.05)
+
+    def test_truncated_log(self):
+        self.write(LOG)
+        tailer = PostgresqlLogTailer(self.path)
+        with open(self.path, "w") as f:
+            f.write(LOG.splitlines(keepends=True)[1])
+        self.assertEqual(tailer.read()[0].severity, "WARNING")
+
+    def test_deadlock(self):
+        self.write(
+            "2024-11-24 10:00:04.000 UTC [123] ERROR:  deadlock detected\n"
+            "2024-11-24 10:00:04.000 UTC [123] DETAIL:  Process 123 waits for "
+            "ShareLock on transaction 741; blocked by process 124.\n"
+            "\tProcess 124 waits for ShareLock on transaction 740; "
+            "blocked by process 123.\n"
+            "\tProcess 123: UPDATE t1 SET val = 'x' WHERE num = 2\n"
+            "\tProcess 124: UPDATE t1 SET val = 'x' WHERE num = 1\n"
+            "2024-11-24 10:00:04.000 UTC [123] HINT:  See server log for query details.\n"
+            "2024-11-24 10:00:04.000 UTC [123] STATEMENT:  UPDATE t1 SET val = 'x' "
+            "WHERE num = 2\n"
+        )
+        tailer = PostgresqlLogTailer(self.path, from_start=True)
+        (event,) = tailer.read()
+        self.assertEqual(event.kind, "deadlock")
+
+        deadlock = event.deadlock
+        self.assertEqual(deadlock.victim, 123)
+        self.assertEqual(
+            [
+                (wait.pid, wait.mode, wait.target, wait.blocked_by)
+                for wait in deadlock.waits
+            ],
+            [
+                (123, "ShareLock", "transaction 741", 124),
+                (124, "ShareLock", "transaction 740", 123),
+            ],
+        )
+        self.assertEqual(
+            deadlock.queries,
+            {
+                123: "UPDATE t1 SET val = 'x' WHERE num = 2",
+                124: "UPDATE t1 SET val = 'x' WHERE num = 1",
+            },
+        )
+        self.assertIsNone(tailer.find(kind="deadlock")[0].lock_wait)
@@ -1,9 +1,8 @@
-import threading
+import asyncio
 
 from psycopg.rows import dict_row
-from tabulate import tabulate
 
-from util import PostgresqlBaseTest
+from util import PostgresqlAsyncBaseTest, PostgresqlBaseTest
 
 
 class PostgresqlLockTest(PostgresqlBaseTest):
@@ -51,6 +50,8 @@ class PostgresqlLockTest(PostgresqlBaseTest):
          l.mode <> 'AccessShareLock' -- レコードが多くなり見辛くなるので対象外
          and
          l.pid <> pg_backend_pid()  -- このクエリ実行自体は対象外
+         and
+         s.datname = current_database()  -- 並列実行時の他ワーカーのセッションは対象外
         order by
          l.pid,
          l.locktype,
@@ -65,17 +66,17 @@ class PostgresqlLockTest(PostgresqlBaseTest):
         t_a_conn = self.create_connection()
         t_a_cur = t_a_conn.cursor()
         t_a_cur.execute("SELECT pg_backend_pid()")
-        p_a = str(t_a_cur.fetchone()[0]).rjust(5)
+        p_a = t_a_cur.fetchone()[0]
 
         t_b_conn = self.create_connection()
         t_b_cur = t_b_conn.cursor()
         t_b_cur.execute("SELECT pg_backend_pid()")
-        p_b = str(t_b_cur.fetchone()[0]).rjust(5)
+        p_b = t_b_cur.fetchone()[0]
 
         t_c_conn = self.create_connection()
         t_c_cur = t_c_conn.cursor()
         t_c_cur.execute("SELECT pg_backend_pid()")
-        p_c = str(t_c_cur.fetchone()[0]).rjust(5)
+        p_c = t_c_cur.fetchone()[0]
 
         t_check_conn = self.create_connection()
         t_check_cur = t_check_conn.cursor(row_factory=dict_row)
@@ -86,14 +87,8 @@ class PostgresqlLockTest(PostgresqlBaseTest):
         t_c_cur.execute("BEGIN")
 
         t_check_cur.execute(check_lock_query)
-        actual = t_check_cur.fetchall()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="left"
-        )
-
-        self.assertEqual(
-            actual_table,
-            f"""
+        self.assertTableEqual(
+            """
 +-------+------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------+
 |   pid | locktype   | table_name   | page   | tuple   | transactionid   | mode          | granted   | state               |
 |-------+------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------|
@@ -101,19 +96,19 @@ class PostgresqlLockTest(PostgresqlBaseTest):
 | {p_b} | virtualxid |              |        |         |                 | ExclusiveLock | True      | idle in transaction |
 | {p_c} | virtualxid |              |        |         |                 | ExclusiveLock | True      | idle in transaction |
 +-------+------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------+
-""".strip(),
+""",
+            t_check_cur.fetchall(),
+            p_a=p_a,
+            p_b=p_b,
+            p_c=p_c,
         )
 
         # Aがselect for update
         t_a_cur.execute("SELECT * FROM users WHERE id=1 FOR UPDATE")
         t_a_cur.execute("SELECT txid_current()")
-        t_a = str(t_a_cur.fetchone()[0]).rjust(5)
+        t_a = t_a_cur.fetchone()[0]
 
         t_check_cur.execute(check_lock_query)
-        actual = t_check_cur.fetchall()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="right"
-        )
 
         # 待ちの state は active になるとのことだったが、idle in transaction になっている
         # 実際にpsqlで確認したら active だったが。stateの詳細は以下
@@ -126,9 +121,8 @@ class PostgresqlLockTest(PostgresqlBaseTest):
         # | idle in transaction (aborted)        | この状態はidle in transactionと似ていますが、トランザクション内のある文がエラーになっている点が異なります。       |
         # | fastpath function call               | バックエンドは近道関数を実行中です。                                                     |
         # | disabled                             | この状態は、このバックエンドでtrack\_activitiesが無効である場合に報告されます。                         |
-        self.assertEqual(
-            actual_table,
-            f"""
+        self.assertTableEqual(
+            """
 +-------+---------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------+
 |   pid |      locktype |   table_name |   page |   tuple |   transactionid |          mode |   granted |               state |
 |-------+---------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------|
@@ -139,25 +133,22 @@ class PostgresqlLockTest(PostgresqlBaseTest):
 | {p_b} |    virtualxid |              |        |         |                 | ExclusiveLock |      True | idle in transaction |
 | {p_c} |    virtualxid |              |        |         |                 | ExclusiveLock |      True | idle in transaction |
 +-------+---------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------+
-""".strip(),
+""",
+            t_check_cur.fetchall(),
+            p_a=p_a,
+            p_b=p_b,
+            p_c=p_c,
+            t_a=t_a,
         )
 
         # Bがselect for update
-        thread_b = threading.Thread(
-            target=t_b_cur.execute, args=("SELECT * FROM users WHERE id=1 FOR UPDATE",)
+        thread_b = self.start_blocking(
+            t_b_conn, t_b_cur.execute, "SELECT * FROM users WHERE id=1 FOR UPDATE"
         )
-        thread_b.start()
-        thread_b.join(timeout=0.1)
 
         t_check_cur.execute(check_lock_query)
-        actual = t_check_cur.fetchall()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="right"
-        )
-
-        self.assertEqual(
-            actual_table,
-            f"""
+        self.assertTableEqual(
+            """
 +-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------+
 |   pid |      locktype |   table_name |   page |   tuple |   transactionid |                mode |   granted |               state |
 |-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------|
@@ -172,25 +163,22 @@ class PostgresqlLockTest(PostgresqlBaseTest):
 | {p_b} |    virtualxid |              |        |         |                 |       ExclusiveLock |      True | idle in transaction |
 | {p_c} |    virtualxid |              |        |         |                 |       ExclusiveLock |      True | idle in transaction |
 +-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------+
-""".strip(),
+""",
+            t_check_cur.fetchall(),
+            p_a=p_a,
+            p_b=p_b,
+            p_c=p_c,
+            t_a=t_a,
         )
 
         # Cがselect for update
-        thread_c = threading.Thread(
-            target=t_c_cur.execute, args=("SELECT * FROM users WHERE id=1 FOR UPDATE",)
+        thread_c = self.start_blocking(
+            t_c_conn, t_c_cur.execute, "SELECT * FROM users WHERE id=1 FOR UPDATE"
         )
-        thread_c.start()
-        thread_c.join(timeout=0.1)
 
         t_check_cur.execute(check_lock_query)
-        actual = t_check_cur.fetchall()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="right"
-        )
-
-        self.assertEqual(
-            actual_table,
-            f"""
+        self.assertTableEqual(
+            """
 +-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------+
 |   pid |      locktype |   table_name |   page |   tuple |   transactionid |                mode |   granted |               state |
 |-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------|
@@ -208,7 +196,12 @@ class PostgresqlLockTest(PostgresqlBaseTest):
 | {p_c} |         tuple |        users |      0 |       1 |                 | AccessExclusiveLock |     False | idle in transaction |
 | {p_c} |    virtualxid |              |        |         |                 |       ExclusiveLock |      True | idle in transaction |
 +-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------+
-""".strip(),
+""",
+            t_check_cur.fetchall(),
+            p_a=p_a,
+            p_b=p_b,
+            p_c=p_c,
+            t_a=t_a,
         )
 
         # Aがcommit
@@ -216,17 +209,11 @@ class PostgresqlLockTest(PostgresqlBaseTest):
 
         thread_b.join()
         t_b_cur.execute("SELECT txid_current()")
-        t_b = str(t_b_cur.fetchone()[0]).rjust(5)
+        t_b = t_b_cur.fetchone()[0]
 
         t_check_cur.execute(check_lock_query)
-        actual = t_check_cur.fetchall()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="right"
-        )
-
-        self.assertEqual(
-            actual_table,
-            f"""
+        self.assertTableEqual(
+            """
 +-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------+
 |   pid |      locktype |   table_name |   page |   tuple |   transactionid |                mode |   granted |               state |
 |-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------|
@@ -240,7 +227,11 @@ class PostgresqlLockTest(PostgresqlBaseTest):
 | {p_c} |         tuple |        users |      0 |       1 |                 | AccessExclusiveLock |      True | idle in transaction |
 | {p_c} |    virtualxid |              |        |         |                 |       ExclusiveLock |      True | idle in transaction |
 +-------+---------------+--------------+--------+---------+-----------------+---------------------+-----------+---------------------+
-""".strip(),
+""",
+            t_check_cur.fetchall(),
+            p_b=p_b,
+            p_c=p_c,
+            t_b=t_b,
         )
 
         # Bがcommit
@@ -248,17 +239,11 @@ class PostgresqlLockTest(PostgresqlBaseTest):
 
         thread_c.join()
         t_c_cur.execute("SELECT txid_current()")
-        t_c = str(t_c_cur.fetchone()[0]).rjust(5)
+        t_c = t_c_cur.fetchone()[0]
 
         t_check_cur.execute(check_lock_query)
-        actual = t_check_cur.fetchall()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="right"
-        )
-
-        self.assertEqual(
-            actual_table,
-            f"""
+        self.assertTableEqual(
+            """
 +-------+---------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------+
 |   pid |      locktype |   table_name |   page |   tuple |   transactionid |          mode |   granted |               state |
 |-------+---------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------|
@@ -267,7 +252,10 @@ class PostgresqlLockTest(PostgresqlBaseTest):
 | {p_c} | transactionid |              |        |         |           {t_c} | ExclusiveLock |      True | idle in transaction |
 | {p_c} |    virtualxid |              |        |         |                 | ExclusiveLock |      True | idle in transaction |
 +-------+---------------+--------------+--------+---------+-----------------+---------------+-----------+---------------------+
-""".strip(),
+""",
+            t_check_cur.fetchall(),
+            p_c=p_c,
+            t_c=t_c,
         )
 
         # Cがcommit
@@ -276,3 +264,77 @@ class PostgresqlLockTest(PostgresqlBaseTest):
         t_check_cur.execute(check_lock_query)
         actual = t_check_cur.fetchall()
         self.assertEqual(len(actual), 0)
+
+
+class PostgresqlLockAsyncTest(PostgresqlAsyncBaseTest):
+    """
+    https://qiita.com/behiron/items/571562ea33b8212a4c32
+    """
+
+    async def test_lock_queue(self):
+        """
+        基本的な例をセッション数を増やして試す
+
+        id=1 を A が select for update している間に、多数のセッションが順番に select for update して待ち行列になる。
+        A が commit すると、先頭から 1 つずつロックを取得して commit していく。
+        """
+        await self.setup_tables(
+            """
+        drop table if exists users;
+        create table users
+        (
+            id  integer constraint users_pkey primary key,
+            user_type   integer
+        );
+        INSERT INTO users (id, user_type) VALUES (1,1);
+        INSERT INTO users (id, user_type) VALUES (2,1);
+        INSERT INTO users (id, user_type) VALUES (3,1);
+        """
+        )
+        sessions = 20
+
+        t_check_conn = await self.create_connection()
+        await t_check_conn.set_autocommit(True)
+        t_check_cur = t_check_conn.cursor(row_factory=dict_row)
+
+        t_a_conn = await self.create_connection()
+        await t_a_conn.execute("SELECT * FROM users WHERE id=1 FOR UPDATE")
+
+        acquired = []
+
+        async def select_for_update(conn):
+            await conn.execute("SELECT * FROM users WHERE id=1 FOR UPDATE")
+            acquired.append(conn.info.backend_pid)
+            await conn.commit()
+
+        waiters = [await self.create_connection() for _ in range(sessions)]
+        tasks = [
+            await self.start_blocking(conn, select_for_update(conn)) for conn in waiters
+        ]
+
+        await t_check_cur.execute(
+            """
+        select
+            count(*) as waiting
+        from
+            pg_stat_activity
+        where
+            datname = current_database()
+            and cardinality(pg_blocking_pids(pid)) > 0
+        """
+        )
+        self.assertTableEqual(
+            f"""
++-----------+
+|   waiting |
+|-----------|
+| {sessions:>9} |
++-----------+
+""",
+            await t_check_cur.fetchall(),
+        )
+
+        # A が commit すると、待っていた順にロックを取得する
+        await t_a_conn.commit()
+        await asyncio.gather(*tasks)
+        self.assertListEqual(acquired, [conn.info.backend_pid for conn in waiters])
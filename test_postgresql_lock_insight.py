@@ -1,9 +1,8 @@
-import re
-import threading
 import time
 
 from psycopg.rows import dict_row
 
+from pg_log import PostgresqlLogTailer
 from util import PostgresqlBaseTest
 
 
@@ -44,18 +43,19 @@ class PostgresqlInsightTest(PostgresqlBaseTest):
         t_check_cur.execute("select count(*) as cnt from pg_stat_statements")
         stat_count_before = t_check_cur.fetchall()[0]["cnt"]
 
+        # ここから後に書かれたログだけを読む
+        log = PostgresqlLogTailer()
+
         t_a_cur.execute("BEGIN")
         t_b_cur.execute("BEGIN")
 
         t_a_cur.execute("SELECT 'lock from a' FROM test_table_a WHERE i = 1 FOR UPDATE")
 
-        thread_b = threading.Thread(
-            target=lambda: t_b_cur.execute(
-                "SELECT 'lock from b' FROM test_table_a WHERE i = 1 FOR UPDATE"
-            )
+        thread_b = self.start_blocking(
+            t_b_conn,
+            t_b_cur.execute,
+            "SELECT 'lock from b' FROM test_table_a WHERE i = 1 FOR UPDATE",
         )
-        thread_b.start()
-        thread_b.join(timeout=0.5)
 
         """
         ロックの競合元となっているプロセスの情報の確認
@@ -71,7 +71,9 @@ class PostgresqlInsightTest(PostgresqlBaseTest):
                 *,
                 unnest(pg_blocking_pids(pid)) as blocking_pid
             from
-                pg_stat_activity) as waiting
+                pg_stat_activity
+            where
+                datname = current_database()) as waiting
             join
                 pg_stat_activity as blocking
             on
@@ -97,6 +99,11 @@ class PostgresqlInsightTest(PostgresqlBaseTest):
             actual,
         )
 
+        # 待ちの関係をグラフにすると、先頭で待たせているのは a だとわかる
+        graph = self.wait_for_graph(t_check_conn)
+        self.assertListEqual(graph.root_blockers(), [t_a_conn.info.backend_pid])
+        self.assertDictEqual(graph.stall_counts(), {t_a_conn.info.backend_pid: 1})
+
         """
         ロック競合の確認方法
         """
@@ -106,15 +113,21 @@ class PostgresqlInsightTest(PostgresqlBaseTest):
         self.assertEqual(actual[0]["log_lock_waits"], "on")
 
         # クエリが実行されるとログが出力される（≒ロック待ちになっている間はロギングされない）
+        # log_min_duration_statement (100ms) を超えるまでロック待ちさせてからロールバックする
+        time.sleep(0.2)
         t_a_cur.execute("ROLLBACK")
         thread_b.join()
-        time.sleep(1.0)
 
-        with open("/var/log/postgresql/postgresql.log") as f:
-            logs = "\n".join([l.rstrip() for l in f if f"[{p_b.strip()}]" in l])
-        self.assertIn("there is already a transaction in progress", logs)
+        pid_b = t_b_conn.info.backend_pid
+        duration = log.wait_for(pid=pid_b, kind="duration")
+        self.assertEqual(
+            duration.query,
+            "SELECT 'lock from b' FROM test_table_a WHERE i = 1 FOR UPDATE",
+        )
+        self.assertGreater(duration.duration_ms, 100)
         self.assertIn(
-            "SELECT 'lock from b' FROM test_table_a WHERE i = 1 FOR UPDATE", logs
+            "there is already a transaction in progress",
+            [event.message for event in log.find(pid=pid_b, severity="WARNING")],
         )
 
         """
@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+from scenario import CHECK, Scenario, Step, group_scenarios
+
+
+class ScenarioTest(TestCase):
+    def test_steps_and_sessions(self):
+        scenario = Scenario(
+            name="gap_lock",
+            engine="mysql",
+            steps=[
+                "B: BEGIN",
+                "A: SELECT * FROM t1 WHERE val = 'a:b' FOR UPDATE",
+                Step(CHECK, "SELECT * FROM performance_schema.data_locks"),
+                Step("C", "INSERT INTO t1 VALUES (10, 'ju', 2)", blocks=True),
+            ],
+        )
+        self.assertEqual(
+            scenario.steps[1],
+            Step("A", "SELECT * FROM t1 WHERE val = 'a:b' FOR UPDATE"),
+        )
+        self.assertListEqual(scenario.sessions, ["B", "A", "C"])
+
+    def test_group_scenarios(self):
+        t1 = "DROP TABLE IF EXISTS t1; CREATE TABLE t1 (num int);"
+        t2 = "DROP TABLE IF EXISTS t2; CREATE TABLE t2 (num int);"
+        both = t1 + t2
+        t3 = "DROP TABLE IF EXISTS t3; CREATE TABLE t3 (num int);"
+        scenarios = [
+            Scenario("a", "mysql", t1),
+            Scenario("b", "mysql", t2),
+            Scenario("c", "mysql", t3),
+            # t1 と t2 の両方を使うので a と b を同じグループにまとめる
+            Scenario("d", "mysql", both),
+            # エンジンが違えば同じ名前のテーブルでも別物
+            Scenario("e", "postgresql", t1),
+            Scenario("f", "mysql"),
+            Scenario("g", "mysql", "UPDATE t1 SET num = 0"),
+        ]
+        groups, isolated = group_scenarios(scenarios)
+        self.assertEqual(sorted(groups), [[0, 1, 3], [2], [4]])
+        self.assertEqual(isolated, [5, 6])
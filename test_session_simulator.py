@@ -0,0 +1,47 @@
+from session_simulator import SPOTS, simulate
+from util import MySqlAsyncBaseTest, PostgresqlAsyncBaseTest
+
+
+class MySqlSessionSimulatorTest(MySqlAsyncBaseTest):
+    async def test_hot_row(self):
+        monitor = await self.create_connection(root=True)
+        await monitor.set_autocommit(True)
+
+        result = await simulate(
+            "mysql", self.create_connection, monitor, SPOTS["t1_row"], sessions=30
+        )
+        self.assertEqual(result["peak_queue_depth"], 30)
+        self.assertDictEqual(result["outcomes"], {"ok": 30})
+        self.assertEqual(result["queue_depth"][-1][1], 0)
+        self.assertGreater(result["memory_per_waiting_session"], 0)
+
+
+class PostgresqlSessionSimulatorTest(PostgresqlAsyncBaseTest):
+    async def test_hot_rows(self):
+        monitor = await self.create_connection()
+        await monitor.set_autocommit(True)
+
+        result = await simulate(
+            "postgresql",
+            self.create_connection,
+            monitor,
+            SPOTS["lock_sample_row"],
+            sessions=30,
+            hot_rows=3,
+        )
+        self.assertEqual(result["peak_queue_depth"], 30)
+        self.assertDictEqual(result["outcomes"], {"ok": 30})
+        self.assertIsNone(result["memory_per_waiting_session"])
+
+    async def test_gap_is_not_locked(self):
+        """
+        PostgreSQL にはギャップロックがないので、FOR UPDATE の範囲の手前への INSERT は待たされない
+        """
+        monitor = await self.create_connection()
+        await monitor.set_autocommit(True)
+
+        result = await simulate(
+            "postgresql", self.create_connection, monitor, SPOTS["t1_gap"], sessions=10
+        )
+        self.assertEqual(result["peak_queue_depth"], 0)
+        self.assertDictEqual(result["outcomes"], {"ok": 10})
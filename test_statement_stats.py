@@ -0,0 +1,124 @@
+import time
+from unittest import TestCase
+
+from statement_stats import (
+    Histogram,
+    MySqlLockTime,
+    StatementStats,
+    fingerprint,
+    instrument,
+    uninstrument,
+)
+from util import MySqlBaseTest, classify_error
+
+
+class FingerprintTest(TestCase):
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint(
+                "SELECT * FROM t1\n  WHERE num IN (1, 2, 3) AND val = 'a''b' FOR UPDATE;"
+            ),
+            "select * from t1 where num in (...) and val = ? for update",
+        )
+        self.assertEqual(
+            fingerprint("INSERT INTO t1 (num, val) VALUES (1, 'x'), (2, 'y')"),
+            "insert into t1 (num, val) values (...)",
+        )
+        self.assertEqual(
+            fingerprint("select * from users where id = $1"),
+            fingerprint("SELECT * FROM users WHERE id = %s"),
+        )
+
+
+class HistogramTest(TestCase):
+    def test_percentile(self):
+        histogram = Histogram()
+        for i in range(1, 10001):
+            histogram.record(i / 10000)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 10000)
+        self.assertEqual(summary["min_ms"], 0.1)
+        self.assertEqual(summary["max_ms"], 1000.0)
+        # 値はバケットの幅 (1/128) の範囲で丸められる
+        for p in (50, 90, 99):
+            self.assertAlmostEqual(summary[f"p{p}_ms"], p * 10, delta=p * 10 / 128)
+
+    def test_merge_and_round_trip(self):
+        a, b = Histogram(), Histogram()
+        for seconds in (0.001, 0.002, 0.5):
+            a.record(seconds)
+        b.record(2.0)
+        a.merge(b)
+        self.assertEqual(a.count, 4)
+        self.assertEqual(a.max, 2_000_000)
+        self.assertEqual(Histogram.from_dict(a.to_dict()).summary(), a.summary())
+
+
+class StatementStatsTest(TestCase):
+    def test_record_and_merge(self):
+        a, b = StatementStats(), StatementStats()
+        a.record("mysql", "UPDATE t1 SET val = 'x' WHERE num = 1", "ok", 0.01, 0.005)
+        b.record("mysql", "UPDATE t1 SET val = 'y' WHERE num = 2", "ok", 0.02)
+        b.record("mysql", "UPDATE t1 SET val = 'y' WHERE num = 2", "timeout", 5.0)
+        a.merge(StatementStats.from_dict(b.to_dict()))
+
+        statements = a.to_dict()["statements"]
+        self.assertEqual(
+            [
+                (s["outcome"], s["wall"]["count"], s["lock"]["count"])
+                for s in statements
+            ],
+            [("ok", 2, 1), ("timeout", 1, 0)],
+        )
+        self.assertEqual(
+            statements[0]["fingerprint"], "update t1 set val = ? where num = ?"
+        )
+
+
+class MySqlStatementStatsTest(MySqlBaseTest):
+    def test_lock_time(self):
+        self.setup_tables(
+            """
+        DROP TABLE IF EXISTS `lock_sample`;
+        CREATE TABLE `lock_sample` (
+            `id` bigint(20) NOT NULL,
+            `val1` int(11) NOT NULL,
+            PRIMARY KEY (`id`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        INSERT INTO `lock_sample` (`id`, `val1`) VALUES (1, 1), (2, 2);
+        """
+        )
+        stats = StatementStats()
+        monitor = self.create_connection(root=True)
+        monitor.autocommit = True
+        conn_a = self.create_connection()
+        conn_b = instrument(
+            self.create_connection(fresh=True),
+            "mysql",
+            stats,
+            classify_error,
+            MySqlLockTime(monitor),
+        )
+        self.addCleanup(uninstrument, conn_b)
+
+        cur_a = conn_a.cursor()
+        cur_a.execute("SELECT * FROM lock_sample WHERE id = 1 FOR UPDATE")
+        cur_a.fetchall()
+
+        cur_b = conn_b.cursor()
+        thread = self.start_blocking(
+            conn_b, cur_b.execute, "SELECT * FROM lock_sample WHERE id = 1 FOR UPDATE"
+        )
+        time.sleep(0.2)
+        conn_a.rollback()
+        thread.join()
+        cur_b.fetchall()
+
+        (statement,) = stats.to_dict()["statements"]
+        self.assertEqual(
+            statement["fingerprint"],
+            "select * from lock_sample where id = ? for update",
+        )
+        self.assertEqual(statement["outcome"], "ok")
+        self.assertGreaterEqual(statement["wall"]["max_ms"], 200)
+        self.assertGreaterEqual(statement["lock"]["max_ms"], 150)
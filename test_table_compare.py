@@ -0,0 +1,95 @@
+from unittest import TestCase
+
+from table_compare import compare_table, parse_table
+
+EXPECTED = """
++-------+---------------+-----------------+-----------+
+|   pid | locktype      |   transactionid | granted   |
+|-------+---------------+-----------------+-----------|
+| {p_a} | transactionid |           {t_a} | True      |
+| {p_b} | virtualxid    |                 | False     |
++-------+---------------+-----------------+-----------+
+"""
+
+
+class TableCompareTest(TestCase):
+    def test_parse_table(self):
+        table = parse_table(EXPECTED)
+        self.assertEqual(table.headers, ("pid", "locktype", "transactionid", "granted"))
+        self.assertEqual(
+            table.rows,
+            [
+                ("{p_a}", "transactionid", "{t_a}", "True"),
+                ("{p_b}", "virtualxid", "", "False"),
+            ],
+        )
+        self.assertEqual(
+            table.placeholders, {(0, 0): "p_a", (0, 2): "t_a", (1, 0): "p_b"}
+        )
+        self.assertIs(parse_table(EXPECTED), table)
+
+    def test_match(self):
+        actual = [
+            {
+                "pid": 10,
+                "locktype": "transactionid",
+                "transactionid": 700,
+                "granted": True,
+            },
+            {
+                "pid": 11,
+                "locktype": "virtualxid",
+                "transactionid": None,
+                "granted": False,
+            },
+        ]
+        self.assertIsNone(compare_table(EXPECTED, actual, p_a=10, p_b=11, t_a=700))
+        self.assertIsNone(
+            compare_table(
+                EXPECTED,
+                [tuple(row.values()) for row in actual],
+                p_a=10,
+                p_b=11,
+                t_a=700,
+            )
+        )
+
+    def test_cell_diff(self):
+        actual = [
+            {
+                "pid": 10,
+                "locktype": "transactionid",
+                "transactionid": 701,
+                "granted": True,
+            },
+            {
+                "pid": 11,
+                "locktype": "virtualxid",
+                "transactionid": None,
+                "granted": True,
+            },
+        ]
+        message = compare_table(EXPECTED, actual, p_a=10, p_b=11, t_a=700)
+        self.assertEqual(
+            message.splitlines()[:2],
+            [
+                "row 1, transactionid: expected '700' but '701'",
+                "row 2, granted: expected 'False' but 'True'",
+            ],
+        )
+        self.assertIn(
+            "|    11 | virtualxid    |                 | False     |", message
+        )
+        self.assertIn(
+            "|    11 | virtualxid    |                 | True      |", message
+        )
+
+    def test_shape_diff(self):
+        self.assertEqual(
+            compare_table(EXPECTED, [{"pid": 10}], p_a=10).splitlines()[0],
+            "expected columns ['pid', 'locktype', 'transactionid', 'granted'] but ['pid']",
+        )
+        self.assertEqual(
+            compare_table(EXPECTED, []).splitlines()[0], "expected 2 rows but 0"
+        )
+        self.assertIsNone(compare_table("", []))
@@ -0,0 +1,246 @@
+import io
+import json
+import time
+from unittest import TestCase
+
+from trx_profiler import (
+    IDLE_FRAME,
+    TrxProfiler,
+    capture_mysql,
+    capture_postgresql,
+    mysql_outcomes,
+)
+from util import MySqlBaseTest, PostgresqlBaseTest
+
+
+def trx(
+    session,
+    lock_structs,
+    statement,
+    idle=False,
+    rows_locked=None,
+    started=1.0,
+    trx_id=None,
+    provisional=False,
+    event=None,
+):
+    return {
+        "session": session,
+        "trx_id": trx_id if trx_id is not None else f"{session}-{started}",
+        "provisional": provisional,
+        "event": event,
+        "started": started,
+        "lock_structs": lock_structs,
+        "rows_locked": rows_locked,
+        "idle": idle,
+        "statement": statement,
+    }
+
+
+class TrxProfilerTest(TestCase):
+    def test_profile(self):
+        samples = iter(
+            [
+                ([trx(8, 0, "BEGIN")], 10.0),
+                (
+                    [trx(8, 2, "SELECT * FROM t1 WHERE num = 1 FOR UPDATE", True, 1)],
+                    10.5,
+                ),
+                ([trx(8, 3, "UPDATE t1 SET val = 'x' WHERE num = 2", False, 2)], 11.5),
+                ([trx(8, 3, "UPDATE t1 SET val = 'x' WHERE num = 2", True, 2)], 12.0),
+                ([trx(9, 0, "BEGIN", started=12.5)], 13.0),
+            ]
+        )
+        profiler = TrxProfiler(
+            lambda: next(samples), outcomes=lambda sessions: {8: "COMMITTED"}
+        )
+        for _ in range(5):
+            profiler.sample()
+
+        profile, other = profiler.profiles()
+        self.assertEqual((profile.session, other.session), (8, 9))
+        self.assertEqual(profile.first_locked, 10.5)
+        self.assertEqual(profile.ended, 13.0)
+        self.assertEqual(profile.outcome, "COMMITTED")
+        self.assertEqual(profile.max_lock_structs, 3)
+        self.assertEqual(profile.max_rows_locked, 2)
+        self.assertEqual(profile.idle_seconds, 2.0)
+        self.assertEqual(profile.lock_hold_seconds, 2.5)
+        self.assertEqual(
+            [entry[1:] for entry in profile.series], [(0, None), (2, 1), (3, 2)]
+        )
+
+        self.assertEqual(
+            profiler.folded(),
+            [
+                "begin;select * from t1 where num = ? for update;"
+                "(idle in transaction) 1000000",
+                "begin;update t1 set val = ? where num = ? 500000",
+                "begin;update t1 set val = ? where num = ?;"
+                "(idle in transaction) 1000000",
+            ],
+        )
+
+        f = io.StringIO()
+        profiler.export_json(f)
+        (exported, _) = json.loads(f.getvalue())
+        self.assertEqual(exported["duration"], 12.0)
+        self.assertEqual(exported["outcome"], "COMMITTED")
+
+    def test_same_started(self):
+        """
+        trx_started は秒単位なので、同じ秒に続けて始まったトランザクションはトランザクション ID で区別する
+        """
+        samples = iter(
+            [
+                ([trx(8, 2, "UPDATE t1 SET val = 1", trx_id=100, started=5.0)], 5.0),
+                ([trx(8, 2, "DELETE FROM t1", trx_id=101, started=5.0)], 5.5),
+                ([], 5.75),
+            ]
+        )
+        outcomes = iter(["COMMITTED", "ROLLED BACK"])
+        profiler = TrxProfiler(
+            lambda: next(samples), outcomes=lambda sessions: {8: next(outcomes)}
+        )
+        for _ in range(3):
+            profiler.sample()
+
+        first, second = sorted(profiler.profiles(), key=lambda p: p.trx_id)
+        self.assertEqual((first.trx_id, second.trx_id), (100, 101))
+        self.assertEqual((first.ended, first.outcome), (5.5, "COMMITTED"))
+        self.assertEqual((second.ended, second.outcome), (5.75, "ROLLED BACK"))
+        self.assertEqual(first.hold, {("update t1 set val = ?",): 0.5})
+        self.assertEqual(second.hold, {("delete from t1",): 0.25})
+
+    def test_provisional(self):
+        """
+        読み込みのみのトランザクションの仮の ID は、本当の ID に変わっても同じトランザクションとして扱い、
+        同じセッションの次のトランザクションで使い回されたら別のトランザクションとして扱う
+        """
+
+        def read_only(lock_structs, statement, event):
+            return trx(
+                8,
+                lock_structs,
+                statement,
+                trx_id=2**48 + 8,
+                provisional=True,
+                event=event,
+            )
+
+        samples = iter(
+            [
+                ([read_only(2, "SELECT * FROM t1 FOR SHARE", 10)], 1.0),
+                ([trx(8, 3, "UPDATE t1 SET val = 1", trx_id=200, event=10)], 2.0),
+                ([read_only(0, "BEGIN", 12)], 3.0),
+                ([read_only(1, "SELECT * FROM t1 FOR SHARE", 13)], 4.0),
+            ]
+        )
+        profiler = TrxProfiler(lambda: next(samples))
+        for _ in range(4):
+            profiler.sample()
+
+        promoted, reused, current = sorted(
+            profiler.profiles(), key=lambda p: p.first_seen
+        )
+        self.assertEqual((promoted.trx_id, promoted.ended), (200, 3.0))
+        self.assertEqual(promoted.max_lock_structs, 3)
+        self.assertEqual((reused.event, reused.ended), (12, 4.0))
+        self.assertEqual((current.event, current.ended), (13, None))
+
+    def test_capture_error(self):
+        def capture():
+            if profiler.samples:
+                raise ConnectionError("monitor connection lost")
+            return [trx(8, 1, "BEGIN")], 1.0
+
+        profiler = TrxProfiler(capture, interval=0.01)
+        profiler.start()
+        profiler._thread.join(timeout=5)
+        with self.assertRaises(ConnectionError):
+            profiler.stop()
+
+
+class MySqlTrxProfilerTest(MySqlBaseTest):
+    def test_profile(self):
+        self.setup_tables(
+            """
+        DROP TABLE IF EXISTS `t1`;
+        CREATE TABLE `t1` (
+          `num` int NOT NULL,
+          `val` varchar(32) NOT NULL,
+          PRIMARY KEY (`num`)
+        ) ENGINE=InnoDB;
+        INSERT INTO `t1` (`num`, `val`) VALUES (1, 'one'), (2, 'two');
+        """
+        )
+        conn_chk = self.create_connection(root=True)
+        conn_chk.autocommit = True
+        profiler = TrxProfiler(
+            lambda: capture_mysql(conn_chk, schema=self.database),
+            lambda sessions: mysql_outcomes(conn_chk, sessions),
+        )
+
+        conn1 = self.create_connection()
+        cur1 = conn1.cursor()
+        cur1.execute("BEGIN")
+        cur1.execute("SELECT * FROM t1 WHERE num = 1 FOR UPDATE")
+        cur1.fetchall()
+        profiler.sample()
+        time.sleep(0.2)
+        cur1.execute("UPDATE t1 SET val = 'x' WHERE num = 2")
+        profiler.sample()
+        cur1.execute("COMMIT")
+        profiler.sample()
+
+        (profile,) = [
+            profile
+            for profile in profiler.profiles()
+            if profile.session == conn1.connection_id
+        ]
+        self.assertEqual(profile.outcome, "COMMITTED")
+        self.assertIsNotNone(profile.first_locked)
+        self.assertGreaterEqual(profile.max_lock_structs, 2)
+        self.assertGreaterEqual(profile.max_rows_locked, 2)
+        self.assertGreater(profile.idle_seconds, 0.1)
+        self.assertIn(
+            ("select * from t1 where num = ? for update", IDLE_FRAME),
+            profile.hold,
+        )
+
+
+class PostgresqlTrxProfilerTest(PostgresqlBaseTest):
+    def test_profile(self):
+        self.setup_tables(
+            """
+        drop table if exists t1;
+        create table t1 (num integer primary key, val varchar(32) not null);
+        insert into t1 (num, val) values (1, 'one'), (2, 'two');
+        """
+        )
+        conn_chk = self.create_connection()
+        conn_chk.autocommit = True
+        profiler = TrxProfiler(
+            lambda: capture_postgresql(conn_chk, database=self.database)
+        )
+
+        conn1 = self.create_connection()
+        cur1 = conn1.cursor()
+        cur1.execute("select * from t1 where num = 1 for update")
+        cur1.fetchall()
+        (pid,) = cur1.execute("select pg_backend_pid()").fetchone()
+        profiler.sample()
+        time.sleep(0.2)
+        profiler.sample()
+        conn1.rollback()
+        profiler.sample()
+
+        (profile,) = [
+            profile for profile in profiler.profiles() if profile.session == pid
+        ]
+        self.assertIsNotNone(profile.ended)
+        self.assertGreater(profile.max_lock_structs, 0)
+        # 行ロックはタプルに書かれるので、待たせていない限り pg_locks には現れない
+        self.assertEqual(profile.max_rows_locked, 0)
+        self.assertGreater(profile.lock_hold_seconds, 0.1)
+        self.assertGreater(profile.idle_seconds, 0.1)
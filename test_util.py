@@ -0,0 +1,211 @@
+from os import environ
+from unittest import TestCase, mock
+
+import psycopg
+from mysql import connector
+
+import util
+from util import (
+    LockSnapshot,
+    classify_error,
+    fixture_plan,
+    forget_script_tables,
+    join_sql,
+    lock_kind,
+    split_sql,
+)
+
+
+class SplitSqlTest(TestCase):
+    def test_split_statements(self):
+        self.assertListEqual(
+            split_sql(
+                """
+        DROP TABLE IF EXISTS `t1`;
+        CREATE TABLE `t1` (`num` int NOT NULL, PRIMARY KEY (`num`));
+        INSERT INTO `t1` (`num`) VALUES (1), (2);
+        """
+            ),
+            [
+                "DROP TABLE IF EXISTS `t1`",
+                "CREATE TABLE `t1` (`num` int NOT NULL, PRIMARY KEY (`num`))",
+                "INSERT INTO `t1` (`num`) VALUES (1), (2)",
+            ],
+        )
+
+    def test_semicolon_in_literals_and_comments(self):
+        self.assertListEqual(
+            split_sql(
+                "INSERT INTO t VALUES ('a;b', 'it''s', 'c\\';d', `e;f`); -- g;\n"
+                "/* h; */ SELECT 1 # i;\n;"
+            ),
+            [
+                "INSERT INTO t VALUES ('a;b', 'it''s', 'c\\';d', `e;f`)",
+                "-- g;\n/* h; */ SELECT 1 # i;",
+            ],
+        )
+
+    def test_comment_only_fragment_is_dropped(self):
+        self.assertListEqual(split_sql("SELECT 1; -- done\n"), ["SELECT 1"])
+        self.assertListEqual(
+            split_sql("/*!40101 SET NAMES utf8mb4 */;"),
+            ["/*!40101 SET NAMES utf8mb4 */"],
+        )
+
+    def test_join_keeps_trailing_comment(self):
+        statements = split_sql("SELECT 1 -- c\n; SELECT 2 # d\n; SELECT 3")
+        self.assertListEqual(statements, ["SELECT 1 -- c", "SELECT 2 # d", "SELECT 3"])
+        self.assertListEqual(split_sql(join_sql(statements)), statements)
+
+        script = """
+        INSERT INTO `t1` (`num`) VALUES
+            (1), -- one
+            (2) -- two
+        ;
+        INSERT INTO `t1` (`num`) VALUES (3);
+        """
+        self.assertEqual(len(split_sql(join_sql(split_sql(script)))), 2)
+
+    def test_postgresql_dollar_quote(self):
+        self.assertListEqual(
+            split_sql(
+                "create function f() returns int as $body$ select 1; $body$ "
+                "language sql; select 'a\\'; select E'b\\';c'",
+                dialect="postgresql",
+            ),
+            [
+                "create function f() returns int as $body$ select 1; $body$ "
+                "language sql",
+                "select 'a\\'",
+                "select E'b\\';c'",
+            ],
+        )
+
+
+class FixturePlanTest(TestCase):
+    def test_tables_created_by_script(self):
+        script = """
+        DROP TABLE IF EXISTS `lock_sample`;
+        CREATE TABLE `lock_sample` (`id` bigint NOT NULL, PRIMARY KEY (`id`));
+        INSERT INTO `lock_sample` (`id`) VALUES (1), (2);
+        DROP TABLE IF EXISTS `another_sample`;
+        CREATE TABLE `another_sample` (`id` bigint NOT NULL, PRIMARY KEY (`id`));
+        """
+        key, tables = fixture_plan(script, "mysql")
+        self.assertListEqual(tables, ["lock_sample", "another_sample"])
+        self.assertEqual(fixture_plan(script, "mysql")[0], key)
+        self.assertNotEqual(fixture_plan(script.replace("(2)", "(3)"), "mysql")[0], key)
+
+    def test_postgresql_unquoted_names_are_folded(self):
+        _, tables = fixture_plan(
+            "drop table if exists Users; create table Users (id integer);",
+            "postgresql",
+        )
+        self.assertListEqual(tables, ["users"])
+
+    def test_not_reproducible_from_template(self):
+        self.assertIsNone(fixture_plan("INSERT INTO t1 VALUES (1);", "mysql")[1])
+        self.assertIsNone(
+            fixture_plan("CREATE TABLE t1 (id int); UPDATE t1 SET id = 2;", "mysql")[1]
+        )
+
+
+class LockSnapshotTest(TestCase):
+    def setUp(self):
+        self.before = LockSnapshot.from_rows(
+            [
+                (8, 1848, "TABLE", "mysql", "t1", None, "IX", True, None),
+                (8, 1848, "RECORD", "mysql", "t1", "PRIMARY", "X", True, "1"),
+            ]
+        )
+        self.after = LockSnapshot.from_rows(
+            [
+                (8, 1848, "TABLE", "mysql", "t1", None, "IX", True, None),
+                (9, 1849, "TABLE", "mysql", "t1", None, "IX", True, None),
+                (9, 1849, "RECORD", "mysql", "t1", "PRIMARY", "X", False, "1"),
+            ]
+        )
+
+    def test_filter(self):
+        self.assertEqual(len(self.after.filter(session=9)), 2)
+        self.assertEqual(len(self.after.filter(session=[8, 9], granted=True)), 2)
+        self.assertListEqual(
+            self.after.filter(granted=False).rows(),
+            [
+                {
+                    "session": 9,
+                    "trx": 1849,
+                    "lock_type": "RECORD",
+                    "schema": "mysql",
+                    "table": "t1",
+                    "index": "PRIMARY",
+                    "mode": "X",
+                    "granted": False,
+                    "data": "1",
+                }
+            ],
+        )
+        self.assertEqual(len(LockSnapshot.from_rows([]).filter(session=1)), 0)
+
+    def test_diff(self):
+        acquired, released = self.before.diff(self.after)
+        self.assertListEqual(
+            list(acquired),
+            [
+                (9, 1849, "TABLE", "mysql", "t1", None, "IX", True, None),
+                (9, 1849, "RECORD", "mysql", "t1", "PRIMARY", "X", False, "1"),
+            ],
+        )
+        self.assertListEqual(
+            list(released),
+            [(8, 1848, "RECORD", "mysql", "t1", "PRIMARY", "X", True, "1")],
+        )
+
+
+class ClassifyErrorTest(TestCase):
+    def test_classify_error(self):
+        self.assertEqual(classify_error(connector.Error(errno=1213)), "deadlock")
+        self.assertEqual(classify_error(connector.Error(errno=1205)), "timeout")
+        self.assertIsNone(classify_error(connector.Error(errno=1062)))
+        self.assertEqual(classify_error(psycopg.errors.DeadlockDetected()), "deadlock")
+        self.assertEqual(classify_error(psycopg.errors.LockNotAvailable()), "timeout")
+        self.assertIsNone(classify_error(psycopg.errors.UniqueViolation()))
+
+
+class LockKindTest(TestCase):
+    def test_lock_kind(self):
+        self.assertEqual(
+            [
+                lock_kind(mode)
+                for mode in (
+                    "X",
+                    "S",
+                    "X,GAP",
+                    "X,REC_NOT_GAP",
+                    "X,GAP,INSERT_INTENTION",
+                )
+            ],
+            ["next-key", "next-key", "gap", "record", "insert-intention"],
+        )
+
+
+class ForgetFixturesTest(TestCase):
+    @mock.patch.dict(environ, {"MYSQL_DATABASE": "app"})
+    def test_forget_script_tables(self):
+        state = {
+            (("mysql", "app"), "t1"): "a",
+            (("mysql", "app"), "lock_sample"): "b",
+            (("mysql", "other"), "t1"): "c",
+        }
+        with mock.patch.object(util, "_fixture_state", dict(state)) as fixture_state:
+            # t1 を作り直すスクリプトは t1 の記録だけを消す
+            forget_script_tables(
+                "mysql", "DROP TABLE IF EXISTS `t1`; CREATE TABLE `t1` (`num` int);"
+            )
+            self.assertEqual(
+                set(fixture_state),
+                {(("mysql", "app"), "lock_sample"), (("mysql", "other"), "t1")},
+            )
+            # 何を触るか分からないスクリプトはこのデータベースのすべての記録を消す
+            forget_script_tables("mysql", "UPDATE lock_sample SET val1 = 0")
+            self.assertEqual(set(fixture_state), {(("mysql", "other"), "t1")})
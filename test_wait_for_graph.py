@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+from wait_for_graph import WaitForGraph
+
+
+class WaitForGraphTest(TestCase):
+    def test_chain_and_fan_in(self):
+        # 1 <- 2 <- 3, 1 <- 4, 5 <- 6
+        graph = WaitForGraph([(2, 1), (3, 2), (4, 1), (6, 5)])
+        self.assertListEqual(graph.cycles(), [])
+        self.assertListEqual(graph.root_blockers(), [1, 5])
+        self.assertSetEqual(graph.stalled_by(1), {2, 3, 4})
+        self.assertDictEqual(graph.stall_counts(), {1: 3, 5: 1})
+
+    def test_deadlock_cycle(self):
+        # 1 と 2 が待ち合い、3 は 1 を待っている
+        graph = WaitForGraph([(1, 2), (2, 1), (3, 1)])
+        self.assertListEqual(graph.cycles(), [[1, 2]])
+        self.assertListEqual(graph.root_blockers(), [1, 2])
+        self.assertDictEqual(graph.stall_counts(), {1: 2, 2: 2})
+
+    def test_waiting_on_multiple_blockers(self):
+        # PostgreSQL の共有ロック待ちなどで複数のセッションに待たされる場合
+        graph = WaitForGraph([(3, 1), (3, 2), (4, 3)])
+        self.assertListEqual(graph.root_blockers(), [1, 2])
+        self.assertDictEqual(graph.stall_counts(), {1: 2, 2: 2})
+
+    def test_long_chain(self):
+        sessions = 100000
+        graph = WaitForGraph((i + 1, i) for i in range(sessions))
+        self.assertListEqual(graph.cycles(), [])
+        self.assertDictEqual(graph.stall_counts(), {0: sessions})
+
+        graph.add_edge(0, sessions)
+        self.assertEqual(len(graph.cycles()[0]), sessions + 1)
+        self.assertEqual(len(graph.root_blockers()), sessions + 1)
+        self.assertEqual(graph.stall_counts()[0], sessions)
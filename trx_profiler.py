@@ -0,0 +1,433 @@
+"""
+トランザクションごとに、どれだけ長くロックを持っていたか、その間に何をしていたかを記録する
+
+    python trx_profiler.py mysql --interval 0.05 --duration 30 --folded lock_hold.folded
+    python trx_profiler.py postgresql --out transactions.json
+
+一定間隔で実行中のトランザクションを 1 クエリでサンプリングし、トランザクションごとに
+- 開始時刻、最初にロックを持っているのを観測した時刻
+- ロック構造体の数 / ロックした行数 (MySQL は INNODB_TRX の trx_lock_structs / trx_rows_locked、
+  PostgreSQL は pg_locks の許可済みのロックの数 / tuple ロックの数) の推移
+- idle in transaction だった時間
+- 終了した時刻 (観測できなくなった時刻) と、MySQL では COMMITTED / ROLLED BACK
+を記録する
+
+ロックを持っていた時間は、サンプリングの間隔ごとに、間隔の始めに実行中だった文 (idle の場合は直前の文) に割り当てる
+--folded には flamegraph.pl / speedscope で読める折りたたみ形式 (最初の文;実行中の文;(idle in transaction) マイクロ秒) で書き出す
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+from statement_stats import fingerprint
+from util import connect_mysql, connect_postgresql
+
+MYSQL_TRX_PROFILE_QUERY = """
+select
+    t.PROCESSLIST_ID,
+    trx.trx_id,
+    tx.EVENT_ID,
+    unix_timestamp(trx.trx_started),
+    trx.trx_lock_structs,
+    trx.trx_rows_locked,
+    trx.trx_query is null,
+    coalesce(trx.trx_query, s.SQL_TEXT),
+    unix_timestamp(now(6))
+from
+    information_schema.INNODB_TRX trx
+    join performance_schema.threads t on (t.PROCESSLIST_ID = trx.trx_mysql_thread_id)
+    left join performance_schema.events_statements_current s on (
+        s.THREAD_ID = t.THREAD_ID
+        and s.NESTING_EVENT_LEVEL = 0
+    )
+    left join performance_schema.events_transactions_current tx on (
+        tx.THREAD_ID = t.THREAD_ID
+        and tx.STATE = 'ACTIVE'
+    )
+where
+    trx.trx_mysql_thread_id <> connection_id()
+    and (%(schema)s is null or t.PROCESSLIST_DB = %(schema)s)
+"""
+
+# スレッドで最後に終わったトランザクションの状態 (COMMITTED / ROLLED BACK)
+MYSQL_TRX_OUTCOME_QUERY = """
+select
+    t.PROCESSLIST_ID,
+    h.STATE
+from
+    performance_schema.threads t
+    join performance_schema.events_transactions_history h on (h.THREAD_ID = t.THREAD_ID)
+where
+    t.PROCESSLIST_ID in ({sessions})
+    and h.EVENT_ID = (
+        select max(EVENT_ID)
+        from performance_schema.events_transactions_history
+        where THREAD_ID = h.THREAD_ID
+    )
+"""
+
+POSTGRESQL_TRX_PROFILE_QUERY = """
+select
+    a.pid,
+    max(l.virtualtransaction),
+    null,
+    extract(epoch from a.xact_start),
+    count(*) filter (where l.granted and l.locktype <> 'virtualxid'),
+    count(*) filter (where l.granted and l.locktype = 'tuple'),
+    a.state like 'idle in transaction%%',
+    a.query,
+    extract(epoch from clock_timestamp())
+from
+    pg_stat_activity a
+    left join pg_locks l on (l.pid = a.pid)
+where
+    a.xact_start is not null
+    and a.pid <> pg_backend_pid()
+    and a.backend_type = 'client backend'
+    and (%(database)s::text is null or a.datname = %(database)s)
+group by
+    a.pid,
+    a.xact_start,
+    a.state,
+    a.query
+"""
+
+IDLE_FRAME = "(idle in transaction)"
+
+# InnoDB は読み込みのみのトランザクションに仮の ID (2^48 以上、セッションごとに使い回される) を見せ、
+# 最初に書き込みをした時点で本当の ID に置き換える
+MYSQL_READ_ONLY_TRX_ID = 2**48
+
+
+class TrxProfile:
+    """
+    1 つのトランザクション (セッションとトランザクション ID の組) の観測結果
+    """
+
+    def __init__(self, session, trx_id, started, seen_at, event=None, capacity=1000):
+        self.session = session
+        self.trx_id = trx_id
+        self.started = started
+        # performance_schema のトランザクションのイベント ID (MySQL のみ)
+        self.event = event
+        self.first_seen = seen_at
+        self.last_seen = seen_at
+        self.first_locked = None
+        self.ended = None
+        self.outcome = None
+        self.max_lock_structs = 0
+        self.max_rows_locked = None
+        # (観測時刻, ロック構造体の数, ロックした行数) のうち、前回から変わったもの
+        self.series = deque(maxlen=capacity)
+        self.idle_seconds = 0.0
+        # 折りたたみ形式のスタック -> ロックを持っていた秒数
+        self.hold = {}
+        self.first_statement = None
+        self.provisional = False
+        self._state = None
+
+    @property
+    def key(self):
+        return (self.session, self.trx_id)
+
+    def same_transaction(self, sample):
+        """
+        仮の ID は使い回されるので、開始時刻とトランザクションのイベント ID も同じか確かめる
+        """
+        if not self.provisional:
+            return True
+        return sample["started"] == self.started and sample.get("event") == self.event
+
+    @property
+    def lock_hold_seconds(self):
+        return sum(self.hold.values())
+
+    def stack(self, statement, idle):
+        frames = [self.first_statement]
+        if statement != self.first_statement:
+            frames.append(statement)
+        if idle:
+            frames.append(IDLE_FRAME)
+        return tuple(frames)
+
+    def advance(self, seen_at):
+        """
+        前回の観測から seen_at までの時間を、前回の観測時の状態に割り当てる
+        """
+        if self._state is None:
+            return
+        elapsed = seen_at - self.last_seen
+        lock_structs, statement, idle = self._state
+        if idle:
+            self.idle_seconds += elapsed
+        if lock_structs:
+            stack = self.stack(statement, idle)
+            self.hold[stack] = self.hold.get(stack, 0.0) + elapsed
+
+    def observe(self, sample, seen_at):
+        self.advance(seen_at)
+        self.last_seen = seen_at
+        self.provisional = sample.get("provisional", False)
+
+        statement = fingerprint(sample["statement"]) if sample["statement"] else "?"
+        if self.first_statement is None:
+            self.first_statement = statement
+        lock_structs = sample["lock_structs"]
+        rows_locked = sample["rows_locked"]
+        if lock_structs and self.first_locked is None:
+            self.first_locked = seen_at
+        self.max_lock_structs = max(self.max_lock_structs, lock_structs)
+        if rows_locked is not None:
+            self.max_rows_locked = max(self.max_rows_locked or 0, rows_locked)
+        if not self.series or self.series[-1][1:] != (lock_structs, rows_locked):
+            self.series.append((seen_at, lock_structs, rows_locked))
+        self._state = (lock_structs, statement, sample["idle"])
+
+    def close(self, seen_at):
+        """
+        seen_at の観測でいなくなった (トランザクションが終わった) 場合
+        終わった時刻は前回の観測との間のどこかなので、ロックを持っていた時間は最大で 1 間隔分多めになる
+        """
+        self.advance(seen_at)
+        self.ended = seen_at
+        self._state = None
+
+    def as_dict(self):
+        return {
+            "session": self.session,
+            "trx_id": self.trx_id,
+            "started": self.started,
+            "first_locked": self.first_locked,
+            "ended": self.ended,
+            "outcome": self.outcome,
+            "duration": (self.ended or self.last_seen) - self.started,
+            "lock_hold_seconds": self.lock_hold_seconds,
+            "idle_seconds": self.idle_seconds,
+            "max_lock_structs": self.max_lock_structs,
+            "max_rows_locked": self.max_rows_locked,
+            "series": list(self.series),
+            "hold": {";".join(stack): seconds for stack, seconds in self.hold.items()},
+        }
+
+
+class TrxProfiler:
+    """
+    capture() はトランザクションごとの dict
+    (session, trx_id, provisional, event, started, lock_structs, rows_locked, idle, statement)
+    のリストと観測時刻を返す
+    provisional は trx_id が MySQL の読み込みのみのトランザクションの仮の ID (途中で変わり、使い回される) の場合に真
+    outcomes(sessions) は終わったトランザクションのセッション -> COMMITTED / ROLLED BACK を返す (省略可)
+    """
+
+    def __init__(self, capture, outcomes=None, interval=0.1, capacity=10000):
+        self.capture = capture
+        self.outcomes = outcomes
+        self.interval = interval
+        self.active = {}
+        self.finished = deque(maxlen=capacity)
+        self.samples = 0
+        # バックグラウンドのスレッドでサンプリングが失敗した場合の例外 (stop() で送出する)
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        started = time.monotonic()
+        rows, seen_at = self.capture()
+        self.samples += 1
+
+        current = {}
+        ended = []
+        for row in rows:
+            key = (row["session"], row["trx_id"])
+            current[key] = row
+            profile = self.active.get(key)
+            if profile is not None and not profile.same_transaction(row):
+                # 読み込みのみのトランザクションの仮の ID は、同じセッションの次のトランザクションでも使われる
+                ended.append(self.active.pop(key))
+                profile = None
+            if profile is None:
+                profile = self.promoted(row, current) or TrxProfile(
+                    row["session"],
+                    row["trx_id"],
+                    row["started"],
+                    seen_at,
+                    event=row.get("event"),
+                )
+                self.active[key] = profile
+            profile.observe(row, seen_at)
+
+        ended.extend(
+            self.active.pop(key) for key in list(self.active) if key not in current
+        )
+        for profile in ended:
+            profile.close(seen_at)
+        if ended and self.outcomes is not None:
+            outcomes = self.outcomes(sorted({profile.session for profile in ended}))
+            for profile in ended:
+                profile.outcome = outcomes.get(profile.session)
+        self.finished.extend(ended)
+        return time.monotonic() - started
+
+    def promoted(self, row, current):
+        """
+        同じセッションのトランザクションの仮の ID が本当の ID に変わった場合は、それまでの観測結果を引き継ぐ
+        """
+        for key, profile in list(self.active.items()):
+            if (
+                key not in current
+                and profile.session == row["session"]
+                and profile.provisional
+                and profile.same_transaction(row)
+            ):
+                del self.active[key]
+                profile.trx_id = row["trx_id"]
+                return profile
+        return None
+
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                elapsed = self.sample()
+                self._stop.wait(max(self.interval - elapsed, 0))
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def profiles(self):
+        """
+        ロックを持っていた時間が長い順
+        """
+        return sorted(
+            list(self.finished) + list(self.active.values()),
+            key=lambda profile: -profile.lock_hold_seconds,
+        )
+
+    def folded(self):
+        """
+        全トランザクションのロックを持っていた時間を、スタックごとにマイクロ秒で合計した折りたたみ形式の行
+        """
+        totals = {}
+        for profile in self.profiles():
+            for stack, seconds in profile.hold.items():
+                totals[stack] = totals.get(stack, 0.0) + seconds
+        return [
+            f"{';'.join(frame.replace(';', ',') for frame in stack)} {round(seconds * 1e6)}"
+            for stack, seconds in sorted(totals.items())
+            if round(seconds * 1e6) > 0
+        ]
+
+    def export_json(self, f):
+        json.dump(
+            [profile.as_dict() for profile in self.profiles()],
+            f,
+            indent=2,
+            default=str,
+        )
+
+
+def sample_rows(rows, provisional=lambda trx_id: False):
+    seen_at = rows[0][-1] if rows else None
+    return [
+        {
+            "session": session,
+            "trx_id": trx_id,
+            "provisional": provisional(trx_id),
+            "event": event,
+            "started": float(started),
+            "lock_structs": int(lock_structs),
+            "rows_locked": int(rows_locked) if rows_locked is not None else None,
+            "idle": bool(idle),
+            "statement": statement,
+        }
+        for session, trx_id, event, started, lock_structs, rows_locked, idle, statement, _ in rows
+    ], (float(seen_at) if seen_at is not None else time.time())
+
+
+def capture_mysql(conn, schema=None):
+    with conn.cursor() as cur:
+        cur.execute(MYSQL_TRX_PROFILE_QUERY, {"schema": schema})
+        return sample_rows(
+            cur.fetchall(), lambda trx_id: int(trx_id) >= MYSQL_READ_ONLY_TRX_ID
+        )
+
+
+def mysql_outcomes(conn, sessions):
+    with conn.cursor() as cur:
+        cur.execute(
+            MYSQL_TRX_OUTCOME_QUERY.format(sessions=", ".join(["%s"] * len(sessions))),
+            tuple(sessions),
+        )
+        return dict(cur.fetchall())
+
+
+def capture_postgresql(conn, database=None):
+    with conn.cursor() as cur:
+        cur.execute(POSTGRESQL_TRX_PROFILE_QUERY, {"database": database})
+        return sample_rows(cur.fetchall())
+
+
+def create_profiler(engine, interval):
+    if engine == "mysql":
+        conn = connect_mysql(root=True)
+        conn.autocommit = True
+        return TrxProfiler(
+            lambda: capture_mysql(conn),
+            lambda sessions: mysql_outcomes(conn, sessions),
+            interval=interval,
+        )
+
+    # pg_stat_activity はトランザクション内でキャッシュされるので autocommit にする
+    conn = connect_postgresql()
+    conn.autocommit = True
+    return TrxProfiler(lambda: capture_postgresql(conn), interval=interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("engine", choices=("mysql", "postgresql"))
+    parser.add_argument("--interval", type=float, default=0.1)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--out", default="-")
+    parser.add_argument("--folded")
+    args = parser.parse_args(argv)
+
+    profiler = create_profiler(args.engine, args.interval)
+    with profiler:
+        time.sleep(args.duration)
+
+    if args.folded:
+        with open(args.folded, "w") as f:
+            f.writelines(f"{line}\n" for line in profiler.folded())
+
+    f = sys.stdout if args.out == "-" else open(args.out, "w")
+    try:
+        profiler.export_json(f)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+if __name__ == "__main__":
+    main()
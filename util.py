@@ -1,170 +1,1132 @@
+import asyncio
+import atexit
+import hashlib
+import re
+import sys
+import threading
+import time
+from collections import Counter
 from os import environ
 from unittest import IsolatedAsyncioTestCase, TestCase
 
 import psycopg
 from mysql import connector
 from mysql.connector import aio as aio_connector
-from tabulate import tabulate
+
+from innodb_status import parse_innodb_status
+from statement_stats import MySqlLockTime, current_stats, instrument
+from table_compare import compare_table
+from wait_for_graph import WaitForGraph
+
+MYSQL_SESSION_QUERIES = (
+    "SET max_execution_time = 5000",
+    "SET innodb_lock_wait_timeout = 5",
+)
+
+
+def mysql_connect_params(root=False, database=None):
+    return {
+        "host": environ["MYSQL_HOST"],
+        # mysql.connector.aio は int しか受け付けない
+        "port": int(environ["MYSQL_PORT"]),
+        "user": environ["MYSQL_USER"] if not root else "root",
+        "password": (
+            environ["MYSQL_PASSWORD"] if not root else environ["MYSQL_ROOT_PASSWORD"]
+        ),
+        "database": database or environ["MYSQL_DATABASE"],
+    }
+
+
+def postgresql_conninfo(dbname=None):
+    params = {
+        "user": environ["POSTGRES_USER"],
+        "password": environ["POSTGRES_PASSWORD"],
+        "host": environ["POSTGRES_HOST"],
+        "port": environ["POSTGRES_PORT"],
+        "dbname": dbname or environ["POSTGRES_DB"],
+    }
+    return " ".join([f"{k}={v}" for k, v in params.items()])
+
+
+def init_mysql_session(conn):
+    conn.autocommit = False
+    for query in MYSQL_SESSION_QUERIES:
+        conn.cmd_query(query)
+
+
+def connect_mysql(root=False):
+    conn = connector.connect(**mysql_connect_params(root=root))
+    init_mysql_session(conn)
+    return conn
+
+
+def connect_postgresql():
+    return psycopg.connect(conninfo=postgresql_conninfo(), autocommit=False)
+
+
+def reset_mysql_connection(conn):
+    # COM_RESET_CONNECTION でトランザクション・ロック・セッション変数を破棄してから張り直す
+    conn.rollback()
+    conn.reset_session()
+    init_mysql_session(conn)
+
+
+def reset_postgresql_connection(conn):
+    if (
+        conn.closed
+        or conn.info.transaction_status == psycopg.pq.TransactionStatus.ACTIVE
+    ):
+        raise psycopg.InterfaceError("connection is not reusable")
+    conn.rollback()
+    conn.autocommit = True
+    conn.execute("DISCARD ALL")
+    conn.autocommit = False
+    conn.isolation_level = None
+
+
+class ConnectionPool:
+    """
+    認証済みのコネクションを使い回すためのプール
+
+    返却時に reset でセッションを初期状態に戻し、失敗したコネクションは捨てる
+    """
+
+    def __init__(self, connect, reset, max_idle=16):
+        self._connect = connect
+        self._reset = reset
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self, fresh=False):
+        if not fresh:
+            with self._lock:
+                if self._idle:
+                    return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        try:
+            self._reset(conn)
+        except Exception:
+            self.discard(conn)
+            return
+
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(conn)
+                return
+        self.discard(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, connect, reset):
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(connect, reset)
+        return _pools[key]
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def mysql_pool(root=False):
+    key = ("mysql", tuple(sorted(mysql_connect_params(root=root).items())))
+    return get_pool(key, lambda: connect_mysql(root=root), reset_mysql_connection)
+
+
+def postgresql_pool():
+    key = ("postgresql", postgresql_conninfo())
+    return get_pool(key, connect_postgresql, reset_postgresql_connection)
+
+
+DOLLAR_QUOTE = re.compile(r"\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$")
+
+
+def _skip_quoted(script, start, backslash_escapes):
+    quote = script[start]
+    i = start + 1
+    while i < len(script):
+        c = script[i]
+        if backslash_escapes and c == "\\":
+            i += 2
+        elif c == quote:
+            # '' のように 2 つ重ねたものはクォート文字そのもの
+            if script.startswith(quote, i + 1):
+                i += 2
+            else:
+                return i + 1
+        else:
+            i += 1
+    return len(script)
+
+
+def split_sql(script, dialect="mysql"):
+    """
+    SQL スクリプトを文ごとに分割する
+
+    文字列リテラル・クォートされた識別子・コメント・(PostgreSQL の) ドル引用符の中にある ; では区切らない
+    コメントだけの断片は文として扱わない
+    """
+    mysql = dialect == "mysql"
+    statements = []
+    start = 0
+    has_code = False
+    i = 0
+    while i < len(script):
+        c = script[i]
+        prev = script[i - 1] if i > 0 else ""
+        if c in "'\"`":
+            backslash_escapes = (mysql and c != "`") or (
+                not mysql and c == "'" and prev in "eE"
+            )
+            i = _skip_quoted(script, i, backslash_escapes)
+            has_code = True
+        elif script.startswith("--", i) and (
+            not mysql or script[i + 2 : i + 3] in ("", " ", "\t", "\n", "\r")
+        ):
+            end = script.find("\n", i)
+            i = len(script) if end < 0 else end + 1
+        elif mysql and c == "#":
+            end = script.find("\n", i)
+            i = len(script) if end < 0 else end + 1
+        elif script.startswith("/*", i):
+            # /*! ... */ は MySQL では実行されるので文の一部として扱う
+            has_code = has_code or script.startswith("/*!", i)
+            end = script.find("*/", i + 2)
+            i = len(script) if end < 0 else end + 2
+        elif (
+            not mysql
+            and c == "$"
+            and not (prev.isalnum() or prev == "_")
+            and (m := DOLLAR_QUOTE.match(script, i))
+        ):
+            end = script.find(m.group(0), m.end())
+            i = len(script) if end < 0 else end + len(m.group(0))
+            has_code = True
+        elif c == ";":
+            if has_code:
+                statements.append(script[start:i].strip())
+            start = i + 1
+            has_code = False
+            i += 1
+        else:
+            has_code = has_code or not c.isspace()
+            i += 1
+    if has_code:
+        statements.append(script[start:].strip())
+    return statements
+
+
+def join_sql(statements):
+    """
+    split_sql で分けた文を 1 つのスクリプトに戻す
+    文が -- や # のコメントで終わっていても ; がコメントに入らないよう、; を独立した行に置く
+    """
+    return "\n;\n".join(statements)
+
+
+def execute_mysql_script(conn, script):
+    """
+    スクリプト全体を multi statement として 1 回のラウンドトリップで実行する
+    """
+    with _fixture_lock:
+        forget_script_tables("mysql", script)
+        _execute_mysql_statements(conn, split_sql(script, dialect="mysql"))
+
+
+def _execute_mysql_statements(conn, statements):
+    if not statements:
+        return
+    with conn.cursor() as cur:
+        for _ in cur.execute(join_sql(statements), multi=True):
+            pass
+
+
+async def async_execute_mysql_script(conn, script):
+    # イベントループを止めないようロックは取らず、(途中で失敗しても) 実行後に記録を消す
+    statements = split_sql(script, dialect="mysql")
+    try:
+        if statements:
+            cur = await conn.cursor()
+            async for _ in cur.executemulti(join_sql(statements)):
+                pass
+    finally:
+        forget_script_tables("mysql", script)
+
+
+def execute_postgresql_script(conn, script):
+    """
+    パイプラインモードで全文を送り、結果をまとめて受け取る
+    """
+    with _fixture_lock:
+        forget_script_tables("postgresql", script)
+        _execute_postgresql_statements(conn, split_sql(script, dialect="postgresql"))
+
+
+def _execute_postgresql_statements(conn, statements):
+    with conn.pipeline(), conn.cursor() as cur:
+        for statement in statements:
+            cur.execute(statement)
+
+
+async def async_execute_postgresql_script(conn, script):
+    statements = split_sql(script, dialect="postgresql")
+    try:
+        async with conn.pipeline():
+            async with conn.cursor() as cur:
+                for statement in statements:
+                    await cur.execute(statement)
+    finally:
+        forget_script_tables("postgresql", script)
+
+
+FIXTURE_STATEMENT = re.compile(
+    r"^(?P<verb>DROP\s+TABLE(?:\s+IF\s+EXISTS)?|CREATE\s+TABLE|INSERT\s+INTO)\s+"
+    r"(?P<quote>[`\"]?)(?P<table>\w+)(?P=quote)[\s(;]",
+    re.IGNORECASE,
+)
+
+# テンプレートから復元したテーブルが今どのスクリプトの内容になっているか
+# execute_*_script でスクリプトを直接実行すると、そのスクリプトが触るテーブルの記録を消す
+_fixture_state = {}
+# scenario.run_scenarios などで複数のスレッドから setup_*_fixture を呼ぶため、
+# 記録の確認・テーブルの復元・記録の更新をまとめて排他する (forget_fixtures も取るので RLock)
+_fixture_lock = threading.RLock()
+
+
+def fixture_plan(script, dialect):
+    """
+    スクリプトのハッシュと、スクリプトが作るテーブルの一覧を返す
+
+    DROP TABLE / CREATE TABLE / INSERT INTO 以外の文を含む場合や、
+    作成していないテーブルを触る場合はテンプレートで再現できないので tables は None
+    """
+    key = hashlib.sha256(script.encode()).hexdigest()[:16]
+    parsed = []
+    for statement in split_sql(script, dialect=dialect):
+        m = FIXTURE_STATEMENT.match(statement + ";")
+        if not m:
+            return key, None
+        table = m.group("table")
+        if dialect != "mysql" and not m.group("quote"):
+            table = table.lower()
+        parsed.append((m.group("verb").split()[0].upper(), table))
+
+    tables = [table for verb, table in parsed if verb == "CREATE"]
+    if not tables or any(table not in tables for _, table in parsed):
+        return key, None
+    if any(len(fixture_template_name(key, table)) > 63 for table in tables):
+        return key, None
+    return key, tables
+
+
+def fixture_template_name(key, table):
+    return f"_fixture_{key}_{table}"
+
+
+def fixture_namespace(dialect):
+    if dialect == "mysql":
+        return ("mysql", environ["MYSQL_DATABASE"])
+    return ("postgresql", environ["POSTGRES_DB"])
+
+
+def forget_fixtures(namespace, tables=None):
+    """
+    tables を省略した場合は namespace のすべてのテーブルの記録を消す
+    """
+    with _fixture_lock:
+        for state_key in list(_fixture_state):
+            if state_key[0] == namespace and (tables is None or state_key[1] in tables):
+                del _fixture_state[state_key]
+
+
+def forget_script_tables(dialect, script):
+    """
+    script が作り直すテーブルの記録を消す (どのテーブルを触るか分からなければすべて)
+    """
+    _, tables = fixture_plan(script, dialect)
+    forget_fixtures(fixture_namespace(dialect), tables)
+
+
+def setup_mysql_fixture(conn, script):
+    """
+    初回はスクリプトを実行してテーブルごとにテンプレート (_fixture_<hash>_<table>) を作り、
+    以降は TRUNCATE + INSERT SELECT (テーブル定義が違う場合は CREATE TABLE LIKE) で復元する
+    """
+    key, tables = fixture_plan(script, "mysql")
+    if tables is None:
+        execute_mysql_script(conn, script)
+        return
+
+    with _fixture_lock:
+        _restore_mysql_fixture(conn, script, key, tables)
+
+
+def _restore_mysql_fixture(conn, script, key, tables):
+    namespace = fixture_namespace("mysql")
+    templates = {table: fixture_template_name(key, table) for table in tables}
+    if all(_fixture_state.get((namespace, table)) == key for table in tables):
+        restore = [
+            f"TRUNCATE TABLE `{table}`;"
+            f"INSERT INTO `{table}` SELECT * FROM `{template}`;"
+            for table, template in templates.items()
+        ]
+    else:
+        with conn.cursor() as cur:
+            cur.execute(
+                "select count(*) from information_schema.TABLES "
+                "where TABLE_SCHEMA = database() and TABLE_NAME in "
+                f"({', '.join(['%s'] * len(templates))})",
+                tuple(templates.values()),
+            )
+            built = cur.fetchall()[0][0] == len(templates)
+        if built:
+            restore = [
+                f"DROP TABLE IF EXISTS `{table}`;"
+                f"CREATE TABLE `{table}` LIKE `{template}`;"
+                f"INSERT INTO `{table}` SELECT * FROM `{template}`;"
+                for table, template in templates.items()
+            ]
+        else:
+            # 途中で失敗しても壊れたテンプレートが残らないよう、作り終えてから RENAME する
+            restore = [script] + [
+                f"DROP TABLE IF EXISTS `{template}`, `{template}_tmp`;"
+                f"CREATE TABLE `{template}_tmp` LIKE `{table}`;"
+                f"INSERT INTO `{template}_tmp` SELECT * FROM `{table}`;"
+                f"RENAME TABLE `{template}_tmp` TO `{template}`;"
+                for table, template in templates.items()
+            ]
+
+    _execute_mysql_statements(conn, split_sql(join_sql(restore), dialect="mysql"))
+    for table in tables:
+        _fixture_state[(namespace, table)] = key
+
+
+def setup_postgresql_fixture(conn, script):
+    """
+    初回はスクリプトを実行して fixture_cache スキーマにテンプレートを作り、
+    直前と同じスクリプトのテーブルであれば TRUNCATE + INSERT SELECT で復元する
+
+    テーブル定義が入れ替わる場合は、インデックスや制約の名前を元のまま再現するためにスクリプトを実行する
+    """
+    key, tables = fixture_plan(script, "postgresql")
+    if tables is None:
+        execute_postgresql_script(conn, script)
+        return
+
+    with _fixture_lock:
+        _restore_postgresql_fixture(conn, script, key, tables)
+
+
+def _restore_postgresql_fixture(conn, script, key, tables):
+    namespace = fixture_namespace("postgresql")
+    templates = {
+        table: f'fixture_cache."{fixture_template_name(key, table)}"'
+        for table in tables
+    }
+    if all(_fixture_state.get((namespace, table)) == key for table in tables):
+        restore = [
+            f'TRUNCATE TABLE "{table}" RESTART IDENTITY;'
+            f'INSERT INTO "{table}" SELECT * FROM {template};'
+            for table, template in templates.items()
+        ]
+    else:
+        restore = [script, "CREATE SCHEMA IF NOT EXISTS fixture_cache;"] + [
+            f"DROP TABLE IF EXISTS {template};"
+            f'CREATE TABLE {template} AS TABLE "{table}";'
+            for table, template in templates.items()
+        ]
+
+    _execute_postgresql_statements(
+        conn, split_sql(join_sql(restore), dialect="postgresql")
+    )
+    for table in tables:
+        _fixture_state[(namespace, table)] = key
+
+
+MYSQL_LOCK_WAIT_QUERY = """
+select
+    count(*)
+from
+    performance_schema.data_lock_waits w
+    join performance_schema.threads t on (w.REQUESTING_THREAD_ID = t.THREAD_ID)
+where
+    t.PROCESSLIST_ID = %s
+"""
+
+POSTGRESQL_LOCK_WAIT_QUERY = "select cardinality(pg_blocking_pids(%s))"
+
+LOCK_WAIT_TIMEOUT = 5.0
+
+
+def is_mysql_session_blocked(cur, connection_id):
+    cur.execute(MYSQL_LOCK_WAIT_QUERY, (connection_id,))
+    return cur.fetchall()[0][0] > 0
+
+
+def is_postgresql_session_blocked(cur, pid):
+    cur.execute(POSTGRESQL_LOCK_WAIT_QUERY, (pid,))
+    return cur.fetchall()[0][0] > 0
+
+
+def poll_intervals(timeout=LOCK_WAIT_TIMEOUT, initial=0.001, maximum=0.05):
+    """
+    timeout までの間、1ms から倍々に (最大 maximum まで) 伸ばした待ち時間を返す
+    """
+    deadline = time.monotonic() + timeout
+    interval = initial
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(interval, remaining)
+        interval = min(interval * 2, maximum)
+
+
+def wait_until_blocked(is_blocked, is_done, timeout=LOCK_WAIT_TIMEOUT):
+    """
+    is_blocked() が真になったら True、先に is_done() が真になったら False を返す
+    どちらにもならないまま timeout を過ぎたら TimeoutError
+    """
+    for interval in poll_intervals(timeout=timeout):
+        if is_blocked():
+            return True
+        if is_done():
+            return False
+        time.sleep(interval)
+    raise TimeoutError(f"session did not reach lock wait within {timeout}s")
+
+
+async def async_wait_until_blocked(is_blocked, is_done, timeout=LOCK_WAIT_TIMEOUT):
+    for interval in poll_intervals(timeout=timeout):
+        if await is_blocked():
+            return True
+        if is_done():
+            return False
+        await asyncio.sleep(interval)
+    raise TimeoutError(f"session did not reach lock wait within {timeout}s")
+
+
+# MySQL のエラー番号
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_LOCK_DEADLOCK = 1213
+ER_QUERY_TIMEOUT = 3024
+
+
+def classify_error(e):
+    """
+    ロック競合によるエラーを deadlock / timeout / serialization に分類する
+    それ以外のエラーは None
+    """
+    if isinstance(e, connector.Error):
+        if e.errno == ER_LOCK_DEADLOCK:
+            return "deadlock"
+        if e.errno in (ER_LOCK_WAIT_TIMEOUT, ER_QUERY_TIMEOUT):
+            return "timeout"
+        return None
+    if isinstance(e, psycopg.errors.DeadlockDetected):
+        return "deadlock"
+    if isinstance(e, (psycopg.errors.LockNotAvailable, psycopg.errors.QueryCanceled)):
+        return "timeout"
+    if isinstance(e, psycopg.errors.SerializationFailure):
+        return "serialization"
+    return None
+
+
+_mysql_lock_time = None
+_mysql_lock_time_lock = threading.Lock()
+
+
+def mysql_lock_time():
+    """
+    文ごとの LOCK_TIME を読むためのプロセスで 1 つの root のコネクション
+    """
+    global _mysql_lock_time
+    with _mysql_lock_time_lock:
+        if _mysql_lock_time is None:
+            conn = connect_mysql(root=True)
+            conn.autocommit = True
+            _mysql_lock_time = MySqlLockTime(conn)
+        return _mysql_lock_time
+
+
+def collect_postgresql_statements(stats):
+    conn = connect_postgresql()
+    try:
+        stats.collect_postgresql(conn)
+    finally:
+        conn.close()
+
+
+def instrument_connection(conn, engine):
+    """
+    環境変数 STATEMENT_STATS が指定されていれば、conn のカーソルの execute を計測する
+    """
+    stats = current_stats()
+    if stats is None:
+        return conn
+    if engine == "mysql":
+        return instrument(conn, engine, stats, classify_error, mysql_lock_time())
+    stats.collectors.add(collect_postgresql_statements)
+    return instrument(conn, engine, stats, classify_error)
+
+
+MYSQL_LOCK_SNAPSHOT_QUERY = """
+select
+    t.PROCESSLIST_ID,
+    l.ENGINE_TRANSACTION_ID,
+    l.LOCK_TYPE,
+    l.OBJECT_SCHEMA,
+    l.OBJECT_NAME,
+    l.INDEX_NAME,
+    l.LOCK_MODE,
+    l.LOCK_STATUS = 'GRANTED',
+    l.LOCK_DATA
+from
+    performance_schema.data_locks l
+    left join performance_schema.threads t on (l.THREAD_ID = t.THREAD_ID)
+where
+    %(schema)s is null or l.OBJECT_SCHEMA = %(schema)s
+"""
+
+POSTGRESQL_LOCK_SNAPSHOT_QUERY = """
+select
+    l.pid,
+    l.virtualtransaction,
+    l.locktype,
+    n.nspname,
+    coalesce(it.relname, c.relname),
+    case when c.relkind = 'i' then c.relname end,
+    l.mode,
+    l.granted,
+    case l.locktype
+        when 'tuple' then l.page || ',' || l.tuple
+        when 'page' then l.page::text
+        when 'transactionid' then l.transactionid::text
+        when 'virtualxid' then l.virtualxid
+    end
+from
+    pg_locks l
+    left join pg_class c on (l.relation = c.oid)
+    left join pg_namespace n on (c.relnamespace = n.oid)
+    left join pg_index i on (c.relkind = 'i' and i.indexrelid = c.oid)
+    left join pg_class it on (i.indrelid = it.oid)
+    left join pg_stat_activity s on (l.pid = s.pid)
+where
+    l.pid <> pg_backend_pid()
+    and (%(database)s::text is null or s.datname = %(database)s)
+"""
+
+
+def lock_kind(mode):
+    """
+    data_locks のレコードロックの LOCK_MODE (X,GAP など) をロックの種類に分ける
+    supremum の X はネクストキーロックとして扱う (実質はギャップロック)
+    """
+    if "INSERT_INTENTION" in mode:
+        return "insert-intention"
+    if "REC_NOT_GAP" in mode:
+        return "record"
+    if "GAP" in mode:
+        return "gap"
+    return "next-key"
+
+
+class LockSnapshot:
+    """
+    ある時点のロック一覧を列ごとのタプルで保持する
+
+    MySQL (performance_schema.data_locks) と PostgreSQL (pg_locks) のどちらも同じ列に揃える
+    - session: MySQL は PROCESSLIST_ID (connection_id)、PostgreSQL は pid
+    - trx: MySQL は ENGINE_TRANSACTION_ID、PostgreSQL は virtualtransaction
+    - index: ロック対象がインデックスの場合のインデックス名 (PostgreSQL では table はインデックスのテーブル)
+    - data: MySQL は LOCK_DATA、PostgreSQL は tuple の "page,tuple" や transactionid など
+    """
+
+    COLUMNS = (
+        "session",
+        "trx",
+        "lock_type",
+        "schema",
+        "table",
+        "index",
+        "mode",
+        "granted",
+        "data",
+    )
+
+    def __init__(self, columns, taken_at=None):
+        self.columns = columns
+        self.taken_at = taken_at if taken_at is not None else time.time()
+
+    @classmethod
+    def from_rows(cls, rows, taken_at=None):
+        # 同じ文字列が大量に繰り返されるので intern して共有する
+        values = [
+            tuple(sys.intern(v) if isinstance(v, str) else v for v in row)
+            for row in rows
+        ]
+        columns = dict(zip(cls.COLUMNS, map(tuple, zip(*values))))
+        if not values:
+            columns = {name: () for name in cls.COLUMNS}
+        return cls(columns, taken_at=taken_at)
+
+    @classmethod
+    def capture_mysql(cls, conn, schema=None):
+        taken_at = time.time()
+        with conn.cursor() as cur:
+            cur.execute(MYSQL_LOCK_SNAPSHOT_QUERY, {"schema": schema})
+            rows = cur.fetchall()
+        return cls.from_rows(
+            [(*row[:7], bool(row[7]), row[8]) for row in rows], taken_at=taken_at
+        )
+
+    @classmethod
+    def capture_postgresql(cls, conn, database=None):
+        taken_at = time.time()
+        with conn.cursor() as cur:
+            cur.execute(POSTGRESQL_LOCK_SNAPSHOT_QUERY, {"database": database})
+            rows = cur.fetchall()
+        return cls.from_rows(rows, taken_at=taken_at)
+
+    def __len__(self):
+        return len(self.columns["session"])
+
+    def __iter__(self):
+        return zip(*(self.columns[name] for name in self.COLUMNS))
+
+    def rows(self):
+        return [dict(zip(self.COLUMNS, row)) for row in self]
+
+    def take(self, positions):
+        return LockSnapshot(
+            {
+                name: tuple(values[i] for i in positions)
+                for name, values in self.columns.items()
+            },
+            taken_at=self.taken_at,
+        )
+
+    def filter(self, **criteria):
+        """
+        列名=値 で絞り込む (値に list / tuple / set を渡した場合はそのいずれか)
+        """
+        positions = range(len(self))
+        for name, expected in criteria.items():
+            values = self.columns[name]
+            if isinstance(expected, (list, tuple, set, frozenset)):
+                expected = set(expected)
+                positions = [i for i in positions if values[i] in expected]
+            else:
+                positions = [i for i in positions if values[i] == expected]
+        return self.take(positions)
+
+    def diff(self, newer):
+        """
+        (newer で増えたロック, newer でなくなったロック) を返す
+        """
+        before = Counter(self)
+        after = Counter(newer)
+        return (
+            LockSnapshot.from_rows(list((after - before).elements()), newer.taken_at),
+            LockSnapshot.from_rows(list((before - after).elements()), newer.taken_at),
+        )
+
+
+def release_connections(connections, threads):
+    """
+    テストで使ったコネクションをロールバックしてプールに返す
+
+    ロック待ちのスレッドが使っているコネクションは、先に他のコネクションをロールバックして
+    スレッドが終わるのを待ってから扱う (実行中のコネクションを別スレッドから触らないため)
+    """
+
+    def rollback(conn):
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+
+    busy = {id(conn) for thread, conn in threads if thread.is_alive()}
+    for _, conn in connections:
+        if id(conn) not in busy:
+            rollback(conn)
+
+    stuck = set()
+    for thread, conn in threads:
+        thread.join(timeout=LOCK_WAIT_TIMEOUT * 2)
+        if thread.is_alive():
+            stuck.add(id(conn))
+        elif id(conn) in busy:
+            rollback(conn)
+
+    for pool, conn in connections:
+        if id(conn) in stuck:
+            pool.discard(conn)
+        else:
+            pool.release(conn)
 
 
 class MySqlBaseTest(TestCase):
     maxDiff = None
 
-    def create_connection(self, root=False):
-        conn = connector.connect(
-            host=environ["MYSQL_HOST"],
-            port=environ["MYSQL_PORT"],
-            user=environ["MYSQL_USER"] if not root else "root",
-            password=(
-                environ["MYSQL_PASSWORD"]
-                if not root
-                else environ["MYSQL_ROOT_PASSWORD"]
-            ),
-            database=environ["MYSQL_DATABASE"],
-        )
-        conn.autocommit = False
-        conn.cmd_query("SET max_execution_time = 5000")
-        conn.cmd_query("SET innodb_lock_wait_timeout = 5")
-        self._connections.append(conn)
+    @property
+    def database(self):
+        """
+        テストが使うスキーマ名 (並列実行時はワーカーごとに異なる)
+        """
+        return environ["MYSQL_DATABASE"]
+
+    def create_connection(self, root=False, fresh=False):
+        """
+        fresh=True の場合はプールを使わず新しいセッション (thread id) を払い出す
+        """
+        pool = mysql_pool(root=root)
+        conn = instrument_connection(pool.acquire(fresh=fresh), "mysql")
+        self._connections.append((pool, conn))
         return conn
 
     def setup_tables(self, query):
         conn = self.create_connection(root=True)
-        with conn.cursor() as cur:
-            for q in query.split(";"):
-                cleaned = q.strip()
-                if not cleaned:
-                    continue
-                cur.execute(cleaned)
+        setup_mysql_fixture(conn, query)
         conn.commit()
 
+    def lock_snapshot(self, conn):
+        return LockSnapshot.capture_mysql(conn, schema=self.database)
+
+    def wait_for_graph(self, conn):
+        return WaitForGraph.capture_mysql(conn, schema=self.database)
+
+    def show_innodb_status(self, cur):
+        cur.execute("SHOW ENGINE INNODB STATUS")
+        _, _, status = cur.fetchall()[0]
+        return parse_innodb_status(status)
+
+    def assertInnodbLock(
+        self, status, table, index=None, lock_type=None, mode=None, waiting=False
+    ):
+        """
+        status (parse_innodb_status の結果) にテスト用スキーマの table に対する条件に合うロックがあること
+        """
+        criteria = {"schema": self.database, "table": table, "waiting": waiting}
+        for name, value in (("index", index), ("lock_type", lock_type), ("mode", mode)):
+            if value is not None:
+                criteria[name] = value
+
+        if not status.find_locks(**criteria):
+            locks = "\n".join(
+                f"{lock.schema}.{lock.table} index={lock.index} mode={lock.mode} "
+                f"lock_type={lock.lock_type} waiting={lock.waiting}"
+                for trx in status.transactions
+                for lock in trx.locks
+            )
+            self.fail(f"No InnoDB lock matches {criteria}\n\nLocks:\n{locks}")
+
+    def start_blocking(self, conn, target, *args, timeout=LOCK_WAIT_TIMEOUT):
+        """
+        target(*args) を別スレッドで実行し、conn のセッションがロック待ちになった時点でスレッドを返す
+
+        ロック待ちにならずに終わった場合や timeout までに待ちにならなかった場合はテスト失敗
+        """
+        if self._lock_wait_cur is None:
+            lock_wait_conn = self.create_connection(root=True)
+            lock_wait_conn.autocommit = True
+            self._lock_wait_cur = lock_wait_conn.cursor()
+
+        thread = threading.Thread(target=target, args=args)
+        thread.start()
+        self._threads.append((thread, conn))
+
+        connection_id = conn.connection_id
+        try:
+            blocked = wait_until_blocked(
+                lambda: is_mysql_session_blocked(self._lock_wait_cur, connection_id),
+                lambda: not thread.is_alive(),
+                timeout=timeout,
+            )
+        except TimeoutError as e:
+            self.fail(str(e))
+        if not blocked:
+            self.fail(f"session {connection_id} finished without waiting for a lock")
+        return thread
+
     def setUp(self):
         self._connections = []
+        self._threads = []
+        self._lock_wait_cur = None
 
     def tearDown(self):
-        for conn in self._connections:
-            try:
-                conn.rollback()
-            except Exception:
-                pass
-            try:
-                conn.close()
-            except Exception:
-                pass
+        release_connections(self._connections, self._threads)
 
-    def assertTableEqual(self, expected, actual):
+    def assertTableEqual(self, expected, actual, **values):
+        """
+        values は期待値の {名前} のセルに入る値 (pid や txid など)
+        """
         self.assertEqual(type(expected), str)
         self.assertEqual(type(actual), list)
 
-        expected_table = expected.strip()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="left"
-        )
-        if expected_table != actual_table:
-            self.fail(f"Expected:\n{expected_table}\n\nActual:\n{actual_table}")
+        message = compare_table(expected, actual, **values)
+        if message is not None:
+            self.fail(message)
+
+
+async def async_release_connections(connections, tasks):
+    """
+    非同期版のテストで使ったコネクションを閉じる
+
+    待たせている側を先にロールバックし、ロック待ちのタスクが自然に終わるのを待つ
+    (終わらなければキャンセルする)
+    """
+    busy = {id(conn) for task, conn in tasks if not task.done()}
+    for conn in connections:
+        if id(conn) not in busy:
+            try:
+                await conn.rollback()
+            except Exception:
+                pass
+    all_tasks = [task for task, _ in tasks]
+    if all_tasks:
+        _, pending = await asyncio.wait(all_tasks, timeout=LOCK_WAIT_TIMEOUT * 2)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*all_tasks, return_exceptions=True)
+    for conn in connections:
+        try:
+            await conn.close()
+        except Exception:
+            pass
 
 
 class MySqlAsyncBaseTest(IsolatedAsyncioTestCase):
     maxDiff = None
 
+    @property
+    def database(self):
+        return environ["MYSQL_DATABASE"]
+
     async def create_connection(self, root=False):
-        conn = await aio_connector.connect(
-            host=environ["MYSQL_HOST"],
-            port=int(environ["MYSQL_PORT"]),
-            user=environ["MYSQL_USER"] if not root else "root",
-            password=(
-                environ["MYSQL_PASSWORD"]
-                if not root
-                else environ["MYSQL_ROOT_PASSWORD"]
-            ),
-            database=environ["MYSQL_DATABASE"],
-        )
+        conn = await aio_connector.connect(**mysql_connect_params(root=root))
         await conn.set_autocommit(False)
         self._connections.append(conn)
         return conn
 
     async def setup_tables(self, query):
         conn = await self.create_connection(root=True)
-        cur = await conn.cursor()
-        for q in query.split(";"):
-            cleaned = q.strip()
-            if not cleaned:
-                continue
-            await cur.execute(cleaned)
-
+        await async_execute_mysql_script(conn, query)
         await conn.commit()
 
+    async def start_blocking(self, conn, coro, timeout=LOCK_WAIT_TIMEOUT):
+        """
+        coro をタスクとして実行し、conn のセッションがロック待ちになった時点でタスクを返す
+        """
+        if self._lock_wait_cur is None:
+            lock_wait_conn = await self.create_connection(root=True)
+            await lock_wait_conn.set_autocommit(True)
+            self._lock_wait_cur = await lock_wait_conn.cursor()
+
+        async def is_blocked():
+            await self._lock_wait_cur.execute(MYSQL_LOCK_WAIT_QUERY, (connection_id,))
+            return (await self._lock_wait_cur.fetchall())[0][0] > 0
+
+        connection_id = conn.connection_id
+        task = asyncio.create_task(coro)
+        self._tasks.append((task, conn))
+        try:
+            blocked = await async_wait_until_blocked(
+                is_blocked, task.done, timeout=timeout
+            )
+        except TimeoutError as e:
+            self.fail(str(e))
+        if not blocked:
+            self.fail(f"session {connection_id} finished without waiting for a lock")
+        return task
+
     async def asyncSetUp(self):
         self._connections = []
+        self._tasks = []
+        self._lock_wait_cur = None
 
     async def asyncTearDown(self):
-        for conn in self._connections:
-            try:
-                await conn.close()
-            except Exception:
-                pass
+        await async_release_connections(self._connections, self._tasks)
 
-    def assertTableEqual(self, expected, actual):
+    def assertTableEqual(self, expected, actual, **values):
+        """
+        values は期待値の {名前} のセルに入る値 (pid や txid など)
+        """
         self.assertEqual(type(expected), str)
         self.assertEqual(type(actual), list)
 
-        expected_table = expected.strip()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="left"
-        )
-        if expected_table != actual_table:
-            self.fail(f"Expected:\n{expected_table}\n\nActual:\n{actual_table}")
+        message = compare_table(expected, actual, **values)
+        if message is not None:
+            self.fail(message)
 
 
 class PostgresqlBaseTest(TestCase):
     maxDiff = None
 
-    def create_connection(self):
-        params = {
-            "user": environ["POSTGRES_USER"],
-            "password": environ["POSTGRES_PASSWORD"],
-            "host": environ["POSTGRES_HOST"],
-            "port": environ["POSTGRES_PORT"],
-            "dbname": environ["POSTGRES_DB"],
-        }
-        conn = psycopg.connect(
-            conninfo=" ".join([f"{k}={v}" for k, v in params.items()]),
-            autocommit=False,
-        )
-        self._connections.append(conn)
+    @property
+    def database(self):
+        """
+        テストが使うデータベース名 (並列実行時はワーカーごとに異なる)
+        """
+        return environ["POSTGRES_DB"]
+
+    def create_connection(self, fresh=False):
+        """
+        fresh=True の場合はプールを使わず新しいバックエンド (pid) を払い出す
+        """
+        pool = postgresql_pool()
+        conn = instrument_connection(pool.acquire(fresh=fresh), "postgresql")
+        self._connections.append((pool, conn))
         return conn
 
     def setup_tables(self, query):
         conn = self.create_connection()
-        with conn.cursor() as cur:
-            for q in query.split(";"):
-                cleaned = q.strip()
-                if not cleaned:
-                    continue
-                cur.execute(cleaned)
+        setup_postgresql_fixture(conn, query)
         conn.commit()
 
+    def lock_snapshot(self, conn):
+        return LockSnapshot.capture_postgresql(conn, database=self.database)
+
+    def wait_for_graph(self, conn):
+        return WaitForGraph.capture_postgresql(conn, database=self.database)
+
+    def start_blocking(self, conn, target, *args, timeout=LOCK_WAIT_TIMEOUT):
+        """
+        target(*args) を別スレッドで実行し、conn のバックエンドがロック待ちになった時点でスレッドを返す
+
+        ロック待ちにならずに終わった場合や timeout までに待ちにならなかった場合はテスト失敗
+        """
+        if self._lock_wait_cur is None:
+            lock_wait_conn = self.create_connection()
+            lock_wait_conn.autocommit = True
+            self._lock_wait_cur = lock_wait_conn.cursor()
+
+        pid = conn.info.backend_pid
+        thread = threading.Thread(target=target, args=args)
+        thread.start()
+        self._threads.append((thread, conn))
+
+        try:
+            blocked = wait_until_blocked(
+                lambda: is_postgresql_session_blocked(self._lock_wait_cur, pid),
+                lambda: not thread.is_alive(),
+                timeout=timeout,
+            )
+        except TimeoutError as e:
+            self.fail(str(e))
+        if not blocked:
+            self.fail(f"backend {pid} finished without waiting for a lock")
+        return thread
+
     def setUp(self):
         self._connections = []
+        self._threads = []
+        self._lock_wait_cur = None
 
     def tearDown(self):
-        for conn in self._connections:
-            try:
-                conn.rollback()
-            except Exception:
-                pass
-            try:
-                conn.close()
-            except Exception:
-                pass
+        release_connections(self._connections, self._threads)
 
-    def assertTableEqual(self, expected, actual):
+    def assertTableEqual(self, expected, actual, **values):
+        """
+        values は期待値の {名前} のセルに入る値 (pid や txid など)
+        """
         self.assertEqual(type(expected), str)
         self.assertEqual(type(actual), list)
 
-        expected_table = expected.strip()
-        actual_table = tabulate(
-            actual, headers="keys", tablefmt="psql", stralign="left"
+        message = compare_table(expected, actual, **values)
+        if message is not None:
+            self.fail(message)
+
+
+class PostgresqlAsyncBaseTest(IsolatedAsyncioTestCase):
+    """
+    psycopg.AsyncConnection を使う版
+
+    ロック待ちのセッションをスレッドではなくタスクで動かすので、1 つのイベントループで多数のセッションを扱える
+    """
+
+    maxDiff = None
+
+    @property
+    def database(self):
+        return environ["POSTGRES_DB"]
+
+    async def create_connection(self):
+        conn = await psycopg.AsyncConnection.connect(
+            conninfo=postgresql_conninfo(), autocommit=False
         )
-        if expected_table != actual_table:
-            self.fail(f"Expected:\n{expected_table}\n\nActual:\n{actual_table}")
+        self._connections.append(conn)
+        return conn
+
+    async def setup_tables(self, query):
+        conn = await self.create_connection()
+        await async_execute_postgresql_script(conn, query)
+        await conn.commit()
+
+    async def start_blocking(self, conn, coro, timeout=LOCK_WAIT_TIMEOUT):
+        """
+        coro をタスクとして実行し、conn のバックエンドがロック待ちになった時点でタスクを返す
+        """
+        if self._lock_wait_cur is None:
+            lock_wait_conn = await self.create_connection()
+            await lock_wait_conn.set_autocommit(True)
+            self._lock_wait_cur = lock_wait_conn.cursor()
+
+        async def is_blocked():
+            await self._lock_wait_cur.execute(POSTGRESQL_LOCK_WAIT_QUERY, (pid,))
+            return (await self._lock_wait_cur.fetchone())[0] > 0
+
+        pid = conn.info.backend_pid
+        task = asyncio.create_task(coro)
+        self._tasks.append((task, conn))
+        try:
+            blocked = await async_wait_until_blocked(
+                is_blocked, task.done, timeout=timeout
+            )
+        except TimeoutError as e:
+            self.fail(str(e))
+        if not blocked:
+            self.fail(f"backend {pid} finished without waiting for a lock")
+        return task
+
+    async def asyncSetUp(self):
+        self._connections = []
+        self._tasks = []
+        self._lock_wait_cur = None
+
+    async def asyncTearDown(self):
+        await async_release_connections(self._connections, self._tasks)
+
+    def assertTableEqual(self, expected, actual, **values):
+        """
+        values は期待値の {名前} のセルに入る値 (pid や txid など)
+        """
+        self.assertEqual(type(expected), str)
+        self.assertEqual(type(actual), list)
+
+        message = compare_table(expected, actual, **values)
+        if message is not None:
+            self.fail(message)
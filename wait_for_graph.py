@@ -0,0 +1,196 @@
+"""
+ロック待ちの関係 (待っているセッション -> 待たせているセッション) をグラフにして分析する
+
+- cycles: 互いに待ち合っているセッションの組 (デッドロック)
+- root_blockers: 誰にも待たされていないのに他のセッションを待たせている先頭のセッション
+- stall_counts: 先頭のセッションごとに、直接・間接に待たされているセッション数
+
+辺の取得はエンジンごとに 1 クエリで、分析はどれも辺の数に対してほぼ線形に動く
+"""
+
+from collections import deque
+
+MYSQL_WAIT_FOR_QUERY = """
+select distinct
+    tw.PROCESSLIST_ID,
+    tb.PROCESSLIST_ID
+from
+    performance_schema.data_lock_waits w
+    join performance_schema.data_locks l on (
+        l.ENGINE = w.ENGINE
+        and l.ENGINE_LOCK_ID = w.REQUESTING_ENGINE_LOCK_ID
+    )
+    join performance_schema.threads tw on (w.REQUESTING_THREAD_ID = tw.THREAD_ID)
+    join performance_schema.threads tb on (w.BLOCKING_THREAD_ID = tb.THREAD_ID)
+where
+    %(schema)s is null or l.OBJECT_SCHEMA = %(schema)s
+"""
+
+# pg_blocking_pids は重いので、ロック待ちのセッションに限って呼ぶ
+POSTGRESQL_WAIT_FOR_QUERY = """
+select distinct
+    s.pid,
+    unnest(pg_blocking_pids(s.pid))
+from
+    pg_stat_activity s
+where
+    s.wait_event_type = 'Lock'
+    and (%(database)s::text is null or s.datname = %(database)s)
+"""
+
+
+class WaitForGraph:
+    def __init__(self, edges=()):
+        # waiter -> 待たせているセッション / blocker -> 待っているセッション
+        self.blockers = {}
+        self.waiters = {}
+        for waiter, blocker in edges:
+            self.add_edge(waiter, blocker)
+
+    @classmethod
+    def capture_mysql(cls, conn, schema=None):
+        with conn.cursor() as cur:
+            cur.execute(MYSQL_WAIT_FOR_QUERY, {"schema": schema})
+            return cls(cur.fetchall())
+
+    @classmethod
+    def capture_postgresql(cls, conn, database=None):
+        with conn.cursor() as cur:
+            cur.execute(POSTGRESQL_WAIT_FOR_QUERY, {"database": database})
+            return cls(cur.fetchall())
+
+    def add_edge(self, waiter, blocker):
+        self.blockers.setdefault(waiter, set()).add(blocker)
+        self.waiters.setdefault(blocker, set()).add(waiter)
+        self.blockers.setdefault(blocker, set())
+        self.waiters.setdefault(waiter, set())
+
+    @property
+    def sessions(self):
+        return self.blockers.keys()
+
+    def __len__(self):
+        return len(self.blockers)
+
+    def edges(self):
+        return [
+            (waiter, blocker)
+            for waiter, blockers in self.blockers.items()
+            for blocker in blockers
+        ]
+
+    def components(self):
+        """
+        強連結成分を返す (Tarjan のアルゴリズム)
+
+        セッション数が多くても再帰の上限に当たらないよう、スタックを自前で持つ
+        成分は「待たせている側」が先に並ぶ
+        """
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        result = []
+        counter = 0
+
+        for start in self.blockers:
+            if start in index:
+                continue
+            work = [(start, iter(self.blockers[start]))]
+            index[start] = lowlink[start] = counter
+            counter += 1
+            stack.append(start)
+            on_stack.add(start)
+
+            while work:
+                node, neighbors = work[-1]
+                advanced = False
+                for neighbor in neighbors:
+                    if neighbor not in index:
+                        index[neighbor] = lowlink[neighbor] = counter
+                        counter += 1
+                        stack.append(neighbor)
+                        on_stack.add(neighbor)
+                        work.append((neighbor, iter(self.blockers[neighbor])))
+                        advanced = True
+                        break
+                    if neighbor in on_stack:
+                        lowlink[node] = min(lowlink[node], index[neighbor])
+                if advanced:
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    result.append(component)
+        return result
+
+    def cycles(self):
+        """
+        互いに待ち合っているセッションの組 (2 セッション以上の強連結成分か自己ループ)
+        """
+        return [
+            sorted(component)
+            for component in self.components()
+            if len(component) > 1 or component[0] in self.blockers[component[0]]
+        ]
+
+    def _head_components(self):
+        # 成分の外の誰にも待たされておらず、誰かを待たせている (またはデッドロックの) 成分
+        for component in self.components():
+            members = set(component)
+            if any(
+                blocker not in members
+                for member in component
+                for blocker in self.blockers[member]
+            ):
+                continue
+            if len(component) > 1 or self.waiters[component[0]]:
+                yield component
+
+    def root_blockers(self):
+        """
+        他のセッションを待たせていて、それ自身は成分の外の誰にも待たされていないセッション
+
+        デッドロックの組は外から待たされていなければ、組のセッション全員を返す
+        """
+        return sorted(
+            session for component in self._head_components() for session in component
+        )
+
+    def stalled_by(self, *sessions):
+        """
+        sessions に直接・間接に待たされているセッション (sessions 自身は除く)
+        """
+        seen = set(sessions)
+        queue = deque(sessions)
+        while queue:
+            for waiter in self.waiters[queue.popleft()]:
+                if waiter not in seen:
+                    seen.add(waiter)
+                    queue.append(waiter)
+        return seen.difference(sessions)
+
+    def stall_counts(self):
+        """
+        {先頭のセッション: 待たされているセッション数} を多い順に返す
+
+        先頭の成分ごとに 1 回だけ待ちの木をたどるので、1 つのセッションが 1 つの先頭だけに
+        待たされている (通常の) 場合は全体で辺の数に比例した時間で済む
+        デッドロックの組では、組の他のセッションも待たされている数に含める
+        """
+        counts = {}
+        for component in self._head_components():
+            stalled = len(self.stalled_by(*component)) + len(component) - 1
+            for session in component:
+                counts[session] = stalled
+        return dict(sorted(counts.items(), key=lambda kv: (-kv[1], kv[0])))